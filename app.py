@@ -4,6 +4,22 @@ from flask import Flask
 from dotenv import load_dotenv
 from views import main, authapi, posts, reviews, profile, payments, add, fav
 from config import initialize_app
+from utils.add import (
+    backfill_created_command,
+    backfill_guests_command,
+    backfill_prices_command,
+)
+from utils.blobs import sweep_images_command
+from utils.geo import geocode_command
+from utils.images import (
+    image_variants,
+    resize_static_images_command,
+    srcset,
+    static_image,
+)
+from utils.indexes import indexes_command
+from utils.ratings import backfill_ratings_command
+from utils.uploads import storage_cors_command
 
 
 def create_app(testing=False):
@@ -28,6 +44,18 @@ def create_app(testing=False):
     app.register_blueprint(payments)
     app.register_blueprint(add)
     app.register_blueprint(fav)
+    app.cli.add_command(backfill_ratings_command)
+    app.cli.add_command(backfill_prices_command)
+    app.cli.add_command(backfill_guests_command)
+    app.cli.add_command(backfill_created_command)
+    app.cli.add_command(indexes_command)
+    app.cli.add_command(geocode_command)
+    app.cli.add_command(resize_static_images_command)
+    app.cli.add_command(storage_cors_command)
+    app.cli.add_command(sweep_images_command)
+    app.add_template_filter(srcset)
+    app.add_template_global(image_variants)
+    app.add_template_global(static_image)
     return app
 
 
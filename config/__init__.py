@@ -1,2 +1,3 @@
 from .conf import initialize_app
 from .firebase import fetch_db
+from .redis import fetch_redis
@@ -17,6 +17,14 @@ def initialize_app(app, testing=False):
     # Initialize redis and firebase if not testing
     app.secret_key = os.getenv("PAGE_SECRET_KEY")
     app.config["UPLOAD_FOLDER"] = "static/uploads"
+    # Cache Firestore reads, except in tests where the database is mocked
+    app.config["FIRESTORE_CACHE"] = (
+        os.getenv("FIRESTORE_CACHE", "true") == "true" and not testing
+    )
+    # Answer searches from the in-memory index, which listens to Firestore
+    app.config["SEARCH_INDEX"] = (
+        os.getenv("SEARCH_INDEX", "true") == "true" and not testing
+    )
     stripe.api_key = os.getenv("STRIPE_API_KEY")
 
     @app.context_processor
@@ -1,14 +1,19 @@
 """ Firebase configuration module. """
+import os
+
 import firebase_admin
 from firebase_admin import firestore, credentials
 
+# The Storage bucket of the images, which browsers upload to with signed URLs.
+STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "bnb-ai.appspot.com")
+
 
 def initialize_firebase():
     """
     Initialize Firebase with default credentials.
     """
     cred = credentials.Certificate("./config/creds.json")
-    firebase_admin.initialize_app(cred, {"storageBucket": "bnb-ai.appspot.com"})
+    firebase_admin.initialize_app(cred, {"storageBucket": STORAGE_BUCKET})
 
 
 def fetch_db():
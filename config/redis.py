@@ -1,5 +1,6 @@
 """ This module is used to initialize redis user session. """
 import os
+from flask import current_app
 from redis import Redis
 from flask_session import Session
 
@@ -17,3 +18,11 @@ def initialize_redis(app):
         password=os.getenv("REDIS_PASSWORD"),
     )
     Session(app)
+
+
+def fetch_redis():
+    """
+    Fetch the redis client of the app. It is shared by the user sessions and the caches.
+    @return A : class : ` redis. Redis ` instance or None if redis is not initialized
+    """
+    return current_app.config.get("SESSION_REDIS")
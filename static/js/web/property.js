@@ -1,22 +1,45 @@
-async function fetchTips() {
-  const request = await fetch(
-    "/tips?city={{doc['city']}}&country={{doc['country']}}"
-  );
-  const tips = await request.json();
+var tipsStarted = false;
+function showTip(tipsList, tip) {
+  var item = document.createElement("li");
+  item.className = "list-item";
+  var link = document.createElement("a");
+  link.href =
+    "https://www.bing.com/search?q=" +
+    encodeURIComponent(tip.replace(/^\d+\.\s+/, ""));
+  link.textContent = tip;
+  item.appendChild(link);
+  tipsList.appendChild(item);
+}
+function fetchTips() {
+  // Tips are streamed once, when the modal is opened for the first time
+  if (tipsStarted) {
+    return;
+  }
+  tipsStarted = true;
   const tipsList = document.getElementById("tips-list");
-  tipsList.innerHTML = "";
-  for (var i = 0; i < tips.travel_tips.length; i++) {
-    tipsList.innerHTML += `
-        <li class="list-item"><a href="https://www.bing.com/search?q=${tips.travel_tips[
-          i
-        ]
-          .split(". ")[1]
-          .replace(" ", "+")}">${tips.travel_tips[i]}</a></li>
-        `;
+  const source = new EventSource(
+    "/tips/stream?" + new URLSearchParams(tipsLocation)
+  );
+  var received = 0;
+  source.onmessage = function (event) {
+    if (received == 0) {
+      tipsList.innerHTML = "";
+    }
+    received++;
+    showTip(tipsList, JSON.parse(event.data));
+  };
+  function finish() {
+    // Close the stream, otherwise the browser reconnects and asks again
+    source.close();
+    if (received == 0) {
+      tipsList.innerHTML =
+        '<li class="list-item">Service not available, try again later</li>';
+    }
   }
-  console.log(tipsList);
+  source.addEventListener("done", finish);
+  source.onerror = finish;
 }
-//fetchTips();
+document.getElementById("tips-link").addEventListener("click", fetchTips);
 function getStars() {
   var pStars = document.getElementById("stars");
   var rating = Number("{{avg_rating}}");
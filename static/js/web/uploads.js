@@ -0,0 +1,94 @@
+// Uploads the images of the add page straight to Storage with signed URLs,
+// see utils/uploads.py. Without fetch the form is posted to the server.
+function failure(filename, error) {
+  return { filename: filename, error: error };
+}
+function putImage(upload, file) {
+  if (upload.error) {
+    return Promise.resolve(failure(upload.filename, upload.error));
+  }
+  return fetch(upload.url, { method: "PUT", headers: upload.headers, body: file })
+    .then(function (response) {
+      return response.ok ? upload.object : failure(upload.filename, "upload failed");
+    })
+    .catch(function () {
+      return failure(upload.filename, "upload failed");
+    });
+}
+function postJson(url, body) {
+  return fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  }).then(function (response) {
+    if (!response.ok) {
+      throw new Error("The images could not be uploaded, try again later");
+    }
+    return response.json();
+  });
+}
+function uploadImages(form, files) {
+  var list = Array.from(files);
+  return postJson(form.dataset.sign, {
+    files: list.map(function (file) {
+      return { name: file.name, type: file.type, size: file.size };
+    }),
+  })
+    .then(function (data) {
+      return Promise.all(
+        data.uploads.map(function (upload, i) {
+          return putImage(upload, list[i]);
+        })
+      );
+    })
+    .then(function (outcomes) {
+      var objects = outcomes.filter(function (outcome) {
+        return typeof outcome === "string";
+      });
+      var failed = outcomes.filter(function (outcome) {
+        return typeof outcome !== "string";
+      });
+      if (objects.length == 0) {
+        return { redirect: null, failed: failed };
+      }
+      return postJson(form.dataset.finalize, { objects: objects }).then(
+        function (data) {
+          return { redirect: data.redirect, failed: failed.concat(data.failed) };
+        }
+      );
+    });
+}
+function showFailures(failed, redirect) {
+  notify_msg("These images could not be uploaded: ");
+  notify.textContent += failed
+    .map(function (result) {
+      return result.filename + " (" + result.error + ")";
+    })
+    .join(", ");
+  if (redirect) {
+    var link = document.createElement("a");
+    link.href = redirect;
+    link.textContent = " Continue with the uploaded images";
+    notify.appendChild(link);
+  }
+}
+var uploadForm = document.getElementById("upload-form");
+uploadForm.addEventListener("submit", function (e) {
+  var files = document.getElementById("form-files").files;
+  if (!window.fetch || files.length == 0) {
+    return;
+  }
+  e.preventDefault();
+  notify_msg("Uploading " + files.length + " files...");
+  uploadImages(uploadForm, files)
+    .then(function (result) {
+      if (result.failed.length > 0) {
+        showFailures(result.failed, result.redirect);
+      } else {
+        window.location = result.redirect;
+      }
+    })
+    .catch(function (error) {
+      notify_msg(error.message);
+    });
+});
@@ -15,6 +15,25 @@ def app():
     yield app
 
 
+@pytest.fixture()
+def cache_app(app):
+    """
+    Fixture for an app context with the read cache enabled and a mocked redis.
+    """
+    from utils import cache
+
+    cache._l1.clear()
+    cache._generations.clear()
+    redis = MagicMock()
+    redis.get.return_value = None
+    redis.incr.return_value = 1
+    app.config["FIRESTORE_CACHE"] = True
+    app.config["SESSION_REDIS"] = redis
+    with app.app_context():
+        yield redis
+    cache._l1.clear()
+
+
 @pytest.fixture()
 def client(app):
     """
@@ -80,7 +99,7 @@ def mocked_posts():
             "type": "apartment",
             "bedrooms": "1",
             "bathrooms": "1",
-            "guests": "1",
+            "maxGuests": 1,
             "beds": "1",
             "month_disc": "15",
             "year_disc": "20",
@@ -0,0 +1,140 @@
+""" Tests for the availability index of booked nights. """
+from datetime import date
+from unittest.mock import MagicMock, patch
+
+from utils.availability import AvailabilityIndex, Bookings, _book, rental_nights
+
+
+def nights(vfrom, to):
+    """
+    Convert date strings into the nights of a stay.
+    """
+    return date.fromisoformat(vfrom).toordinal(), date.fromisoformat(to).toordinal()
+
+
+def test_bookings_overlap():
+    """
+    Test that stays overlapping a booking are rejected and the checkout day stays free.
+    """
+    bookings = Bookings()
+    bookings.add("1", *nights("2024-05-10", "2024-05-15"))
+    bookings.add("2", *nights("2024-05-01", "2024-05-03"))
+    assert bookings.is_free(*nights("2024-05-03", "2024-05-10"))
+    assert bookings.is_free(*nights("2024-05-15", "2024-05-20"))
+    assert not bookings.is_free(*nights("2024-05-14", "2024-05-16"))
+    assert not bookings.is_free(*nights("2024-04-01", "2024-06-01"))
+
+
+def test_bookings_merge_and_remove():
+    """
+    Test that overlapping bookings are merged and can be removed again.
+    """
+    bookings = Bookings()
+    bookings.add("1", *nights("2024-05-01", "2024-05-05"))
+    bookings.add("2", *nights("2024-05-04", "2024-05-08"))
+    bookings.add("2", *nights("2024-05-04", "2024-05-08"))
+    assert not bookings.is_free(*nights("2024-05-06", "2024-05-07"))
+    bookings.remove("2")
+    assert bookings.is_free(*nights("2024-05-06", "2024-05-07"))
+    assert not bookings.is_free(*nights("2024-05-02", "2024-05-03"))
+
+
+def test_index_snapshot_and_booking():
+    """
+    Test that the index applies snapshot changes and local bookings.
+    """
+    index = AvailabilityIndex()
+    change = MagicMock()
+    change.type.name = "ADDED"
+    change.document.id = "1|uid"
+    change.document.to_dict.return_value = {
+        "property": 7,
+        "from": "2024-05-01",
+        "to": "2024-05-05",
+    }
+    index._on_snapshot(None, [change], None)
+    assert not index.is_free(7, *nights("2024-05-02", "2024-05-03"))
+    index.book("2|uid", "8", "2024-06-01", "2024-06-03")
+    assert not index.is_free(8, *nights("2024-06-02", "2024-06-04"))
+    assert index.is_free(9, *nights("2024-06-02", "2024-06-04"))
+
+
+def test_rental_nights_invalid():
+    """
+    Test that rentals without a valid stay are not indexed.
+    """
+    assert rental_nights({"property": 1, "from": "2024-05-05", "to": "2024-05-01"}) is None
+    assert rental_nights({"property": 1}) is None
+
+
+def test_checkout_rejects_booked_dates(auth_client, mocked_posts):
+    """
+    Test that a checkout for booked dates is rejected before the payment.
+    """
+    with patch("firebase_admin.firestore.client") as firestore, patch(
+        "views.payments.is_available", return_value=False
+    ), patch("stripe.checkout.Session.create") as stripe:
+        firestore.return_value.collection.return_value.where.return_value.stream.return_value = [
+            MagicMock(to_dict=lambda: mocked_posts[0])
+        ]
+        response = auth_client.post(
+            "/payment/1",
+            data={"from": "2023-05-01", "to": "2023-05-07", "guests": "2"},
+        )
+        assert response.status_code == 409
+        stripe.assert_not_called()
+
+
+def test_book_rejects_overlap():
+    """
+    Test that a rental is only written if its stay is free, and that a payment is booked once.
+    """
+    data = {"property": 1, "pay_id": "new", "from": "2023-05-03", "to": "2023-05-05"}
+    booked = MagicMock(id="1|other")
+    booked.to_dict.return_value = {
+        "property": 1,
+        "pay_id": "old",
+        "from": "2023-05-01",
+        "to": "2023-05-04",
+    }
+    rental_ref = MagicMock(id="2|user")
+    with patch("firebase_admin.firestore.client"):
+        transaction = MagicMock()
+        transaction.get.return_value = [booked]
+        assert _book.to_wrap(transaction, rental_ref, data) is None
+        transaction.set.assert_not_called()
+
+        transaction = MagicMock()
+        transaction.get.return_value = [booked]
+        later = {**data, "from": "2023-05-04", "to": "2023-05-06"}
+        assert _book.to_wrap(transaction, rental_ref, later) == "2|user"
+        transaction.set.assert_any_call(rental_ref, later)
+
+        transaction = MagicMock()
+        transaction.get.return_value = [booked]
+        again = {**data, "pay_id": "old"}
+        assert _book.to_wrap(transaction, rental_ref, again) == "1|other"
+        transaction.set.assert_not_called()
+
+
+def test_success_payment_refunds_overlap(auth_client):
+    """
+    Test that a payment for dates that were booked meanwhile is refunded.
+    """
+    with patch("firebase_admin.firestore.client"), patch(
+        "views.payments.book_rental", return_value=None
+    ), patch("views.payments.record_booking") as record, patch(
+        "stripe.checkout.Session.retrieve"
+    ) as retrieve, patch("stripe.Subscription.delete") as cancel, patch(
+        "stripe.Refund.create"
+    ) as refund:
+        retrieve.return_value = {
+            "subscription": "sub_1",
+            "payment_intent": None,
+            "invoice": {"payment_intent": "pi_1"},
+        }
+        response = auth_client.get("/payment-success?session_id=testing")
+        assert response.status_code == 409
+        cancel.assert_called_once_with("sub_1")
+        refund.assert_called_once_with(payment_intent="pi_1")
+        record.assert_not_called()
@@ -0,0 +1,135 @@
+"""Tests for the content addressed images and their reference counts."""
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+from utils.blobs import (
+    _recount,
+    _release,
+    content_key,
+    release_images,
+    retain_images,
+    sweep_images,
+)
+
+KEY = "ab" * 32
+URL = f"https://storage.googleapis.com/bucket/static/uploads/{KEY}.jpg"
+
+
+def test_content_key():
+    """
+    Test that only images named by their content have a key.
+    """
+    assert content_key(URL) == KEY
+    assert content_key("https://storage/static/uploads/IMG_0001.jpg") is None
+
+
+def test_retain_images(app):
+    """
+    Test that the references to every image are counted in one batch.
+    """
+    with app.app_context(), patch("firebase_admin.firestore.client") as firestore:
+        retain_images([URL, URL, "https://storage/static/uploads/old.jpg"])
+        batch = firestore.return_value.batch.return_value
+        batch.set.assert_called_once()
+        assert batch.set.call_args.args[1]["refs"].value == 2
+        batch.commit.assert_called_once()
+
+
+def test_release_keeps_shared_images():
+    """
+    Test that a counter only drops to zero, and is deleted, when the last reference goes.
+    """
+    transaction = MagicMock()
+    counter_ref = MagicMock()
+    counter_ref.get.return_value = MagicMock(
+        exists=True, to_dict=MagicMock(return_value={"refs": 3})
+    )
+    assert _release.to_wrap(transaction, counter_ref, 1) is False
+    transaction.update.assert_called_once_with(counter_ref, {"refs": 2})
+    assert _release.to_wrap(transaction, counter_ref, 3) is True
+    transaction.delete.assert_called_once_with(counter_ref)
+
+
+def test_release_images(app):
+    """
+    Test that unreferenced images are deleted with their variants, and shared ones are kept.
+    """
+    variants = [MagicMock()]
+    with app.app_context(), patch("utils.blobs.storage") as storage, patch(
+        "utils.blobs._release"
+    ) as release, patch("firebase_admin.firestore.client"):
+        bucket = storage.bucket.return_value
+        bucket.list_blobs.return_value = variants
+        release.return_value = False
+        assert release_images([URL]) == 0
+        bucket.list_blobs.assert_not_called()
+
+        release.return_value = True
+        assert release_images([URL]) == 1
+        bucket.list_blobs.assert_called_once_with(prefix=f"static/uploads/{KEY}")
+        variants[0].delete.assert_called_once()
+
+        bucket.list_blobs.return_value = []
+        assert release_images(["https://storage/static/uploads/old.jpg"]) == 1
+        bucket.blob.assert_called_once_with("static/uploads/old.jpg")
+        bucket.blob.return_value.delete.assert_called_once()
+
+
+def test_recount_keeps_recent_uploads():
+    """
+    Test that the references of recent uploads are kept, and old ones are
+    replaced by the references of the posts.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=8)
+    transaction = MagicMock()
+    counter_ref = MagicMock()
+    counter_ref.get.return_value = MagicMock(
+        exists=True, to_dict=MagicMock(return_value={"refs": 2, "retained": now})
+    )
+    assert _recount.to_wrap(transaction, counter_ref, 0, cutoff) is False
+    transaction.delete.assert_not_called()
+
+    counter_ref.get.return_value.to_dict.return_value = {"refs": 2}
+    assert _recount.to_wrap(transaction, counter_ref, 1, cutoff) is False
+    transaction.set.assert_called_once_with(counter_ref, {"refs": 1}, merge=True)
+    assert _recount.to_wrap(transaction, counter_ref, 0, cutoff) is True
+    transaction.delete.assert_called_once_with(counter_ref)
+
+
+def test_sweep_images(app):
+    """
+    Test that unreferenced images and unfinished uploads are deleted once they are old.
+    """
+    old = datetime.now(timezone.utc) - timedelta(days=30)
+    new = datetime.now(timezone.utc)
+    orphan, fresh, pending = "cd" * 32, "ef" * 32, "0" * 32
+
+    def blob(name, created):
+        result = MagicMock(time_created=created)
+        result.name = name
+        return result
+
+    blobs = [
+        blob(f"static/uploads/{KEY}.jpg", old),
+        blob(f"static/uploads/{orphan}.jpg", old),
+        blob(f"static/uploads/{orphan}-320w.webp", old),
+        blob(f"static/uploads/{fresh}.jpg", new),
+        blob(f"static/uploads/{pending}-room.jpg", old),
+        blob("static/uploads/legacy.jpg", old),
+    ]
+    post = MagicMock(to_dict=MagicMock(return_value={"images": [URL]}))
+    with app.app_context(), patch("utils.blobs.storage") as storage, patch(
+        "utils.blobs._recount"
+    ) as recount, patch("firebase_admin.firestore.client") as client:
+        client.return_value.collection.return_value.stream.side_effect = [[post], []]
+        storage.bucket.return_value.list_blobs.return_value = blobs
+        recount.side_effect = lambda transaction, ref, refs, cutoff: refs == 0
+        assert sweep_images() == 2
+        assert {call.args[2] for call in recount.call_args_list} == {0, 1}
+    deleted = [item.name for item in blobs if item.delete.called]
+    assert deleted == [
+        f"static/uploads/{orphan}.jpg",
+        f"static/uploads/{orphan}-320w.webp",
+        f"static/uploads/{pending}-room.jpg",
+    ]
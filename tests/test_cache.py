@@ -0,0 +1,127 @@
+""" Tests for the two-tier Firestore read cache. """
+import threading
+import time
+from unittest.mock import MagicMock
+
+from utils import cache
+from utils.cache import (
+    LRUCache,
+    cached,
+    document_cache_name,
+    invalidate,
+    invalidate_posts,
+    invalidate_searches,
+    search_cache_name,
+)
+
+
+def test_lru_eviction_and_ttl():
+    """
+    Test that the L1 cache evicts the least recently used entry and expires entries.
+    """
+    lru = LRUCache(maxsize=2, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+
+    lru = LRUCache(maxsize=2, ttl=0)
+    lru.set("a", 1)
+    time.sleep(0.001)
+    assert lru.get("a") is None
+
+
+def test_cached_reads_and_invalidation(cache_app):
+    """
+    Test that reads are served from the cache until the collection is invalidated.
+    """
+    loader = MagicMock(return_value={"favs": ["1"]})
+    first = cached("fav", "'1234'", loader)
+    first["favs"].append("2")
+    assert cached("fav", "'1234'", loader) == {"favs": ["1"]}
+    assert loader.call_count == 1
+    assert cache_app.set.call_args.kwargs["ex"] == cache.L2_TTL
+
+    invalidate("fav")
+    cache_app.incr.assert_called_with("cache:gen:fav")
+    cached("fav", "'1234'", loader)
+    assert loader.call_count == 2
+
+
+def test_cached_coalesces_misses(cache_app, app):
+    """
+    Test that concurrent misses for the same key load the value once.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        return "value"
+
+    results = []
+
+    def read():
+        with app.app_context():
+            results.append(cached("posts", "'1|1234'", loader))
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    threads[0].start()
+    started.wait(1)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["value"] * 4
+    assert len(calls) == 1
+
+
+def test_document_cache_per_document(cache_app):
+    """
+    Test that a write to a document only invalidates the cached reads of that
+    document, and a write to a post also the listings of its user.
+    """
+    mine, other = MagicMock(return_value={}), MagicMock(return_value={})
+    listings = MagicMock(return_value=[])
+    cached(document_cache_name("fav", "1234"), "'fav'", mine)
+    cached(document_cache_name("fav", "5678"), "'fav'", other)
+    cached(document_cache_name("listings", "1234"), "'posts'", listings)
+
+    invalidate(document_cache_name("fav", "1234"))
+    cache_app.incr.assert_called_with("cache:gen:fav/1234")
+    cached(document_cache_name("fav", "1234"), "'fav'", mine)
+    cached(document_cache_name("fav", "5678"), "'fav'", other)
+    assert mine.call_count == 2
+    assert other.call_count == 1
+
+    invalidate_posts({"id": "3", "user_uid": "1234"})
+    assert {c.args[0] for c in cache_app.incr.call_args_list[-2:]} == {
+        "cache:gen:posts/3",
+        "cache:gen:listings/1234",
+    }
+    cached(document_cache_name("listings", "1234"), "'posts'", listings)
+    assert listings.call_count == 2
+
+
+def test_search_cache_per_country(cache_app):
+    """
+    Test that a write to a post only invalidates the cached searches of its country.
+    """
+    france = MagicMock(return_value=[1, 2])
+    albania = MagicMock(return_value=[3])
+    cached(search_cache_name("France"), "key", france)
+    cached(search_cache_name(" Albania"), "key", albania)
+
+    invalidate_searches(" France", None)
+    cache_app.incr.assert_called_once_with("cache:gen:search:France")
+    cached(search_cache_name("France"), "key", france)
+    cached(search_cache_name("Albania"), "key", albania)
+    assert france.call_count == 2
+    assert albania.call_count == 1
@@ -0,0 +1,66 @@
+"""Tests for the map clusters."""
+import numpy as np
+
+from utils.clusters import (
+    CELLS_PER_TILE,
+    MAX_ZOOM,
+    ClusterIndex,
+    mercator_cells,
+    tile_box,
+)
+
+
+def test_mercator_cells():
+    """
+    Test that the corners of the map are projected to the corner cells.
+    """
+    size = 2 ** (MAX_ZOOM + 3)
+    column, row = mercator_cells(np.array([90.0, -90.0]), np.array([-180.0, 180.0]))
+    assert list(column) == [0, size - 1]
+    assert list(row) == [0, size - 1]
+
+
+def test_cluster_levels():
+    """
+    Test that nearby posts are one cluster when zoomed out and split when zoomed in.
+    """
+    clusters = ClusterIndex.from_docs(
+        [
+            {"id": 1, "lat": 48.8534, "lng": 2.3488},
+            {"id": 2, "lat": 48.8014, "lng": 2.1301},
+            {"id": 3, "lat": 45.7491, "lng": 4.8479},
+            {"id": 4, "lat": None, "lng": None},
+        ]
+    )
+    (world,) = clusters.tile(0, 0, 0)
+    assert world["count"] == 3
+    assert world["lat"] == round((48.8534 + 48.8014 + 45.7491) / 3, 5)
+    assert [c["count"] for c in clusters.tile(5, 16, 11)] == [2, 1]
+    assert sorted(c["id"] for c in clusters.tile(10, 518, 352)) == [1, 2]
+    assert clusters.tile(1, 0, 0) == []
+
+
+def test_tile_size_bounded():
+    """
+    Test that a tile has at most one cluster per cell, however many posts there are.
+    """
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-60, 60, 5000)
+    lng = rng.uniform(-180, 180, 5000)
+    clusters = ClusterIndex(lat, lng, np.arange(5000))
+    tile = clusters.tile(0, 0, 0)
+    assert len(tile) <= CELLS_PER_TILE**2
+    assert sum(c["count"] for c in tile) == 5000
+    assert clusters.tile(1, 1, 1) != []
+
+
+def test_tile_box():
+    """
+    Test that the box of a tile contains its posts and the edge tiles reach the poles.
+    """
+    assert tile_box(0, 0, 0) == (-90.0, -180.0, 90.0, 180.0)
+    south, west, north, east = tile_box(10, 518, 352)
+    assert south < 48.8534 < north and west < 2.3488 < east
+    assert south < 48.8014 < north and west < 2.1301 < east
+    assert tile_box(1, 1, 0)[1:] == (0.0, 90.0, 180.0)
+    assert tile_box(1, 1, 0)[0] == 0
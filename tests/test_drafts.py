@@ -0,0 +1,108 @@
+"""Tests for the drafts of the add wizard."""
+from unittest.mock import MagicMock, patch
+
+from flask import session
+
+from utils.drafts import (
+    commit_draft,
+    load_draft,
+    start_draft,
+    update_draft,
+    update_post,
+)
+
+
+def login(app):
+    """
+    Build a request context with a logged in user.
+    """
+    context = app.test_request_context()
+    context.push()
+    session["user"] = {"uid": "1234", "creation_id": ""}
+    return context
+
+
+def test_draft_in_redis(app):
+    """
+    Test that the steps of a new post are collected in redis and written in one commit.
+    """
+    store = {}
+    redis = MagicMock()
+    redis.get.side_effect = store.get
+    redis.set.side_effect = lambda key, value, ex: store.__setitem__(key, value)
+    redis.delete.side_effect = lambda key: store.pop(key, None)
+    app.config["SESSION_REDIS"] = redis
+    context = login(app)
+    try:
+        with patch("utils.drafts.next_id", return_value=42), patch(
+            "firebase_admin.firestore.client"
+        ) as firestore:
+            start_draft({"city": "Paris", "country": "France"})
+            assert session["user"]["creation_id"] == 42
+            update_draft(42, {"images": ["a.jpg"]}, images=True)
+            update_draft(42, {"images": ["b.jpg"]}, images=True)
+            assert list(store) == ["draft:1234:42"]
+            assert load_draft(42)["images"] == ["b.jpg", "a.jpg"]
+
+            post = commit_draft(42, {"price": 100})
+            assert post["id"] == 42 and post["city"] == "Paris"
+            batch = firestore.return_value.batch.return_value
+            batch.set.assert_called_once()
+            batch.commit.assert_called_once()
+            assert store == {}
+    finally:
+        context.pop()
+
+
+def test_update_post_diff(app):
+    """
+    Test that edits only write the changed fields, and nothing if nothing changed.
+    """
+    context = login(app)
+    try:
+        with patch("firebase_admin.firestore.client") as firestore:
+            doc_ref = (
+                firestore.return_value.collection.return_value.document.return_value
+            )
+            doc_ref.get.return_value.to_dict.return_value = {
+                "price": 100,
+                "month_disc": "10",
+                "country": "France",
+            }
+            transaction = firestore.return_value.transaction.return_value
+            assert update_post(1, {"price": 120, "month_disc": "10"}) == {"price": 120}
+            transaction.update.assert_called_once_with(doc_ref, {"price": 120})
+            transaction.update.reset_mock()
+            assert update_post(1, {"price": 100, "month_disc": "10"}) == {}
+            transaction.update.assert_not_called()
+    finally:
+        context.pop()
+
+
+def test_update_post_images_in_transaction(app):
+    """
+    Test that new images are added to the images the post has in the transaction.
+    """
+    context = login(app)
+    try:
+        with patch("firebase_admin.firestore.client") as firestore:
+            doc_ref = (
+                firestore.return_value.collection.return_value.document.return_value
+            )
+            doc_ref.get.return_value.to_dict.return_value = {
+                "images": ["old.jpg"],
+                "image_variants": [{"url": "old.jpg"}],
+            }
+            data = {"images": ["new.jpg"], "image_variants": [{"url": "new.jpg"}]}
+            update_post(1, data, images=True)
+            transaction = firestore.return_value.transaction.return_value
+            doc_ref.get.assert_called_with(transaction=transaction)
+            transaction.update.assert_called_once_with(
+                doc_ref,
+                {
+                    "images": ["new.jpg", "old.jpg"],
+                    "image_variants": [{"url": "new.jpg"}, {"url": "old.jpg"}],
+                },
+            )
+    finally:
+        context.pop()
@@ -0,0 +1,31 @@
+"""Tests for the amenity facets."""
+import numpy as np
+
+from utils.facets import FacetIndex, facet_filter
+
+
+def test_facet_index_bitsets():
+    """
+    Test the bitwise filters and counts over more rows than fit into a byte.
+    """
+    rows = [
+        {"basics:Wifi"} if i % 2 else {"basics:Wifi", "standout:Pool"}
+        for i in range(10)
+    ]
+    facets = FacetIndex(rows)
+    pool = facets.mask(["standout:Pool"])
+    assert list(np.flatnonzero(pool)) == [0, 2, 4, 6, 8]
+    assert facets.mask([]).all()
+    assert not facets.mask(["standout:Gym"]).any()
+    assert facets.counts(pool) == {"basics": {"Wifi": 5}, "standout": {"Pool": 5}}
+
+
+def test_facet_filter():
+    """
+    Test the amenity filter for documents outside of the index.
+    """
+    doc = {"tags": {"basics": ["Wifi"], "standout": '["Pool"]'}}
+    assert facet_filter(["basics:Wifi", "standout:Pool"])(doc)
+    assert not facet_filter(["basics:Wifi", "standout:Gym"])(doc)
+    assert facet_filter(["basics:Wifi", "standout:Gym"], match_all=False)(doc)
+    assert facet_filter([]) is None
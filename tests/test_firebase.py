@@ -0,0 +1,275 @@
+""" Tests for the Firestore helper functions. """
+import hashlib
+import json
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from utils.firebase import (
+    batched_updates,
+    get_avg_rating,
+    get_avg_ratings,
+    get_ratings_user,
+    resolve_avg_ratings,
+    upload_files,
+)
+
+
+def mock_reviews(reviews):
+    """
+    Wrap review dictionaries in mocked Firestore snapshots.
+
+    @param reviews - A list of review dictionaries
+    @return A list of mocked documents returning the reviews from to_dict
+    """
+    return [MagicMock(to_dict=MagicMock(return_value=review)) for review in reviews]
+
+
+def test_resolve_avg_ratings_chunks():
+    """
+    Test that the ratings of many properties are fetched in chunked "in" queries.
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        where = firestore.return_value.collection.return_value.where
+        where.return_value.stream.side_effect = [
+            mock_reviews(
+                [
+                    {"reviewed": 1, "rating": 5},
+                    {"reviewed": 1, "rating": 4},
+                    {"reviewed": 2, "rating": 3},
+                ]
+            ),
+            mock_reviews([{"reviewed": 31, "rating": "2"}]),
+        ]
+        ratings = resolve_avg_ratings(list(range(1, 41)))
+
+        assert where.call_count == 2
+        assert where.call_args_list[0].args == ("reviewed", "in", list(range(1, 31)))
+        assert ratings[1] == 4.5
+        assert ratings[2] == 3
+        assert ratings[31] == 2
+        assert ratings[40] is None
+
+
+def test_resolve_avg_ratings_empty():
+    """
+    Test that no query is made for an empty list of ids.
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        assert resolve_avg_ratings([]) == {}
+        firestore.return_value.collection.assert_not_called()
+
+
+def test_get_avg_rating_wrapper():
+    """
+    Test that the single and the per-document helpers go through the batched resolver.
+    """
+    with patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.0 for i in ids},
+    ) as resolver:
+        assert get_avg_rating(3) == 4.0
+        docs = get_avg_ratings([{"id": "1"}, {"id": "2"}])
+        assert [doc["avg_rating"] for doc in docs] == [4.0, 4.0]
+        assert resolver.call_count == 2
+
+
+def test_get_ratings_user_limits_reviews():
+    """
+    Test that a user's average comes from the rating aggregates and that only the
+    newest reviews are fetched, in chunked "in" queries for users with many posts.
+    """
+    docs = [{"id": i, "rating_sum": 9, "rating_count": 2} for i in range(1, 41)]
+    with patch("firebase_admin.firestore.client") as firestore:
+        where = firestore.return_value.collection.return_value.where
+        newest = where.return_value.order_by.return_value.limit.return_value
+        newest.stream.side_effect = [
+            mock_reviews(
+                [{"reviewed": 1, "timestamp": 1}, {"reviewed": 2, "timestamp": 3}]
+            ),
+            mock_reviews([{"reviewed": 31, "timestamp": 2}]),
+        ]
+        reviews, avg_rating, count = get_ratings_user(docs, limit=2)
+
+        assert [review["timestamp"] for review in reviews] == [3, 2]
+        assert avg_rating == 4.5
+        assert count == 80
+        assert [c.args[2] for c in where.call_args_list] == [
+            list(range(1, 31)),
+            list(range(31, 41)),
+        ]
+        where.return_value.order_by.return_value.limit.assert_called_with(2)
+        where.return_value.stream.assert_not_called()
+
+
+def test_batched_updates():
+    """
+    Test that updates are committed in batches of at most BATCH_LIMIT writes.
+    """
+    refs = [MagicMock() for _ in range(5)]
+    with patch("firebase_admin.firestore.client") as firestore, patch(
+        "utils.firebase.BATCH_LIMIT", 2
+    ):
+        batch = firestore.return_value.batch.return_value
+        assert batched_updates((ref, {"n": i}) for i, ref in enumerate(refs)) == 5
+        assert batch.commit.call_count == 3
+        assert batch.update.call_args_list[4].args == (refs[4], {"n": 4})
+        assert batched_updates([]) == 0
+        assert batch.commit.call_count == 3
+
+
+def test_id_allocator_reserves_blocks():
+    """
+    Test that ids are handed out from blocks reserved in the counter document.
+    """
+    from utils.ids import IdAllocator
+
+    with patch("utils.ids._reserve_block", side_effect=[1, 4]) as reserve:
+        allocator = IdAllocator("posts", block_size=3)
+        assert [allocator.allocate() for _ in range(5)] == [1, 2, 3, 4, 5]
+        assert reserve.call_count == 2
+        assert reserve.call_args.args[1:] == ("posts", 3)
+
+
+def test_reserve_block_seeds_counter():
+    """
+    Test that a missing counter is seeded with the highest id in the collection.
+    """
+    from utils.ids import _reserve_block
+
+    transaction = MagicMock()
+    transaction.get.return_value = [
+        MagicMock(to_dict=MagicMock(return_value={"id": 41}))
+    ]
+    with patch("firebase_admin.firestore.client") as firestore:
+        counter_ref = firestore.return_value.collection.return_value.document.return_value
+        counter_ref.get.return_value = MagicMock(exists=False)
+        assert _reserve_block.to_wrap(transaction, "rentals", 10) == 42
+        transaction.set.assert_called_once_with(counter_ref, {"last_id": 51})
+
+
+def test_firebase_query_stream_prefetch():
+    """
+    Test that stream mode reads documents lazily in batches.
+    """
+    from utils.firebase import firebase_query
+
+    with patch("firebase_admin.firestore.client") as firestore:
+        query = firestore.return_value.collection.return_value.where.return_value
+        query.limit.return_value.stream.return_value = mock_reviews(
+            [{"id": 1}, {"id": 2}]
+        )
+        query.limit.return_value.start_after.return_value.stream.return_value = (
+            mock_reviews([{"id": 3}])
+        )
+        with firebase_query(
+            "posts", [("country", "==", 1)], stream=True, prefetch=2
+        ) as docs:
+            assert not isinstance(docs, list)
+            assert next(docs) == {"id": 1}
+            query.limit.return_value.start_after.assert_not_called()
+            assert [doc["id"] for doc in docs] == [2, 3]
+        query.limit.assert_called_with(2)
+
+
+def image_bytes(fmt="JPEG", size=(800, 600)):
+    """
+    Encode a generated image.
+
+    @param fmt - The format of the image
+    @param size - The width and height of the image
+    @return The bytes of the image
+    """
+    output = BytesIO()
+    Image.new("RGB", size, (200, 120, 40)).save(output, fmt)
+    return output.getvalue()
+
+
+def test_upload_files_partial_failure(app):
+    """
+    Test that images are uploaded under the names of their content with their
+    variants, and every file reports its own outcome.
+    """
+    jpeg, png = image_bytes(), image_bytes("PNG")
+    files = [
+        FileStorage(BytesIO(jpeg), filename="one.jpg", content_type="image/jpeg"),
+        FileStorage(BytesIO(png), filename="two.png", content_type="image/png"),
+        FileStorage(BytesIO(b"text"), filename="notes.txt"),
+        FileStorage(BytesIO(b"text"), filename="fake.jpg", content_type="image/jpeg"),
+    ]
+    name = f"static/uploads/{hashlib.sha256(jpeg).hexdigest()}"
+    failing = f"static/uploads/{hashlib.sha256(png).hexdigest()}"
+    blobs = {}
+    with app.app_context(), patch("utils.firebase.storage") as storage, patch(
+        "utils.images.IMAGE_WORKERS", 0
+    ), patch("firebase_admin.firestore.client") as firestore, patch(
+        "utils.blobs._release"
+    ) as release:
+        bucket = storage.bucket.return_value
+        bucket.get_blob.return_value = None
+
+        def blob(blob_name):
+            result = MagicMock(public_url=f"https://storage/{blob_name}")
+            if blob_name.startswith(failing):
+                result.upload_from_string.side_effect = RuntimeError("timeout")
+            blobs[blob_name] = result
+            return result
+
+        bucket.blob.side_effect = blob
+        results = upload_files(files)
+
+    assert results[0]["url"] == f"https://storage/{name}.jpg"
+    assert results[0]["variants"]["url"] == results[0]["url"]
+    assert results[0]["variants"]["widths"] == [320, 640, 800]
+    assert results[1:] == [
+        {"filename": "two.png", "error": "timeout"},
+        {"filename": "notes.txt", "error": "file type not allowed"},
+        {"filename": "fake.jpg", "error": "not a valid image"},
+    ]
+    original = blobs[f"{name}.jpg"]
+    assert original.cache_control == "public, max-age=31536000, immutable"
+    assert original.upload_from_string.call_args.kwargs["content_type"] == "image/jpeg"
+    variant = blobs[f"{name}-640w.webp"]
+    assert variant.cache_control == "public, max-age=31536000, immutable"
+    assert variant.upload_from_string.call_args.kwargs["content_type"] == "image/webp"
+    storage.bucket.assert_called_once()
+    # Both images took a reference, the failed one gave it back
+    assert firestore.return_value.batch.return_value.commit.call_count == 2
+    release.assert_called_once()
+
+
+def test_upload_files_deduplicated(app):
+    """
+    Test that an image that is stored already is neither resized nor uploaded again.
+    """
+    jpeg = image_bytes()
+    variants = {"url": "https://storage/stored.jpg", "widths": [320]}
+    with app.app_context(), patch("utils.firebase.storage") as storage, patch(
+        "utils.blobs.process_image"
+    ) as process_image, patch("firebase_admin.firestore.client") as firestore:
+        bucket = storage.bucket.return_value
+        bucket.get_blob.return_value = MagicMock(
+            public_url="https://storage/stored.jpg",
+            metadata={"variants": json.dumps(variants)},
+        )
+        results = upload_files(
+            [FileStorage(BytesIO(jpeg), filename="copy.jpg", content_type="image/jpeg")]
+        )
+
+    assert results == [
+        {
+            "filename": "copy.jpg",
+            "url": "https://storage/stored.jpg",
+            "variants": variants,
+        }
+    ]
+    bucket.get_blob.assert_called_once_with(
+        f"static/uploads/{hashlib.sha256(jpeg).hexdigest()}.jpg"
+    )
+    bucket.blob.assert_not_called()
+    process_image.assert_not_called()
+    # The stored image is referenced once more, so it is not deleted under the copy
+    batch = firestore.return_value.batch.return_value
+    assert batch.set.call_args.args[1]["refs"].value == 1
@@ -0,0 +1,159 @@
+"""Tests for the offline geocoder and the geohash index."""
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+
+from utils.geo import (
+    GeoIndex,
+    covering_cells,
+    encode_geohash,
+    geocode,
+    geocode_place,
+    geocode_posts,
+    haversine_km,
+    location_data,
+    near_filter,
+    posts_in_box,
+    radius_box,
+)
+
+
+def test_encode_geohash():
+    """
+    Test the geohash of a well known point.
+    """
+    assert encode_geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert encode_geohash(-33.8688, 151.2093).startswith("r3gx2")
+
+
+def test_haversine():
+    """
+    Test the distance between Paris and Lyon.
+    """
+    assert 390 < haversine_km(48.8534, 2.3488, 45.7491, 4.8479) < 395
+    assert haversine_km(10, 179.9, 10, -179.9) < 25
+
+
+def test_geocode():
+    """
+    Test that addresses are geocoded from the gazetteer, also with accents and spaces.
+    """
+    assert geocode(" Paris", " France") == (48.8534, 2.3488)
+    assert geocode("Zurich", "Switzerland") == geocode("Zürich", "CH")
+    # The district is tried if the city is unknown
+    assert geocode("Nowhere", "France", "Lyon") == (45.7491, 4.8479)
+    assert geocode("Nowhere", "France") is None
+    assert geocode("Paris", "Atlantis") is None
+    assert geocode_place("Lyon, France", "Albania") == (45.7491, 4.8479)
+    assert geocode_place("Tirana", "Albania") == (41.3274, 19.8187)
+
+
+def test_geocode_alternate_names():
+    """
+    Test that cities are found by their local and short names, and without letters
+    that have no accents to strip.
+    """
+    assert geocode("Praha", "Czechia") == geocode("Prague", "Czechia")
+    assert geocode("München", "Germany") == geocode("Munich", "Germany")
+    assert geocode("Muenchen", "DE") == geocode("Munich", "DE")
+    assert geocode("New York", "United States") == geocode("New York City", "US")
+    assert geocode("Lodz", "Poland") == geocode("Łódź", "Poland") is not None
+    # The name of a city takes precedence over an alternate name of another one
+    assert geocode("Rome", "US") != geocode("Rome", "Italy")
+
+
+def test_geocode_posts_logs_unknown(app):
+    """
+    Test that the posts whose address is not found are reported and not written.
+    """
+    posts = [
+        MagicMock(to_dict=MagicMock(return_value=post))
+        for post in [
+            {"id": 1, "city": "Praha", "country": "Czechia"},
+            {"id": 2, "city": "Nowhere", "country": "France", "geohash": None},
+            {"id": 3, "city": "Paris", "country": "France", "geohash": "u09tv"},
+        ]
+    ]
+    with app.app_context(), patch("firebase_admin.firestore.client") as client, patch(
+        "utils.geo.logger"
+    ) as logger:
+        client.return_value.collection.return_value.stream.return_value = posts
+        assert geocode_posts() == (1, [2])
+        batch = client.return_value.batch.return_value
+        batch.update.assert_called_once()
+        assert batch.update.call_args.args[1]["lat"] == geocode("Prague", "CZ")[0]
+        logger.warning.assert_called_once()
+
+
+def test_location_data():
+    """
+    Test the location fields written with an address.
+    """
+    data = location_data("Paris", "France")
+    assert data["geohash"] == encode_geohash(48.8534, 2.3488)
+    assert location_data("Nowhere", "France") == {
+        "lat": None,
+        "lng": None,
+        "geohash": None,
+    }
+
+
+def test_covering_cells():
+    """
+    Test that the cells cover both sides of the antimeridian and stay bounded.
+    """
+    cells = covering_cells(*radius_box(0, 179.9, 50))
+    assert any(cell.startswith("r") or cell.startswith("x") for cell in cells)
+    assert any(cell.startswith("2") or cell.startswith("8") for cell in cells)
+    assert len(covering_cells(-90, -180, 90, 180)) == 32
+
+
+def test_geo_index():
+    """
+    Test radius and bounding box queries, also across the antimeridian.
+    """
+    index = GeoIndex(
+        [(48.8534, 2.3488), (45.7491, 4.8479), None, (-17.7, 179.9), (-17.7, -179.9)]
+    )
+    assert list(np.flatnonzero(index.radius(48.85, 2.35, 10))) == [0]
+    assert list(np.flatnonzero(index.radius(48.85, 2.35, 400))) == [0, 1]
+    assert list(np.flatnonzero(index.radius(-17.7, 180, 30))) == [3, 4]
+    assert list(np.flatnonzero(index.box(45, 2, 49, 5))) == [0, 1]
+    assert list(np.flatnonzero(index.box(-20, 179, -15, -179))) == [3, 4]
+
+
+def test_near_filter():
+    """
+    Test the radius filter for documents outside of the index.
+    """
+    is_near = near_filter((48.85, 2.35, 10))
+    assert is_near({"lat": 48.8534, "lng": 2.3488})
+    assert not is_near({"lat": 45.7491, "lng": 4.8479})
+    assert not is_near({"lat": None, "lng": None})
+    assert near_filter(None) is None
+
+
+def test_posts_in_box():
+    """
+    Test that the posts of a box are read with a geohash range per covering cell.
+    """
+    inside = {"id": 1, "lat": 48.8534, "lng": 2.3488}
+    outside = {"id": 2, "lat": 48.8534, "lng": 3.5}
+    box = (48.5, 2.0, 49.0, 3.0)
+    with patch("firebase_admin.firestore.client") as client:
+        posts = client.return_value.collection.return_value
+        query = posts.where.return_value.where.return_value.select.return_value
+        query.stream.return_value = [
+            MagicMock(to_dict=MagicMock(return_value=inside)),
+            MagicMock(to_dict=MagicMock(return_value=outside)),
+        ]
+        cells = covering_cells(*box)
+        docs = posts_in_box(*box, fields=["id", "lat", "lng"])
+    assert docs == [inside] * len(cells)
+    prefix = posts.where.call_args_list[0].args
+    assert prefix == ("geohash", ">=", cells[0])
+    assert posts.where.return_value.where.call_args_list[0].args == (
+        "geohash",
+        "<",
+        f"{cells[0]}~",
+    )
@@ -0,0 +1,85 @@
+""" Tests for the Bing AI travel tips client. """
+import asyncio
+from unittest.mock import patch
+
+from utils.gpt import (
+    SydneyPool,
+    get_travel_tips,
+    main,
+    parse_response,
+    parse_tip,
+    stream_tips,
+)
+
+
+class FakeSydney:
+    """A stand-in for SydneyClient that answers with a fixed list."""
+
+    started = 0
+
+    async def start_conversation(self):
+        FakeSydney.started += 1
+
+    async def reset_conversation(self):
+        pass
+
+    async def close_conversation(self):
+        pass
+
+    async def ask(self, prompt, citations=False):
+        await asyncio.sleep(0)
+        return "Sure!\n1. Louvre\n2. Eiffel Tower"
+
+    async def ask_stream(self, prompt, citations=False):
+        for token in ["Sure!\n1. Lou", "vre[^1^]\n2. Eiffel", " Tower"]:
+            await asyncio.sleep(0)
+            yield token
+
+
+def test_parse_response():
+    """
+    Test extracting the numbered list from an answer.
+    """
+    assert parse_response("Here:\n1. Louvre\n2. Orsay") == ["1. Louvre", "2. Orsay"]
+
+
+def test_pool_reuses_conversations():
+    """
+    Test that the pool keeps its conversations warm between requests.
+    """
+    FakeSydney.started = 0
+    with patch("utils.gpt.SydneyClient", FakeSydney):
+        pool = SydneyPool(size=1)
+        for _ in range(3):
+            assert pool.submit(main, "Paris, France") == ["1. Louvre", "2. Eiffel Tower"]
+        assert FakeSydney.started == 1
+
+
+def test_get_travel_tips_timeout():
+    """
+    Test that a slow answer is given up after the timeout.
+    """
+
+    async def slow(sydney, text):
+        await asyncio.sleep(1)
+
+    with patch("utils.gpt.SydneyClient", FakeSydney), patch("utils.gpt.main", slow):
+        assert get_travel_tips("Paris, France", timeout=0.05) == []
+
+
+def test_parse_tip():
+    """
+    Test parsing single lines of a streamed answer.
+    """
+    assert parse_tip("1. Louvre[^1^] ") == "1. Louvre"
+    assert parse_tip("Sure!") is None
+
+
+def test_pool_streams_tips():
+    """
+    Test that tips are yielded line by line while the answer is streamed.
+    """
+    with patch("utils.gpt.SydneyClient", FakeSydney):
+        pool = SydneyPool(size=1)
+        tips = list(pool.stream(stream_tips, "Paris, France"))
+        assert tips == ["1. Louvre", "2. Eiffel Tower"]
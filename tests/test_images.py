@@ -0,0 +1,114 @@
+"""Tests for the responsive variants of the images."""
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from flask import render_template_string
+from PIL import Image
+
+from utils.images import (
+    image_variants,
+    make_variants,
+    process_image,
+    srcset,
+    variant_name,
+)
+
+
+def image_bytes(mode="RGB", size=(2000, 1000)):
+    """
+    Encode a generated image as PNG.
+
+    @param mode - The mode of the image
+    @param size - The width and height of the image
+    @return The bytes of the image
+    """
+    output = BytesIO()
+    Image.new(mode, size).save(output, "PNG")
+    return output.getvalue()
+
+
+def test_make_variants():
+    """
+    Test that an image is resized to every width in every format, with a placeholder.
+    """
+    meta, files = make_variants(image_bytes())
+    assert meta["width"] == 2000 and meta["height"] == 1000
+    assert meta["widths"] == [320, 640, 1024, 1600]
+    assert meta["formats"] == ["avif", "webp"]
+    assert meta["placeholder"].startswith("data:image/webp;base64,")
+    assert len(files) == 8
+    with Image.open(BytesIO(files[(640, "webp")])) as variant:
+        assert variant.format == "WEBP" and variant.size == (640, 320)
+    with Image.open(BytesIO(files[(320, "avif")])) as variant:
+        assert variant.format == "AVIF"
+
+
+def test_make_variants_small_image():
+    """
+    Test that small images are not enlarged and transparency is kept.
+    """
+    meta, files = make_variants(image_bytes("RGBA", (500, 500)))
+    assert meta["widths"] == [320, 500]
+    with Image.open(BytesIO(files[(500, "webp")])) as variant:
+        assert variant.mode == "RGBA"
+
+
+def test_process_image_pool():
+    """
+    Test that images are resized in the process pool and invalid images are rejected.
+    """
+    with patch("utils.images.IMAGE_WORKERS", 1):
+        meta, _ = process_image(image_bytes(size=(400, 300)))
+        assert meta["widths"] == [320, 400]
+        with pytest.raises(ValueError, match="not a valid image"):
+            process_image(b"not an image")
+
+
+def test_srcset():
+    """
+    Test that the srcset lists the variants next to the original.
+    """
+    post = {
+        "image_variants": [
+            {"url": "https://storage/static/uploads/a.jpg", "widths": [320, 640]}
+        ]
+    }
+    image = image_variants(post, "https://storage/static/uploads/a.jpg")
+    assert srcset(image, "avif") == (
+        "https://storage/static/uploads/a-320w.avif 320w, "
+        "https://storage/static/uploads/a-640w.avif 640w"
+    )
+    assert image_variants(post, "b.jpg") == {"url": "b.jpg"}
+    assert image_variants({}, "b.jpg") == {"url": "b.jpg"}
+    assert variant_name("room", 320, "webp") == "room-320w.webp"
+
+
+def test_picture_markup(app):
+    """
+    Test that images with variants get sources and a placeholder, and all images are lazy loaded.
+    """
+    template = (
+        '{% from "picture.html" import picture %}'
+        '{{ picture(image_variants(post, url), "100vw", class="card-img") }}'
+    )
+    url = "https://storage/static/uploads/a.jpg"
+    meta = {
+        "url": url,
+        "width": 800,
+        "height": 600,
+        "widths": [320, 640],
+        "formats": ["avif", "webp"],
+        "placeholder": "data:image/webp;base64,AAAA",
+    }
+    with app.test_request_context():
+        html = render_template_string(
+            template, post={"image_variants": [meta]}, url=url
+        )
+        plain = render_template_string(template, post={}, url=url)
+    assert '<source type="image/avif"' in html
+    assert "https://storage/static/uploads/a-640w.webp 640w" in html
+    assert 'sizes="100vw"' in html and 'width="800"' in html
+    assert "data:image/webp;base64,AAAA" in html
+    assert "<source" not in plain
+    assert 'loading="lazy"' in plain and f'src="{url}"' in plain
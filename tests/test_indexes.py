@@ -0,0 +1,38 @@
+""" Tests for the Firestore index definitions. """
+import json
+
+from utils.indexes import firestore_indexes
+
+
+def test_shipped_indexes_are_current():
+    """
+    Test that firestore.indexes.json matches the generated index definitions.
+    """
+    with open("firestore.indexes.json", encoding="utf-8") as file:
+        assert json.load(file) == firestore_indexes()
+
+
+def test_search_index_fields():
+    """
+    Test that the search query has an index on its filter and order fields.
+    """
+    fields = [
+        [field["fieldPath"] for field in index["fields"]]
+        for index in firestore_indexes()["indexes"]
+    ]
+    assert ["country", "maxGuests", "price", "id"] in fields
+    assert ["user_uid", "id"] in fields
+
+
+def test_reviews_index_is_descending():
+    """
+    Test that the newest reviews query has an index ordered by timestamp descending.
+    """
+    assert {
+        "collectionGroup": "reviews",
+        "queryScope": "COLLECTION",
+        "fields": [
+            {"fieldPath": "reviewed", "order": "ASCENDING"},
+            {"fieldPath": "timestamp", "order": "DESCENDING"},
+        ],
+    } in firestore_indexes()["indexes"]
@@ -1,7 +1,10 @@
 """ Test the various routes in for listings. """
 import unittest
+from datetime import datetime, timezone
 from unittest.mock import patch, MagicMock
 import pytest
+from utils.clusters import ClusterIndex, tile_box
+from utils.firebase import projection_fields
 from utils.time import convert_date
 
 
@@ -31,6 +34,7 @@ class TestMain(unittest.TestCase):
                 "price": 10,
                 "rating": 4,
                 "user_uid": "12358896",
+                "created": convert_date("2022-01-01"),
                 "images": ["https://via.placeholder.com/150"],
                 "description": "This is a test description",
                 "tags": {
@@ -45,6 +49,7 @@ class TestMain(unittest.TestCase):
             },
             {
                 "id": "2",
+                "created": convert_date("2022-01-01"),
                 "city": "Paris",
                 "country": "France",
                 "price": 20,
@@ -60,6 +65,7 @@ class TestMain(unittest.TestCase):
             },
             {
                 "id": "3",
+                "created": convert_date("2022-01-01"),
                 "city": "Brussels",
                 "country": "Belgium",
                 "price": 30,
@@ -106,13 +112,18 @@ class TestMain(unittest.TestCase):
         reviews_mock = [
             MagicMock(to_dict=MagicMock(return_value=post)) for post in mocked_reviews
         ]
-        cls.mock_firestore.collection.return_value.stream.return_value = posts_mock
+        cls.mock_firestore.collection.return_value.order_by.return_value.order_by.return_value.limit.return_value.select.return_value.stream.return_value = (
+            posts_mock
+        )
+        cls.mock_firestore.collection.return_value.where.return_value.order_by.return_value.limit.return_value.select.return_value.stream.return_value = (
+            posts_mock
+        )
+        cls.mock_firestore.collection.return_value.where.return_value.select.return_value.stream.return_value = (
+            posts_mock
+        )
         cls.mock_firestore.collection.return_value.where.return_value.stream.side_effect = [
-            posts_mock,
             rentals_mock,
-            posts_mock,
             reviews_mock,
-            posts_mock,
         ]
         cls.mock_firestore.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {
             "favs": ["1", "2", "3"]
@@ -126,8 +137,11 @@ class TestMain(unittest.TestCase):
     def tearDownClass(cls):
         cls.patcher.stop()
 
-    @patch("utils.firebase.get_avg_rating", return_value=4.5)
-    def test_01_index(self, mock_get_avg_rating):
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_01_index(self, mock_resolve_avg_ratings):
         """
         Make a request to the index route and check that the response is 200.
 
@@ -140,8 +154,11 @@ class TestMain(unittest.TestCase):
         assert b"France" in response.data
         assert b"Brussels" in response.data
 
-    @patch("utils.firebase.get_avg_rating", return_value=4.5)
-    def test_02_my_listings(self, mock_get_avg_rating):
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_02_my_listings(self, mock_resolve_avg_ratings):
         """
         Make a request to the index route and verify that it returns the correct listings.
 
@@ -154,8 +171,11 @@ class TestMain(unittest.TestCase):
         assert b"France" in response.data
         assert b"Paris" in response.data
 
-    @patch("utils.firebase.get_avg_rating", return_value=4.5)
-    def test_03_my_stays(self, mock_get_avg_rating):
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_03_my_stays(self, mock_resolve_avg_ratings):
         """
         Test the my_stays route.
 
@@ -164,14 +184,21 @@ class TestMain(unittest.TestCase):
         """
         response = self.auth_client.get("/stays")
         assert response.status_code == 200
+        # Only the fields of the listing cards are read
+        self.mock_firestore.collection.return_value.where.return_value.select.assert_any_call(
+            projection_fields("card")
+        )
         assert b"Tirana" in response.data
         assert b"France" in response.data
         assert b"Paris" in response.data
         assert b"5" in response.data
         assert b"4" in response.data
 
-    @patch("utils.firebase.get_avg_rating", return_value=4.5)
-    def test_04_favs(self, mock_get_avg_rating):
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_04_favs(self, mock_resolve_avg_ratings):
         """
         Test the favorites route while autheticated.
 
@@ -192,3 +219,100 @@ class TestMain(unittest.TestCase):
             b'class="icon ion-ios-heart"'
             or b'class="icon ion-ios-heart-outline"' not in response.data
         )
+
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_05_listings_page(self, mock_resolve_avg_ratings):
+        """
+        Test loading the next page of a listing feed from a page token.
+        """
+        from utils.pagination import encode_cursor
+
+        order_by = self.mock_firestore.collection.return_value.order_by
+        query = order_by.return_value.order_by.return_value
+        query.start_after.return_value.limit.return_value.select.return_value.stream.return_value = (
+            query.limit.return_value.select.return_value.stream.return_value
+        )
+        created = datetime(2023, 5, 1, 12, 30, tzinfo=timezone.utc)
+        with self.client.application.test_request_context():
+            token = encode_cursor(
+                {
+                    "feed": "index",
+                    "type": "index",
+                    "after": {"created": created, "id": 3},
+                }
+            )
+        response = self.client.get(f"/api/listings?cursor={token}")
+        assert response.status_code == 200
+        assert "Tirana" in response.get_json()["html"]
+        assert response.get_json()["next"] is None
+        # The feed is in creation order, the ids only break ties
+        order_by.assert_called_with("created")
+        query.start_after.assert_called_with({"created": created, "id": 3})
+
+        response = self.client.get("/api/listings?cursor=forged")
+        assert response.status_code == 400
+
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_06_search_ranked(self, mock_resolve_avg_ratings):
+        """
+        Test that search results are ranked by the selected sort order.
+        """
+        candidates = [
+            {"id": 1, "city": "Tirana", "country": "France", "price": 30, "images": []},
+            {"id": 2, "city": "Paris", "country": "France", "price": 10, "images": []},
+        ]
+        facets = {"standout": {"Pool": 2}}
+        with patch("views.main.search_posts", return_value=(iter(candidates), facets)):
+            response = self.client.post(
+                "/search",
+                data={
+                    "from": "",
+                    "to": "",
+                    "from-price": "0",
+                    "to-price": "50",
+                    "country": "France",
+                    "guests": "1",
+                    "sort": "price",
+                },
+            )
+        assert response.status_code == 200
+        html = response.data.decode("utf-8")
+        assert html.index("Paris") < html.index("Tirana")
+        assert "Pool (2)" in html
+
+    def test_07_map_tile(self):
+        """
+        Test that the map endpoint returns the clusters of a tile and rejects invalid tiles.
+        """
+        clusters = ClusterIndex.from_docs(
+            [
+                {"id": 1, "lat": 48.8534, "lng": 2.3488},
+                {"id": 2, "lat": 45.7491, "lng": 4.8479},
+            ]
+        )
+        with patch("views.main.map_clusters", return_value=clusters):
+            response = self.client.get("/api/map?z=0&x=0&y=0")
+        assert response.status_code == 200
+        assert response.json["clusters"][0]["count"] == 2
+        assert self.client.get("/api/map?z=1&x=2&y=0").status_code == 400
+        assert self.client.get("/api/map?z=1").status_code == 400
+
+    def test_08_map_tile_without_index(self):
+        """
+        Test that without the search index a tile only reads the posts in its box.
+        """
+        docs = [{"id": 1, "lat": 48.8534, "lng": 2.3488}]
+        with patch("views.main.map_clusters", return_value=None), patch(
+            "views.main.posts_in_box", return_value=docs
+        ) as posts_in_box:
+            response = self.client.get("/api/map?z=10&x=518&y=352")
+        assert response.json["clusters"] == [
+            {"lat": 48.8534, "lng": 2.3488, "count": 1, "id": 1}
+        ]
+        assert posts_in_box.call_args.args == tile_box(10, 518, 352)
@@ -0,0 +1,103 @@
+""" Tests for the cursor based pagination helpers. """
+from datetime import datetime, timezone
+from unittest.mock import patch, MagicMock
+
+from utils.pagination import decode_cursor, encode_cursor, fetch_page, slice_page
+
+
+def mock_posts(ids):
+    """
+    Wrap post ids in mocked Firestore snapshots.
+
+    @param ids - A list of post ids
+    @return A list of mocked documents
+    """
+    return [
+        MagicMock(to_dict=MagicMock(return_value={"id": i, "price": i * 10}))
+        for i in ids
+    ]
+
+
+def test_fetch_page_cursor():
+    """
+    Test that a full page returns the cursor of its last document.
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        query = firestore.return_value.collection.return_value.order_by.return_value
+        query.limit.return_value.stream.return_value = mock_posts([1, 2])
+        docs, after = fetch_page("posts", [], ["id"], page_size=2)
+        assert [doc["id"] for doc in docs] == [1, 2]
+        assert after == {"id": 2}
+        query.limit.assert_called_with(2)
+
+
+def test_cursor_datetimes(app):
+    """
+    Test that page tokens keep the datetimes of a cursor, e.g. the creation time of a post.
+    """
+    created = datetime(2023, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    state = {"feed": "index", "after": {"created": created, "id": 3}}
+    with app.test_request_context():
+        assert decode_cursor(encode_cursor(state)) == state
+
+
+def test_fetch_page_predicate():
+    """
+    Test that filtered pages read further batches until they are full.
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        query = firestore.return_value.collection.return_value.order_by.return_value
+        query.limit.return_value.stream.return_value = mock_posts([1, 2])
+        query.start_after.return_value.limit.return_value.stream.return_value = (
+            mock_posts([3])
+        )
+        docs, after = fetch_page(
+            "posts",
+            [],
+            ["id"],
+            page_size=2,
+            predicate=lambda doc: doc["price"] != 20,
+        )
+        assert [doc["id"] for doc in docs] == [1, 3]
+        assert after == {"id": 3}
+        query.start_after.assert_called_with({"id": 2})
+
+
+def test_slice_page():
+    """
+    Test paging through a known list of ids.
+    """
+    assert slice_page(["3", "1", "2"], page_size=2) == ([1, 2], 2)
+    assert slice_page(["3", "1", "2"], after=2, page_size=2) == ([3], None)
+
+
+def test_fetch_page_projection():
+    """
+    Test that a projected page always fetches the fields of its cursor.
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        query = firestore.return_value.collection.return_value.order_by.return_value
+        query.limit.return_value.select.return_value.stream.return_value = (
+            mock_posts([1])
+        )
+        docs, after = fetch_page(
+            "posts", [], ["id"], fields=["price"], page_size=2
+        )
+        query.limit.return_value.select.assert_called_with(["price", "id"])
+        assert after is None
+
+
+def test_fetch_page_string_filter():
+    """
+    Test that the filters of string fields keep their values, e.g. the uid of the user feed.
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        posts = firestore.return_value.collection.return_value
+        query = posts.where.return_value.order_by.return_value
+        query.limit.return_value.stream.return_value = mock_posts([1])
+        docs, after = fetch_page(
+            "posts", [("user_uid", "==", "Xy7uid")], ["id"], page_size=2
+        )
+        posts.where.assert_called_once_with("user_uid", "==", "Xy7uid")
+        assert [doc["id"] for doc in docs] == [1]
+        assert after is None
@@ -33,7 +33,7 @@ class TestPost(unittest.TestCase):
                 },
                 {
                     "rating": 4,
-                    "reviewed": "2",
+                    "reviewed": "1",
                     "reviewer": "1234",
                     "timestamp": datetime.now(),
                 },
@@ -71,6 +71,10 @@ class TestPost(unittest.TestCase):
             mocked_post,
         ]
 
+        cls.mock_firestore.collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = (
+            ratings_data
+        )
+
         cls.mock_firestore.collection.return_value.document.return_value = mocked_post[
             0
         ]
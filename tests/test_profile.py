@@ -80,11 +80,15 @@ class TestProfile(unittest.TestCase):
         reviews_mock = [
             MagicMock(to_dict=MagicMock(return_value=post)) for post in mocked_reviews
         ]
-        cls.mock_firestore.collection.return_value.where.return_value.stream.side_effect = [
-            posts_mock,
-            posts_mock,
-            reviews_mock,
-        ]
+        cls.mock_firestore.collection.return_value.where.return_value.select.return_value.stream.return_value = (
+            posts_mock
+        )
+        cls.mock_firestore.collection.return_value.where.return_value.stream.return_value = (
+            reviews_mock
+        )
+        cls.mock_firestore.collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = (
+            reviews_mock
+        )
         cls.patcher = patch(
             "firebase_admin.firestore.client", return_value=cls.mock_firestore
         )
@@ -120,8 +124,11 @@ class TestProfile(unittest.TestCase):
             # Assert that the mock function was called with the expected data
             mock_set_claims.assert_called_once_with(self.uid, expected_data)
 
-    @patch("utils.firebase.get_avg_rating", return_value=4.5)
-    def test_view_user(self, mock_get_avg_rating):
+    @patch(
+        "utils.firebase.resolve_avg_ratings",
+        side_effect=lambda ids: {int(i): 4.5 for i in ids},
+    )
+    def test_view_user(self, mock_resolve_avg_ratings):
         """
         Test the view_user method. This is a test for the rating_view. py script.
 
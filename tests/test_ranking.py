@@ -0,0 +1,79 @@
+""" Tests for the ranking of search results. """
+from datetime import datetime, timedelta, timezone
+
+from utils.ranking import popularity, rank_page, sort_order
+
+
+def post(id, price=100, rating_sum=0, rating_count=0, created=None):
+    """
+    Build a ranked post.
+    """
+    doc = {"id": id, "price": price, "rating_sum": rating_sum, "rating_count": rating_count}
+    if created is not None:
+        doc["created"] = created
+    return doc
+
+
+def ids(docs):
+    return [doc["id"] for doc in docs]
+
+
+def test_rank_by_price_pages():
+    """
+    Test that pages continue after the rank key of the previous page.
+    """
+    docs = [post(1, 300), post(2, 100), post(3, 200), post(4, 100)]
+    page, after = rank_page(iter(docs), "price", None, 3)
+    assert ids(page) == [2, 4, 3]
+    assert after["key"] == [200.0, 3]
+    page, after = rank_page(iter(docs), "price", after, 3)
+    assert ids(page) == [1]
+    assert after is None
+
+
+def test_rank_by_rating():
+    """
+    Test that the best rated posts come first and posts without ratings last.
+    """
+    docs = [post(1), post(2, rating_sum=8, rating_count=2), post(3, rating_sum=5, rating_count=1)]
+    page, _ = rank_page(docs, "rating", None, 10)
+    assert ids(page) == [3, 2, 1]
+
+
+def test_popularity():
+    """
+    Test that popularity grows with the number of ratings and decays with age.
+    """
+    now = datetime.now(timezone.utc)
+    assert popularity(post(1, rating_sum=40, rating_count=10), now.timestamp()) > popularity(
+        post(2, rating_sum=5, rating_count=1), now.timestamp()
+    )
+    new = post(3, created=now)
+    old = post(4, created=now - timedelta(days=365))
+    assert popularity(new, now.timestamp()) > popularity(old, now.timestamp())
+
+
+def test_rank_newest_and_unknown_sort():
+    """
+    Test the newest order and that unknown sort orders fall back to the default.
+    """
+    now = datetime.now(timezone.utc)
+    docs = [post(1, created=now - timedelta(days=2)), post(2, created=now), post(3)]
+    page, _ = rank_page(docs, "newest", None, 10)
+    assert ids(page) == [2, 1, 3]
+    assert sort_order("drop table") == "price"
+    assert sort_order("relevance") == "price"
+    assert sort_order("relevance", "pool") == "relevance"
+
+
+def test_rank_by_relevance():
+    """
+    Test that keyword results come in descending order of relevance.
+    """
+    docs = [
+        {**post(1, price=50), "relevance": 0.5},
+        {**post(2, price=300), "relevance": 2.5},
+        {**post(3, price=100), "relevance": 1.0},
+    ]
+    page, _ = rank_page(docs, "relevance", None, 10)
+    assert ids(page) == [2, 3, 1]
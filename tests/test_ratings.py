@@ -0,0 +1,107 @@
+""" Tests for the denormalized rating aggregates. """
+from unittest.mock import patch, MagicMock
+
+from firebase_admin import firestore
+
+from utils.ratings import (
+    _commit_review,
+    average_rating,
+    backfill_ratings,
+    rating_aggregate,
+    rating_changes,
+)
+
+
+def test_rating_aggregate():
+    """
+    Test computing the aggregate of a post from the ratings of its reviews.
+    """
+    aggregate = rating_aggregate([5, 4, "4"])
+    assert aggregate["rating_sum"] == 13
+    assert aggregate["rating_count"] == 3
+    assert aggregate["rating_hist"] == {"1": 0, "2": 0, "3": 0, "4": 2, "5": 1}
+    assert average_rating(rating_aggregate([])) is None
+
+
+def test_rating_changes():
+    """
+    Test the increments for adding, editing and deleting a review.
+    """
+    added = rating_changes(None, 4)
+    assert isinstance(added["rating_sum"], firestore.Increment)
+    assert added["rating_sum"].value == 4
+    assert added["rating_count"].value == 1
+    assert added["rating_hist.4"].value == 1
+
+    edited = rating_changes(4, 2)
+    assert edited["rating_sum"].value == -2
+    assert "rating_count" not in edited
+    assert edited["rating_hist.4"].value == -1
+    assert edited["rating_hist.2"].value == 1
+
+    deleted = rating_changes(4, None)
+    assert deleted["rating_count"].value == -1
+    assert rating_changes(3, 3) == {}
+
+
+def test_backfill_ratings():
+    """
+    Test that the backfill writes the recomputed aggregates in batches.
+    """
+    reviews = [
+        MagicMock(to_dict=MagicMock(return_value={"reviewed": 1, "rating": 5})),
+        MagicMock(to_dict=MagicMock(return_value={"reviewed": 1, "rating": 3})),
+    ]
+    posts = [
+        MagicMock(to_dict=MagicMock(return_value={"id": i})) for i in range(1, 4)
+    ]
+    with patch("firebase_admin.firestore.client") as client, patch(
+        "utils.firebase.BATCH_LIMIT", 2
+    ):
+        client.return_value.collection.return_value.stream.side_effect = [
+            reviews,
+            posts,
+        ]
+        batch = client.return_value.batch.return_value
+        assert backfill_ratings() == 3
+        assert batch.commit.call_count == 2
+        first = batch.update.call_args_list[0].args[1]
+        assert first["rating_sum"] == 8
+        assert first["rating_count"] == 2
+
+
+def test_commit_review_seeds_aggregate():
+    """
+    Test that a review of a post without an aggregate seeds it from all of the
+    post's reviews, and that a post with one is only incremented.
+    """
+    review_ref = MagicMock(id="3|user")
+    review_ref.get.return_value = MagicMock(exists=False)
+    post = MagicMock(to_dict=MagicMock(return_value={"id": 1, "country": "Czechia"}))
+    reviews = [
+        MagicMock(id="1|other", to_dict=MagicMock(return_value={"rating": 4})),
+        MagicMock(id="2|other", to_dict=MagicMock(return_value={"rating": 2})),
+    ]
+    transaction = MagicMock()
+    transaction.get.side_effect = [[post], reviews]
+    written = []
+    with patch("firebase_admin.firestore.client"):
+        _commit_review.to_wrap(
+            transaction, review_ref, {"reviewed": 1, "rating": 5}, written
+        )
+    transaction.set.assert_called_once_with(review_ref, {"reviewed": 1, "rating": 5})
+    transaction.update.assert_called_once_with(
+        post.reference, rating_aggregate([4, 2, 5])
+    )
+    assert [doc["country"] for doc in written] == ["Czechia"]
+
+    post.to_dict.return_value = {"id": 1, **rating_aggregate([4, 2])}
+    transaction = MagicMock()
+    transaction.get.side_effect = [[post]]
+    with patch("firebase_admin.firestore.client"):
+        _commit_review.to_wrap(
+            transaction, review_ref, {"reviewed": 1, "rating": 5}, []
+        )
+    changes = transaction.update.call_args.args[1]
+    assert changes["rating_count"].value == 1
+    assert changes["rating_sum"].value == 5
@@ -58,8 +58,10 @@ class TestReviews(unittest.TestCase):
             [MagicMock(to_dict=MagicMock(return_value=post)) for post in mocked_review],
         ]
         cls.mock_firestore.collection.return_value.document.return_value.get.side_effect = [
-            Mock(to_dict=Mock(return_value=mocked_review[0])),
-            Mock(to_dict=Mock(return_value=None)),
+            Mock(exists=False, to_dict=Mock(return_value=None)),
+            Mock(exists=True, to_dict=Mock(return_value=mocked_review[0])),
+            Mock(exists=True, to_dict=Mock(return_value=mocked_review[0])),
+            Mock(exists=False, to_dict=Mock(return_value=None)),
         ]
         cls.patcher = patch(
             "firebase_admin.firestore.client", return_value=cls.mock_firestore
@@ -70,7 +72,8 @@ class TestReviews(unittest.TestCase):
     def tearDownClass(cls):
         cls.patcher.stop()
 
-    def test_01_add_review_success(self):
+    @patch("views.reviews.next_id", return_value=4)
+    def test_01_add_review_success(self, mock_next_id):
         """
         Test adding a review with valid data.
 
@@ -0,0 +1,109 @@
+"""Tests for the search parameters and the search result cache."""
+from unittest.mock import MagicMock, call, patch
+
+from utils.search import search_cache_key
+from views.main import find_search_page, load_search_page
+
+
+def params(**kwargs):
+    """
+    Build the fields of a search form, overridden by kwargs.
+    """
+    form = {
+        "from": "2024-03-01",
+        "to": "2024-03-05",
+        "from-price": "0",
+        "to-price": "500",
+        "country": "France",
+        "guests": "2",
+        "q": "",
+        "amenities": [],
+        "match": "all",
+        "sort": "price",
+        "near": "",
+        "radius": "",
+    }
+    form.update(kwargs)
+    return form
+
+
+def test_search_cache_key_canonical():
+    """
+    Test that searches that only differ in how they were typed share a key.
+    """
+    key = search_cache_key(
+        params(q="Pool  wifi", amenities=["b", "a"]), None, bookings=True
+    )
+    assert key == search_cache_key(
+        params(q="wifi pool", amenities=["a", "b", "a"], country="France "),
+        None,
+        bookings=True,
+    )
+    # Without amenities the match mode does not matter
+    assert search_cache_key(params(match="any"), None, True) == search_cache_key(
+        params(), None, True
+    )
+    assert key != search_cache_key(params(q="wifi pool"), None, bookings=False)
+    assert search_cache_key(params(), None, True) != search_cache_key(
+        params(guests="3"), None, True
+    )
+    assert search_cache_key(params(), None, True) != search_cache_key(
+        params(), {"key": [10.0, 1], "now": 0}, True
+    )
+
+
+def test_search_page_cached(cache_app):
+    """
+    Test that an identical search is answered from the cached post ids.
+    """
+    page = ([{"id": 2, "price": 10}, {"id": 1, "price": 30}], None, None)
+    cards = [{"id": 2, "city": "Paris"}, {"id": 1, "city": "Lyon"}]
+    with patch("views.main.find_search_page", return_value=page) as find, patch(
+        "views.main.load_posts", return_value=cards
+    ) as load_posts:
+        assert load_search_page(params(), None) == (cards, None, None)
+        assert load_search_page(params(**{"to-price": "0500"}), None) == (
+            cards,
+            None,
+            None,
+        )
+    assert find.call_count == 1
+    load_posts.assert_called_with([2, 1])
+
+
+def test_search_fallback_firestore(app):
+    """
+    Test that searches are read from Firestore while the index is loading, with
+    the country compared as a string and the numeric fields as numbers.
+    """
+    doc = MagicMock(
+        to_dict=MagicMock(
+            return_value={"id": 1, "price": 100, "maxGuests": 2, "from": None}
+        )
+    )
+    with app.app_context(), patch(
+        "views.main.search_posts", return_value=None
+    ), patch("firebase_admin.firestore.client") as client:
+        posts = client.return_value.collection.return_value
+        assert find_search_page(params(), None, None) == ([], None, None)
+    assert posts.where.call_args == call("country", "==", "France")
+    where = posts.where.return_value.where
+    assert where.call_args == call("maxGuests", ">=", 2)
+    assert where.return_value.where.call_args == call("price", ">=", 0)
+
+
+def test_search_page_not_cached_while_loading(cache_app):
+    """
+    Test that the results of a search are not cached while the index is loading.
+    """
+    from flask import current_app
+
+    page = ([], None, None)
+    current_app.config["SEARCH_INDEX"] = True
+    with patch("views.main.find_search_page", return_value=page) as find, patch(
+        "views.main.load_posts", return_value=[]
+    ), patch("views.main.index", MagicMock(ready=False)):
+        assert load_search_page(params(q="pool"), None) == page
+        assert load_search_page(params(q="pool"), None) == page
+    assert find.call_count == 2
+    cache_app.set.assert_not_called()
@@ -0,0 +1,224 @@
+"""Tests for the in-memory search index."""
+from datetime import date
+from unittest.mock import MagicMock, patch
+
+from utils.ranking import rank_page, sort_order
+from utils.search_index import SearchIndex, search_posts
+from utils.time import convert_date
+
+
+def change(kind, doc_id, data=None):
+    """
+    Mock a document change of a snapshot.
+
+    @param kind - The name of the change type
+    @param doc_id - The id of the document
+    @param data - The document data
+    @return The mocked change
+    """
+    document = MagicMock(id=doc_id, to_dict=MagicMock(return_value=data))
+    result = MagicMock(document=document)
+    result.type.name = kind
+    return result
+
+
+def post(id, country="France", guests=2, price=100):
+    """
+    Build a searchable post.
+    """
+    return {
+        "id": id,
+        "country": country,
+        "maxGuests": guests,
+        "price": price,
+        "from": convert_date("2024-01-01"),
+        "to": convert_date("2024-12-31"),
+        "city": "Paris",
+        "images": [],
+    }
+
+
+def build_index(*posts):
+    """
+    Build an index from a snapshot that adds the given posts.
+    """
+    index = SearchIndex()
+    index._on_snapshot(
+        None, [change("ADDED", f"{p['id']}|uid", p) for p in posts], None
+    )
+    return index
+
+
+def search(index, **kwargs):
+    """
+    Search the index with default parameters, overridden by kwargs.
+
+    @return The ids of the matching posts
+    """
+    params = {
+        "country": "France",
+        "guests": 1,
+        "vfrom": date(2024, 3, 1),
+        "to": date(2024, 3, 5),
+        "from_price": "0",
+        "to_price": "500",
+    }
+    params.update(kwargs)
+    docs, _ = index.matches(**params)
+    return sorted(doc["id"] for doc in docs)
+
+
+def test_search_filters():
+    """
+    Test that the masks apply every search criteria.
+    """
+    index = build_index(
+        post(1),
+        post(2, country="Albania"),
+        post(3, guests=1),
+        post(4, price=900),
+        post(5, guests=4),
+    )
+    assert search(index, guests=2) == [1, 5]
+    assert search(index, vfrom=date(2023, 12, 1), guests=2) == []
+    assert search(index, country="Spain") == []
+
+
+def test_incomplete_posts_logged():
+    """
+    Test that posts without the fields of the searches are left out and logged.
+    """
+    incomplete = {**post(2), "guests": "2"}
+    del incomplete["maxGuests"]
+    with patch("utils.search_index.logger") as logger:
+        index = build_index(post(1), incomplete)
+    assert search(index) == [1]
+    logger.warning.assert_called_once()
+    assert logger.warning.call_args.args[1:] == ("2|uid", "maxGuests")
+
+
+def test_created_from_document():
+    """
+    Test that posts without a creation time are ranked by the creation time of their document.
+    """
+    index = SearchIndex()
+    older = change("ADDED", "1|uid", post(1))
+    older.document.create_time = convert_date("2022-01-01")
+    newer = change("ADDED", "2|uid", {**post(2), "created": convert_date("2023-01-01")})
+    index._on_snapshot(None, [older, newer], None)
+    docs, _ = index.matches(
+        country="France",
+        guests=1,
+        vfrom=date(2024, 3, 1),
+        to=date(2024, 3, 5),
+        from_price="0",
+        to_price="500",
+    )
+    page, _ = rank_page(docs, "newest", None, 10)
+    assert [doc["id"] for doc in page] == [2, 1]
+    assert page[1]["created"] == convert_date("2022-01-01")
+
+
+def test_search_bookings():
+    """
+    Test that booked properties are skipped.
+    """
+    index = build_index(post(1), post(2))
+    assert search(index, available=lambda pid: pid != 1) == [2]
+
+
+def test_search_keywords():
+    """
+    Test that keyword searches only match posts with the keywords and carry their relevance.
+    """
+    index = build_index(post(1), {**post(2), "description": "Loft with a pool"})
+    docs, _ = index.matches(
+        "France", 1, date(2024, 3, 1), date(2024, 3, 5), "0", "500", keywords="pool"
+    )
+    docs = list(docs)
+    assert [doc["id"] for doc in docs] == [2]
+    assert docs[0]["relevance"] > 0
+    assert search(index, keywords="gym") == []
+
+
+def test_search_keywords_best_match():
+    """
+    Test that the best match order of a keyword search ranks by descending relevance, not price.
+    """
+    index = build_index(
+        {**post(1, price=50), "description": "Flat near a pool"},
+        {**post(2, price=400), "description": "Pool, pool and an indoor pool"},
+    )
+    docs, _ = index.matches(
+        "France", 1, date(2024, 3, 1), date(2024, 3, 5), "0", "500", keywords="pool"
+    )
+    page, _ = rank_page(docs, sort_order("relevance", "pool"), None, 10)
+    assert [doc["id"] for doc in page] == [2, 1]
+    assert page[0]["relevance"] > page[1]["relevance"]
+
+
+def test_search_amenities():
+    """
+    Test that amenity filters combine the tag bitsets and the results are counted per tag.
+    """
+    index = build_index(
+        {**post(1), "tags": {"basics": ["Wifi", "Kitchen"], "standout": ["Pool"]}},
+        {**post(2), "tags": {"basics": '["Wifi"]'}},
+        {**post(3), "tags": {"standout": ["Pool"]}},
+    )
+    assert search(index, amenities=["basics:Wifi", "standout:Pool"]) == [1]
+    assert search(
+        index, amenities=["basics:Wifi", "standout:Pool"], match_all=False
+    ) == [
+        1,
+        2,
+        3,
+    ]
+    assert search(index, amenities=["views:Ocean view"]) == []
+    _, counts = index.matches(
+        "France",
+        1,
+        date(2024, 3, 1),
+        date(2024, 3, 5),
+        "0",
+        "500",
+        amenities=["basics:Wifi"],
+    )
+    assert counts == {"basics": {"Kitchen": 1, "Wifi": 2}, "standout": {"Pool": 1}}
+
+
+def test_search_near():
+    """
+    Test that radius searches only find the geocoded posts within the distance.
+    """
+    index = build_index(
+        {**post(1), "lat": 48.8534, "lng": 2.3488},
+        {**post(2), "lat": 48.8014, "lng": 2.1301},
+        {**post(3), "lat": 45.7491, "lng": 4.8479},
+        post(4),
+    )
+    assert search(index, near=(48.85, 2.35, 5)) == [1]
+    assert search(index, near=(48.85, 2.35, 25)) == [1, 2]
+    assert search(index, near=(48.85, 2.35, 500)) == [1, 2, 3]
+
+
+def test_snapshot_changes():
+    """
+    Test that modified and removed documents update the index.
+    """
+    index = build_index(post(1), post(2))
+    index._on_snapshot(
+        None,
+        [change("MODIFIED", "1|uid", post(1, price=900)), change("REMOVED", "2|uid")],
+        None,
+    )
+    assert search(index) == []
+
+
+def test_search_posts_disabled(app):
+    """
+    Test that searches fall back to Firestore when the index is disabled.
+    """
+    with app.app_context(), patch("utils.search_index.index") as index:
+        assert search_posts("France", 1, None, None, "0", "1") is None
+        index.start.assert_not_called()
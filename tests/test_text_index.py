@@ -0,0 +1,76 @@
+"""Tests for the inverted index of keyword searches."""
+from unittest.mock import patch
+
+from utils.text_index import TextIndex, post_tokens, tokenize
+
+
+def test_tokenize():
+    """
+    Test that tokens are lowercase and without accents.
+    """
+    assert tokenize("Café near the Seine!") == ["cafe", "near", "the", "seine"]
+
+
+def test_post_tokens_tags():
+    """
+    Test that tag lists are indexed, also when they are stored as JSON strings.
+    """
+    tokens = post_tokens(
+        {
+            "city": "Paris",
+            "district": "None",
+            "tags": {"basics": '["Wifi", "Kitchen"]', "views": ["Ocean view"]},
+        }
+    )
+    assert sorted(tokens) == ["kitchen", "ocean", "paris", "view", "wifi"]
+
+
+def test_search_prefix_and_all_tokens():
+    """
+    Test that query tokens match as prefixes and every token must match.
+    """
+    index = TextIndex()
+    index.update("1", {"city": "Paris", "description": "Quiet flat with a pool"})
+    index.update(
+        "2", {"city": "Tirana", "description": "Flat near the pool and the pool bar"}
+    )
+    assert set(index.search("poo")) == {"1", "2"}
+    assert set(index.search("flat par")) == {"1"}
+    assert index.search("pool gym") == {}
+    scores = index.search("pool")
+    assert scores["2"] > scores["1"]
+
+
+def test_expansions_keep_frequent_terms():
+    """
+    Test that a query token with too many expansions keeps the token itself and
+    the most frequent terms instead of the first ones in alphabetical order.
+    """
+    index = TextIndex()
+    index.update("1", {"description": "paella palace"})
+    index.update("2", {"description": "paris pa"})
+    index.update("3", {"description": "paris"})
+    index.update("4", {"description": "paris"})
+    with patch("utils.text_index.MAX_EXPANSIONS", 2), patch(
+        "utils.text_index.logger"
+    ) as logger:
+        assert sorted(index._expand("pa")) == ["pa", "paris"]
+        assert set(index.search("pa")) == {"2", "3", "4"}
+        logger.info.assert_called()
+        logger.info.reset_mock()
+        assert index._expand("par") == ["paris"]
+        logger.info.assert_not_called()
+
+
+def test_update_and_remove():
+    """
+    Test that updates replace the tokens of a post.
+    """
+    index = TextIndex()
+    index.update("1", {"description": "Sea view"})
+    index.update("1", {"description": "Mountain view"})
+    assert index.search("sea") == {}
+    assert set(index.search("mountain")) == {"1"}
+    index.remove("1")
+    assert index.search("view") == {}
+    assert len(index) == 0
@@ -0,0 +1,272 @@
+""" Tests for the travel tips cache. """
+import time
+from unittest.mock import patch
+
+import pytest
+
+from utils import tips
+from utils.tips import get_cached_tips, stream_cached_tips, tips_key
+
+
+@pytest.fixture()
+def tips_app(app, tmp_path):
+    """
+    Fixture for an app context without redis and with a temporary instance folder.
+    """
+    app.instance_path = str(tmp_path)
+    with app.app_context():
+        yield app
+
+
+def test_tips_key():
+    """
+    Test that locations are normalized into the same key.
+    """
+    assert tips_key(" Paris", "FRANCE ") == tips_key("paris", "France")
+    assert tips_key("New  York", "USA") == "new york|usa"
+
+
+def test_tips_cached_on_disk(tips_app):
+    """
+    Test that tips are asked for once and then served from the disk cache.
+    """
+    with patch("utils.tips.get_travel_tips", return_value=["1. Louvre"]) as ask:
+        assert get_cached_tips("Paris", "France") == ["1. Louvre"]
+        assert get_cached_tips("paris", "france") == ["1. Louvre"]
+        assert ask.call_count == 1
+
+
+def test_tips_failure_not_cached(tips_app):
+    """
+    Test that an empty answer is not cached.
+    """
+    with patch("utils.tips.get_travel_tips", return_value=[]) as ask:
+        assert get_cached_tips("Paris", "France") == []
+        assert get_cached_tips("Paris", "France") == []
+        assert ask.call_count == 2
+
+
+def test_tips_stale_while_revalidate(tips_app):
+    """
+    Test that stale tips are served while they are refreshed in the background.
+    """
+    with patch("utils.tips.get_travel_tips", return_value=["1. Louvre"]):
+        get_cached_tips("Paris", "France")
+    with patch("utils.tips.get_travel_tips", return_value=["1. Orsay"]) as ask, patch(
+        "utils.tips.TIPS_TTL", -1
+    ):
+        assert get_cached_tips("Paris", "France") == ["1. Louvre"]
+        for _ in range(100):
+            if not tips._refreshing:
+                break
+            time.sleep(0.01)
+        ask.assert_called_once()
+    assert get_cached_tips("Paris", "France") == ["1. Orsay"]
+
+
+def test_tips_route_cache_control(client):
+    """
+    Test that the tips route sets cache headers.
+    """
+    with patch("views.post.get_cached_tips", return_value=["1. Louvre"]):
+        response = client.get("/tips?city=Paris&country=France")
+        assert response.status_code == 200
+        assert "public" in response.headers["Cache-Control"]
+    with patch("views.post.get_cached_tips", return_value=[]):
+        response = client.get("/tips?city=Paris&country=France")
+        assert response.headers["Cache-Control"] == "no-store"
+
+
+def test_tips_single_flight(tips_app):
+    """
+    Test that concurrent requests for the same location ask Bing AI once.
+    """
+    import threading
+
+    release = threading.Event()
+    calls = []
+
+    def ask(text):
+        calls.append(text)
+        release.wait(1)
+        return ["1. Louvre"]
+
+    results = []
+
+    def read():
+        with tips_app.app_context():
+            results.append(get_cached_tips("Paris", "France"))
+
+    with patch("utils.tips.get_travel_tips", side_effect=ask):
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert results == [["1. Louvre"]] * 4
+    assert len(calls) == 1
+
+
+def test_tips_redis_lock(tips_app):
+    """
+    Test that a worker that waited for the lock of a location reuses the tips
+    the lock holder cached instead of asking again.
+    """
+    import json
+    from unittest.mock import MagicMock
+
+    redis = MagicMock()
+    redis.get.side_effect = [
+        None,
+        json.dumps({"tips": ["1. Louvre"], "fetched": time.time()}),
+    ]
+    redis.lock.return_value.acquire.return_value = True
+    tips_app.config["SESSION_REDIS"] = redis
+    with patch("utils.tips.get_travel_tips") as ask:
+        assert get_cached_tips("Paris", "France") == ["1. Louvre"]
+        ask.assert_not_called()
+    redis.lock.assert_called_once()
+    redis.lock.return_value.release.assert_called_once()
+
+
+def test_tips_queue_full(tips_app):
+    """
+    Test that requests are dropped when the queue of a worker is full.
+    """
+    with patch("utils.tips.TIPS_MAX_QUEUE", 0), patch(
+        "utils.tips.get_travel_tips"
+    ) as ask:
+        assert get_cached_tips("Paris", "France") == []
+        ask.assert_not_called()
+
+
+def test_stream_cached_tips(tips_app):
+    """
+    Test that streamed tips are cached once the answer is complete.
+    """
+    with patch(
+        "utils.tips.stream_travel_tips", return_value=iter(["1. Louvre", "2. Orsay"])
+    ) as ask:
+        assert list(stream_cached_tips("Paris", "France")) == ["1. Louvre", "2. Orsay"]
+        assert list(stream_cached_tips("Paris", "France")) == ["1. Louvre", "2. Orsay"]
+        ask.assert_called_once()
+
+
+def test_stream_tips_single_flight(tips_app):
+    """
+    Test that concurrent streams for the same location ask Bing AI once and
+    that the other requests get the streamed answer.
+    """
+    import threading
+
+    release = threading.Event()
+    calls = []
+
+    def ask(text):
+        calls.append(text)
+        yield "1. Louvre"
+        release.wait(1)
+        yield "2. Orsay"
+
+    results = []
+
+    def read():
+        with tips_app.app_context():
+            results.append(get_cached_tips("Paris", "France"))
+
+    with patch("utils.tips.stream_travel_tips", side_effect=ask), patch(
+        "utils.tips.get_travel_tips"
+    ) as get:
+        stream = stream_cached_tips("Paris", "France")
+        assert next(stream) == "1. Louvre"
+        threads = [threading.Thread(target=read) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        assert list(stream) == ["2. Orsay"]
+        for thread in threads:
+            thread.join()
+        get.assert_not_called()
+    assert results == [["1. Louvre", "2. Orsay"]] * 3
+    assert len(calls) == 1
+
+
+def test_stream_tips_disconnect(tips_app):
+    """
+    Test that the tips of a stream whose client disconnects are not shared
+    and that the waiting requests ask on their own.
+    """
+    import threading
+
+    def ask(text):
+        yield "1. Louvre"
+        yield "2. Orsay"
+
+    results = []
+
+    def read():
+        with tips_app.app_context():
+            results.append(list(stream_cached_tips("Paris", "France")))
+
+    with patch("utils.tips.stream_travel_tips", side_effect=ask), patch(
+        "utils.tips.get_travel_tips", return_value=["1. Louvre", "2. Orsay"]
+    ) as get:
+        stream = stream_cached_tips("Paris", "France")
+        assert next(stream) == "1. Louvre"
+        thread = threading.Thread(target=read)
+        thread.start()
+        time.sleep(0.05)
+        stream.close()
+        thread.join()
+        get.assert_called_once()
+    assert results == [["1. Louvre", "2. Orsay"]]
+
+
+def test_tips_wait_timeout(tips_app):
+    """
+    Test that a request stops waiting for a concurrent question that takes
+    too long and asks on its own.
+    """
+    import threading
+
+    release = threading.Event()
+
+    def ask(text):
+        yield "1. Louvre"
+        release.wait(1)
+
+    with patch("utils.tips.TIPS_WAIT", 0.05), patch(
+        "utils.tips.stream_travel_tips", side_effect=ask
+    ), patch("utils.tips.get_travel_tips", return_value=["2. Orsay"]) as get:
+        stream = stream_cached_tips("Paris", "France")
+        assert next(stream) == "1. Louvre"
+        assert get_cached_tips("Paris", "France") == ["2. Orsay"]
+        get.assert_called_once()
+        release.set()
+        assert not list(stream)
+
+
+def test_stream_tips_queue_full(tips_app):
+    """
+    Test that streams are dropped when the queue of a worker is full.
+    """
+    with patch("utils.tips.TIPS_MAX_QUEUE", 0), patch(
+        "utils.tips.stream_travel_tips"
+    ) as ask:
+        assert not list(stream_cached_tips("Paris", "France"))
+        ask.assert_not_called()
+
+
+def test_tips_stream_route(client):
+    """
+    Test that the stream route sends every tip as an event followed by a done event.
+    """
+    with patch("views.post.stream_cached_tips", return_value=iter(["1. Louvre"])):
+        response = client.get("/tips/stream?city=Paris&country=France")
+        assert response.mimetype == "text/event-stream"
+        assert response.get_data(as_text=True) == (
+            'data: "1. Louvre"\n\nevent: done\ndata: {}\n\n'
+        )
@@ -0,0 +1,131 @@
+"""Tests for the direct uploads of the images to Storage."""
+import hashlib
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+from flask import session
+from PIL import Image
+
+from utils.uploads import MAX_UPLOAD_BYTES, finalize_uploads, sign_uploads
+
+
+def login(app):
+    """
+    Build a request context with a logged in user.
+    """
+    context = app.test_request_context()
+    context.push()
+    session["user"] = {"uid": "1234", "creation_id": ""}
+    return context
+
+
+def png_bytes():
+    """
+    @return The bytes of a generated PNG image
+    """
+    output = BytesIO()
+    Image.new("RGB", (400, 300)).save(output, "PNG")
+    return output.getvalue()
+
+
+def test_sign_uploads(app):
+    """
+    Test that only images within the size limit get signed URLs with distinct object names.
+    """
+    context = login(app)
+    try:
+        with patch("utils.uploads.storage") as storage:
+            blob = storage.bucket.return_value.blob
+            blob.return_value.generate_signed_url.return_value = "https://signed"
+            results = sign_uploads(
+                [
+                    {"name": "a.jpg", "type": "image/jpeg", "size": 1000},
+                    {"name": "a.jpg", "type": "image/jpeg", "size": 1000},
+                    {"name": "notes.txt", "type": "text/plain", "size": 10},
+                    {
+                        "name": "b.png",
+                        "type": "image/png",
+                        "size": MAX_UPLOAD_BYTES + 1,
+                    },
+                ]
+            )
+        assert [result.get("error") for result in results] == [
+            None,
+            None,
+            "file type not allowed",
+            "file too large",
+        ]
+        first, second = results[0]["object"], results[1]["object"]
+        assert first != second
+        assert first.startswith("static/uploads/") and first.endswith("-a.jpg")
+        assert results[0]["url"] == "https://signed"
+        assert results[0]["headers"]["Content-Type"] == "image/jpeg"
+        kwargs = blob.return_value.generate_signed_url.call_args.kwargs
+        assert kwargs["version"] == "v4" and kwargs["method"] == "PUT"
+        assert session["uploads"] == [first, second]
+    finally:
+        context.pop()
+
+
+def test_finalize_uploads(app):
+    """
+    Test that signed images are copied to the names of their content with their
+    variants, and other objects are rejected.
+    """
+    context = login(app)
+    session["uploads"] = [
+        "static/uploads/1-a.png",
+        "static/uploads/2-b.png",
+        "static/uploads/3-c.png",
+    ]
+    data = png_bytes()
+    name = f"static/uploads/{hashlib.sha256(data).hexdigest()}.png"
+    blobs = {
+        "static/uploads/1-a.png": MagicMock(
+            content_type="image/png",
+            size=100,
+            download_as_bytes=MagicMock(return_value=data),
+        ),
+        "static/uploads/2-b.png": MagicMock(
+            content_type="image/png",
+            size=100,
+            download_as_bytes=MagicMock(return_value=b"not an image"),
+        ),
+    }
+    try:
+        with patch("utils.uploads.storage") as storage, patch(
+            "utils.images.IMAGE_WORKERS", 0
+        ), patch("firebase_admin.firestore.client"):
+            bucket = storage.bucket.return_value
+            bucket.get_blob.side_effect = blobs.get
+            bucket.blob.side_effect = lambda blob_name: MagicMock(
+                public_url=f"https://storage/{blob_name}"
+            )
+            results = finalize_uploads(
+                [
+                    "static/uploads/1-a.png",
+                    "static/uploads/2-b.png",
+                    "static/uploads/3-c.png",
+                    "static/uploads/other.png",
+                ]
+            )
+        assert results[0]["url"] == f"https://storage/{name}"
+        assert results[0]["filename"] == "a.png"
+        assert results[0]["variants"]["widths"] == [320, 400]
+        assert results[1:] == [
+            {"filename": "b.png", "error": "not a valid image"},
+            {"filename": "c.png", "error": "not uploaded"},
+            {"filename": "static/uploads/other.png", "error": "unknown upload"},
+        ]
+        bucket.copy_blob.assert_called_once_with(
+            blobs["static/uploads/1-a.png"], bucket, name
+        )
+        copy = bucket.copy_blob.return_value
+        assert copy.cache_control == "public, max-age=31536000, immutable"
+        copy.patch.assert_called_once()
+        # The uploaded objects are not kept under their random names
+        blobs["static/uploads/1-a.png"].delete.assert_called_once()
+        blobs["static/uploads/2-b.png"].delete.assert_called_once()
+        assert session["uploads"] == []
+    finally:
+        context.pop()
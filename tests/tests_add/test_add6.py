@@ -67,3 +67,39 @@ def test_add_6_edit_post(auth_client):
         # Assert the response status code
         assert response.status_code == 302
         assert response.headers["Location"] == "/edit/1"
+
+
+def test_add_6_sign_without_files(auth_client):
+    """
+    Test that signing uploads needs a list of files.
+
+    @param auth_client - The client to make requests to the server
+    """
+    response = auth_client.post("/add-6/sign", json={})
+    assert response.status_code == 400
+
+
+def test_add_6_finalize(auth_client):
+    """
+    Test that finalized uploads are added to the post.
+
+    @param auth_client - The client to make requests to the server
+    """
+    results = [
+        {"filename": "a.jpg", "url": "https://storage/a.jpg", "variants": {}},
+        {"filename": "b.jpg", "error": "not uploaded"},
+    ]
+    with patch("views.add.finalize_uploads", return_value=results), patch(
+        "views.add.update_post"
+    ) as update_post:
+        response = auth_client.post(
+            "/add-6/1/finalize", json={"objects": ["a.jpg", "b.jpg"]}
+        )
+
+        assert response.status_code == 200
+        assert response.get_json() == {"redirect": "/edit/1", "failed": [results[1]]}
+        update_post.assert_called_once_with(
+            1,
+            {"images": ["https://storage/a.jpg"], "image_variants": [{}]},
+            images=True,
+        )
@@ -1,3 +1,4 @@
+from datetime import datetime, timezone
 from unittest.mock import patch, MagicMock
 
 
@@ -39,6 +40,71 @@ def test_add_7_post(auth_client):
         assert response.headers["Location"] == "/add-8"
 
 
+def test_add_7_post_guests(auth_client):
+    """
+    Test that the number of guests is stored as a number under maxGuests
+    and that an invalid number is answered with an error message.
+
+    @param auth_client - The client to make requests to the server
+    """
+    with auth_client.session_transaction() as session:
+        session["drafts"] = {"9999": {"city": "Mlada Boleslav", "country": "Czechia"}}
+    data = {"bedrooms": "1", "baths": "1", "beds": "1"}
+    with patch("firebase_admin.firestore.client"):
+        response = auth_client.post("/add-7", data={**data, "guests": " 3 "})
+        assert response.status_code == 302
+        with auth_client.session_transaction() as session:
+            draft = session["drafts"]["9999"]
+        assert draft["maxGuests"] == 3
+        assert "guests" not in draft
+
+        for guests in ["", "many", "0"]:
+            response = auth_client.post("/add-7", data={**data, "guests": guests})
+            assert response.status_code == 400
+
+
+def test_backfill_guests():
+    """
+    Test that the number of guests is copied to maxGuests as a number in batches.
+    """
+    from utils.add import backfill_guests
+
+    posts = [
+        MagicMock(to_dict=MagicMock(return_value={"id": 1, "guests": "4"})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 2, "maxGuests": 2})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 3, "maxGuests": "3"})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 4, "guests": "lots"})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 5})),
+    ]
+    with patch("firebase_admin.firestore.client") as client:
+        client.return_value.collection.return_value.stream.return_value = posts
+        batch = client.return_value.batch.return_value
+        assert backfill_guests() == (2, [4, 5])
+        assert [call.args[1] for call in batch.update.call_args_list] == [
+            {"maxGuests": 4},
+            {"maxGuests": 3},
+        ]
+        batch.commit.assert_called_once()
+
+
+def test_backfill_created():
+    """
+    Test that posts without a creation time get the creation time of their document.
+    """
+    from utils.add import backfill_created
+
+    created = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    posts = [
+        MagicMock(create_time=created, to_dict=MagicMock(return_value={"id": 1})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 2, "created": created})),
+    ]
+    with patch("firebase_admin.firestore.client") as client:
+        client.return_value.collection.return_value.stream.return_value = posts
+        batch = client.return_value.batch.return_value
+        assert backfill_created() == 1
+        batch.update.assert_called_once_with(posts[0].reference, {"created": created})
+
+
 def test_add_7_edit_get(auth_client, mocked_posts):
     """
     Test the edit page for a property housing info.
@@ -16,11 +16,13 @@ def test_add_8_get(auth_client):
 
 def test_add_8_post(auth_client):
     """
-    Test the form for the property pricing.
+    Test the form for the property pricing, which writes the draft of the post in one commit.
 
     @param auth_client - The client to make requests to the server
     """
-    with patch("firebase_admin.firestore.client"):
+    with auth_client.session_transaction() as session:
+        session["drafts"] = {"9999": {"city": "Mlada Boleslav", "country": "Czechia"}}
+    with patch("firebase_admin.firestore.client") as firestore:
         response = auth_client.post(
             "/add-8",
             data={
@@ -33,6 +35,34 @@ def test_add_8_post(auth_client):
         # Assert the response status code
         assert response.status_code == 302
         assert response.headers["Location"] == "/edit/9999"
+        batch = firestore.return_value.batch.return_value
+        batch.commit.assert_called_once()
+        post = batch.set.call_args.args[1]
+        assert post["id"] == 9999
+        assert post["city"] == "Mlada Boleslav"
+        assert post["price"] == 100
+        assert post["rating_count"] == 0
+
+
+def test_add_8_post_without_draft(auth_client):
+    """
+    Test that the last step starts over if the draft of the post is missing.
+
+    @param auth_client - The client to make requests to the server
+    """
+    with patch("firebase_admin.firestore.client") as firestore:
+        response = auth_client.post(
+            "/add-8",
+            data={
+                "price": "100",
+                "month-disc": "15",
+                "year-disc": "20",
+            },
+        )
+
+        assert response.status_code == 302
+        assert response.headers["Location"] == "/add-1"
+        firestore.return_value.batch.assert_not_called()
 
 
 def test_add_8_edit_get(auth_client, mocked_posts):
@@ -84,3 +114,48 @@ def test_add_8_edit_post(auth_client):
         # Assert the response status code
         assert response.status_code == 302
         assert response.headers["Location"] == "/edit/9999"
+
+
+def test_add_8_post_invalid_price(auth_client):
+    """
+    Test that a price that is not a number is answered with an error message.
+
+    @param auth_client - The client to make requests to the server
+    """
+    with auth_client.session_transaction() as session:
+        session["drafts"] = {"9999": {"city": "Mlada Boleslav", "country": "Czechia"}}
+    with patch("firebase_admin.firestore.client") as firestore:
+        for price in ["", "abc", "-5"]:
+            response = auth_client.post(
+                "/add-8",
+                data={"price": price, "month-disc": "15", "year-disc": "20"},
+            )
+            assert response.status_code == 400
+        firestore.return_value.batch.assert_not_called()
+
+
+def test_backfill_prices():
+    """
+    Test that the prices stored as strings are converted to numbers in batches.
+    """
+    from utils.add import backfill_prices
+
+    posts = [
+        MagicMock(to_dict=MagicMock(return_value={"id": 1, "price": "100"})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 2, "price": 80})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 3, "price": " 90 "})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 4, "price": "cheap"})),
+        MagicMock(to_dict=MagicMock(return_value={"id": 5, "price": "70"})),
+    ]
+    with patch("firebase_admin.firestore.client") as client, patch(
+        "utils.firebase.BATCH_LIMIT", 2
+    ):
+        client.return_value.collection.return_value.stream.return_value = posts
+        batch = client.return_value.batch.return_value
+        assert backfill_prices() == (3, [4])
+        assert batch.commit.call_count == 2
+        assert [call.args[1] for call in batch.update.call_args_list] == [
+            {"price": 100},
+            {"price": 90},
+            {"price": 70},
+        ]
@@ -1,6 +1,12 @@
+import click
 from flask import session
+from flask.cli import with_appcontext
 from google.cloud.exceptions import GoogleCloudError
 
+from config import fetch_db
+from utils.cache import invalidate_posts, invalidate_searches
+from utils.firebase import batched_updates
+from utils.geo import location_data
 from utils.render import render_message
 from utils.time import convert_date
 
@@ -38,6 +44,8 @@ def address_data(request):
         "country": country,
         "apt": apt if apt else "None",
         "user_uid": session["user"]["uid"],
+        # Geocoded offline, so the post can be found by radius searches
+        **location_data(city, country, district),
     }
     return data
 
@@ -70,25 +78,61 @@ def type_date_data(request):
     return data
 
 
+def parse_guests(value):
+    """
+    Parse the maximum number of guests of a post.
+
+    :param value: The number of guests as entered in the form
+    :return: The number of guests as a whole number, or None if it is not a valid number
+    """
+    try:
+        guests = int(str(value).strip())
+    except ValueError:
+        return None
+    return guests if guests > 0 else None
+
+
 def basic_data(request):
     bedrooms = request.form["bedrooms"]
-    guests = request.form["guests"]
+    guests = parse_guests(request.form["guests"])
+    if guests is None:
+        return render_message(
+            400, "Please enter the number of guests as a whole number"
+        )
     baths = request.form["baths"]
     beds = request.form["beds"]
     data = {
         "bedrooms": bedrooms,
         "baths": baths,
-        "guests": guests,
+        # Stored as a number under the field the searches filter on
+        "maxGuests": guests,
         "beds": beds,
     }
     return data
 
 
+def parse_price(value):
+    """
+    Parse the price per night of a post.
+
+    :param value: The price as entered in the form
+    :return: The price as a whole number, or None if it is not a valid price
+    """
+    try:
+        price = int(str(value).strip())
+    except ValueError:
+        return None
+    return price if price >= 0 else None
+
+
 def price_data(request):
-    price = request.form["price"]
+    price = parse_price(request.form["price"])
+    if price is None:
+        return render_message(400, "Please enter the price as a whole number")
     month_disc = request.form["month-disc"]
     year_disc = request.form["year-disc"]
     data = {
+        # Stored as a number, so searches can filter the price range in Firestore
         "price": price,
         "month_disc": month_disc,
         "year_disc": year_disc,
@@ -113,3 +157,117 @@ def user_data(user):
         "phoneNumber": phone,
     }
     return data
+
+
+def backfill_prices():
+    """
+    Convert the prices of the posts that were stored as strings to numbers.
+    The posts are updated in batched writes.
+
+    :return: A tuple of the number of updated posts and the ids of the posts
+             whose price is not a number
+    """
+    invalid = []
+    written = []
+
+    def updates():
+        for doc in fetch_db().collection("posts").stream():
+            post = doc.to_dict()
+            if not isinstance(post.get("price"), str):
+                continue
+            price = parse_price(post["price"])
+            if price is None:
+                invalid.append(post.get("id", doc.id))
+                continue
+            written.append(post)
+            yield doc.reference, {"price": price}
+
+    updated = batched_updates(updates())
+    if updated:
+        invalidate_posts(*written)
+        invalidate_searches(*(post.get("country") for post in written))
+    return updated, invalid
+
+
+def backfill_guests():
+    """
+    Store the number of guests of the posts that were written by the add
+    process as a string under "guests" as a number under "maxGuests", so the
+    posts can be found by the searches. The posts are updated in batched writes.
+
+    :return: A tuple of the number of updated posts and the ids of the posts
+             whose number of guests is not a number
+    """
+    invalid = []
+    written = []
+
+    def updates():
+        for doc in fetch_db().collection("posts").stream():
+            post = doc.to_dict()
+            if isinstance(post.get("maxGuests"), int):
+                continue
+            guests = parse_guests(post.get("maxGuests", post.get("guests")))
+            if guests is None:
+                invalid.append(post.get("id", doc.id))
+                continue
+            written.append(post)
+            yield doc.reference, {"maxGuests": guests}
+
+    updated = batched_updates(updates())
+    if updated:
+        invalidate_posts(*written)
+        invalidate_searches(*(post.get("country") for post in written))
+    return updated, invalid
+
+
+def backfill_created():
+    """
+    Record the creation time of the posts that were written before it was
+    recorded, from the creation time of their document, so they are listed
+    in the feed of all posts. The posts are updated in batched writes.
+
+    :return: The number of updated posts
+    """
+    written = []
+
+    def updates():
+        for doc in fetch_db().collection("posts").stream():
+            post = doc.to_dict()
+            if "created" in post:
+                continue
+            written.append(post)
+            yield doc.reference, {"created": doc.create_time}
+
+    updated = batched_updates(updates())
+    if updated:
+        invalidate_posts(*written)
+    return updated
+
+
+@click.command("backfill-prices")
+@with_appcontext
+def backfill_prices_command():
+    """Convert the prices of the posts that were stored as strings to numbers."""
+    updated, invalid = backfill_prices()
+    click.echo(f"Converted the prices of {updated} posts.")
+    if invalid:
+        click.echo(f"Posts with an invalid price: {', '.join(map(str, invalid))}")
+
+
+@click.command("backfill-guests")
+@with_appcontext
+def backfill_guests_command():
+    """Store the number of guests of the posts as a number under maxGuests."""
+    updated, invalid = backfill_guests()
+    click.echo(f"Converted the number of guests of {updated} posts.")
+    if invalid:
+        click.echo(
+            f"Posts with an invalid number of guests: {', '.join(map(str, invalid))}"
+        )
+
+
+@click.command("backfill-created")
+@with_appcontext
+def backfill_created_command():
+    """Record the creation time of the posts that were written without it."""
+    click.echo(f"Recorded the creation time of {backfill_created()} posts.")
@@ -0,0 +1,383 @@
+"""
+This module contains the availability index of the booked nights of every property.
+
+Every worker keeps the bookings of each property as sorted, disjoint intervals
+of day numbers, built from the rentals collection by a Firestore snapshot
+listener. Checking a stay is a binary search over the intervals of its
+property. New bookings are added by the payment view right away, the listener
+brings them to the other workers. Until the listener delivered its first
+snapshot, the rentals of a property are read from Firestore instead.
+
+A booking is written in a transaction that checks the rentals of its property
+and touches the property's document in the "bookings" collection, so of two
+payments for overlapping stays only the first one is booked.
+"""
+import logging
+import os
+import threading
+from bisect import bisect_left, bisect_right
+
+from firebase_admin import firestore
+from flask import current_app as app
+from flask import has_app_context, session
+
+from config import fetch_db
+from utils.cache import invalidate_searches
+from utils.firebase import firebase_query, next_id
+from utils.time import day_ordinal
+
+logger = logging.getLogger("first_logger")
+
+
+def availability_enabled():
+    """
+    Check if the availability index is enabled for the app.
+
+    @return True if bookings should be checked against the in-memory index
+    """
+    return has_app_context() and app.config.get("SEARCH_INDEX", False)
+
+
+def _nights(vfrom, to):
+    """
+    Convert a stay into an interval of nights. The last day is the checkout day,
+    so it is free for the next guest.
+
+    @param vfrom - The first day of the stay
+    @param to - The last day of the stay
+    @return A tuple of the first night and the checkout day as day numbers
+    """
+    return day_ordinal(vfrom), day_ordinal(to)
+
+
+class Bookings:
+    """
+    The booked nights of a single property as sorted, disjoint intervals.
+    """
+
+    def __init__(self):
+        self.rentals = {}
+        self._starts = []
+        self._ends = []
+
+    def _merge(self, start, end):
+        """
+        Add an interval, merging it with the intervals it overlaps or touches.
+
+        @param start - The first night
+        @param end - The checkout day
+        """
+        left = bisect_left(self._ends, start)
+        right = bisect_right(self._starts, end)
+        if left < right:
+            start = min(start, self._starts[left])
+            end = max(end, self._ends[right - 1])
+            del self._starts[left:right]
+            del self._ends[left:right]
+        self._starts.insert(left, start)
+        self._ends.insert(left, end)
+
+    def add(self, rid, start, end):
+        """
+        Add the booking of a rental. Adding the same rental twice has no effect.
+
+        @param rid - The id of the rental document
+        @param start - The first night
+        @param end - The checkout day
+        """
+        if self.rentals.get(rid) == (start, end):
+            return
+        previous = self.rentals.get(rid)
+        self.rentals[rid] = (start, end)
+        if previous is None:
+            self._merge(start, end)
+        else:
+            self._rebuild()
+
+    def remove(self, rid):
+        """
+        Remove the booking of a rental.
+
+        @param rid - The id of the rental document
+        """
+        if self.rentals.pop(rid, None) is not None:
+            self._rebuild()
+
+    def _rebuild(self):
+        """
+        Rebuild the intervals from the rentals after one was changed or removed.
+        """
+        self._starts, self._ends = [], []
+        for start, end in self.rentals.values():
+            self._merge(start, end)
+
+    def is_free(self, start, end):
+        """
+        Check if no night of a stay is booked.
+
+        @param start - The first night
+        @param end - The checkout day
+        @return True if the stay does not overlap a booking
+        """
+        # The last interval that starts before the checkout day is the only candidate
+        i = bisect_left(self._starts, end) - 1
+        return i < 0 or self._ends[i] <= start
+
+
+def rental_nights(data):
+    """
+    Get the booked nights of a rental document.
+
+    @param data - The rental document
+    @return A tuple of the property id, the first night and the checkout day,
+            or None if the rental has no valid dates
+    """
+    try:
+        start, end = _nights(data["from"], data["to"])
+        pid = int(data["property"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (pid, start, end) if start < end else None
+
+
+class AvailabilityIndex:
+    """
+    The bookings of all properties, kept current by a listener on the rentals collection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._pid = None
+        self._watch = None
+        self._properties = {}
+        self._rentals = {}
+
+    @property
+    def ready(self):
+        """
+        @return True once the listener delivered the first snapshot
+        """
+        return self._ready.is_set()
+
+    def start(self):
+        """
+        Start listening to the rentals collection, also after the worker was
+        forked or the listener stopped after an error.
+        """
+        with self._lock:
+            if (
+                self._pid == os.getpid()
+                and self._watch is not None
+                and self._watch.is_active
+            ):
+                return
+            self._pid = os.getpid()
+            self._properties = {}
+            self._rentals = {}
+            self._ready.clear()
+            self._watch = (
+                fetch_db()
+                .collection("rentals")
+                .select(["property", "from", "to"])
+                .on_snapshot(self._on_snapshot)
+            )
+
+    def _on_snapshot(self, snapshot, changes, read_time):
+        """
+        Apply the changes of a snapshot to the index. This runs on the thread
+        of the listener.
+
+        @param snapshot - All documents of the collection
+        @param changes - The changes since the last snapshot
+        @param read_time - The time of the snapshot
+        """
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                booking = None
+                if change.type.name != "REMOVED":
+                    booking = rental_nights(doc.to_dict() or {})
+                self._remove(doc.id)
+                if booking is not None:
+                    self._add(doc.id, *booking)
+        self._ready.set()
+
+    def _add(self, rid, pid, start, end):
+        """
+        Add the booking of a rental to its property. The caller holds the lock.
+        """
+        self._rentals[rid] = pid
+        self._properties.setdefault(pid, Bookings()).add(rid, start, end)
+
+    def _remove(self, rid):
+        """
+        Remove the booking of a rental from its property. The caller holds the lock.
+        """
+        pid = self._rentals.pop(rid, None)
+        if pid is not None:
+            self._properties[pid].remove(rid)
+
+    def book(self, rid, pid, vfrom, to):
+        """
+        Add a new booking right away, before the listener reports it.
+
+        @param rid - The id of the rental document
+        @param pid - The id of the property
+        @param vfrom - The first day of the stay
+        @param to - The last day of the stay
+        """
+        start, end = _nights(vfrom, to)
+        with self._lock:
+            self._remove(rid)
+            self._add(rid, int(pid), start, end)
+
+    def is_free(self, pid, start, end):
+        """
+        Check if a property is free for a stay.
+
+        @param pid - The id of the property
+        @param start - The first night of the stay
+        @param end - The checkout day of the stay
+        @return True if no night of the stay is booked
+        """
+        with self._lock:
+            bookings = self._properties.get(int(pid))
+            return bookings is None or bookings.is_free(start, end)
+
+
+index = AvailabilityIndex()
+
+
+def _is_free_in_firestore(pid, vfrom, to):
+    """
+    Check if a property is free for a stay by reading its rentals.
+
+    @param pid - The id of the property
+    @param vfrom - The first day of the stay
+    @param to - The last day of the stay
+    @return True if no night of the stay is booked
+    """
+    bookings = Bookings()
+    with firebase_query("rentals", [("property", "==", int(pid))]) as rentals:
+        for i, rental in enumerate(rentals):
+            booking = rental_nights(rental)
+            if booking is not None:
+                bookings.add(i, booking[1], booking[2])
+    return bookings.is_free(*_nights(vfrom, to))
+
+
+def _ready_index():
+    """
+    Get the availability index, starting its listener in this worker if needed.
+
+    @return The index or None if it is disabled or not loaded yet
+    """
+    if not availability_enabled():
+        return None
+    try:
+        index.start()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot start the availability index listener")
+        return None
+    return index if index.ready else None
+
+
+def is_available(pid, vfrom, to):
+    """
+    Check if a property is free for a stay, e.g. before a checkout.
+
+    @param pid - The id of the property
+    @param vfrom - The first day of the stay
+    @param to - The last day of the stay
+    @return True if no night of the stay is booked
+    """
+    ready = _ready_index()
+    if ready is None:
+        return _is_free_in_firestore(pid, vfrom, to)
+    return ready.is_free(pid, *_nights(vfrom, to))
+
+
+def availability_filter(vfrom, to):
+    """
+    Build the filter for the booked nights of a search. Without a loaded index
+    the bookings are not checked, since reading the rentals of every result
+    would cost more than the search itself.
+
+    @param vfrom - The first day of the stay
+    @param to - The last day of the stay
+    @return A function that returns True if a property id is free for the stay, or None
+    """
+    ready = _ready_index()
+    if ready is None:
+        return None
+    start, end = _nights(vfrom, to)
+    return lambda pid: ready.is_free(pid, start, end)
+
+
+@firestore.transactional
+def _book(transaction, rental_ref, data):
+    """
+    Write a rental unless its stay overlaps another rental of the property.
+
+    @param transaction - The Firestore transaction to run in
+    @param rental_ref - Reference to the new rental document
+    @param data - The rental document
+    @return The id of the rental document that holds the payment, or None if the
+            stay overlaps a booking
+    """
+    db = fetch_db()
+    # Concurrent bookings of a property all write this document, so they conflict
+    # and run one after the other instead of both missing each other's rental
+    lock_ref = db.collection("bookings").document(str(data["property"]))
+    lock_ref.get(transaction=transaction)
+    rentals = transaction.get(
+        db.collection("rentals").where("property", "==", data["property"])
+    )
+    bookings = Bookings()
+    for doc in rentals:
+        rental = doc.to_dict() or {}
+        # The same payment is booked once, e.g. when the success page is reloaded
+        if rental.get("pay_id") == data["pay_id"]:
+            return doc.id
+        booking = rental_nights(rental)
+        if booking is not None:
+            bookings.add(doc.id, booking[1], booking[2])
+    if not bookings.is_free(*_nights(data["from"], data["to"])):
+        return None
+    transaction.set(rental_ref, data)
+    transaction.set(lock_ref, {"updated": firestore.SERVER_TIMESTAMP})
+    return rental_ref.id
+
+
+def book_rental(data):
+    """
+    Write the rental of a paid stay, unless the property was booked for an
+    overlapping stay since the checkout started.
+
+    @param data - The rental document, with the property, the pay_id and the dates
+    @return The id of the rental document, or None if the stay overlaps a booking
+    """
+    db = fetch_db()
+    data = {**data, "id": next_id("rentals")}
+    rental_ref = db.collection("rentals").document(
+        f'{data["id"]}|{session["user"]["uid"]}'
+    )
+    return _book(db.transaction(), rental_ref, data)
+
+
+def record_booking(rid, pid, vfrom, to):
+    """
+    Add a new booking to the index of this worker and invalidate the cached
+    searches it changes.
+
+    @param rid - The id of the rental document
+    @param pid - The id of the property
+    @param vfrom - The first day of the stay
+    @param to - The last day of the stay
+    """
+    if index.ready:
+        index.book(rid, pid, vfrom, to)
+    # The property is no longer free in the cached searches of its country
+    with firebase_query("posts", [("id", "==", int(pid))], fields=["country"]) as docs:
+        invalidate_searches(*(doc.get("country") for doc in docs))
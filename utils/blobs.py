@@ -0,0 +1,324 @@
+"""
+This module stores the images of the posts in Storage under the names of their content.
+
+An image is named by the SHA-256 hash of its bytes, e.g. "static/uploads/<hash>.jpg",
+so the same image is stored once however often it is uploaded, and a name never
+changes its content, so it is served with a long-lived immutable Cache-Control.
+The metadata of the variants is kept on the blob, so an image that is stored
+already is neither uploaded nor resized again. As images are shared between posts,
+the references to an image are counted in the "blobs" collection, and an image
+is only deleted when nothing references it anymore. Every upload takes a
+reference, which the draft or post the image is added to holds. Drafts that
+are never finished do not give their references back, so the sweep-images
+command recounts the references of the posts and deletes the images that no
+post and no recent upload references.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
+
+import click
+from firebase_admin import firestore, storage
+from flask import current_app as app
+from flask.cli import with_appcontext
+from PIL import Image, UnidentifiedImageError
+
+from config import fetch_db
+from utils.images import process_image, variant_name
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The extensions of the image formats that can be uploaded.
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+CONTENT_NAME = re.compile(r"[0-9a-f]{64}")
+# Objects uploaded with a signed URL that were never finalized, see utils.uploads.
+PENDING_NAME = re.compile(r"[0-9a-f]{32}-")
+# How many seconds the references of an upload are kept without a post, longer
+# than a draft lives, see utils.drafts.DRAFT_TTL.
+IMAGE_GRACE = int(os.getenv("IMAGE_GRACE", str(8 * 24 * 3600)))
+VARIANT_SUFFIX = re.compile(r"-\d+w\.[a-z]+$")
+
+
+def image_type(data):
+    """
+    Get the content type of an image from its header, without decoding it.
+
+    @param data - The bytes of the image
+    @return The content type, a key of EXTENSIONS
+    @raise ValueError - If the data is not an image or its format is not allowed
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            content_type = Image.MIME.get(image.format)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as err:
+        raise ValueError("not a valid image") from err
+    if content_type not in EXTENSIONS:
+        raise ValueError("file type not allowed")
+    return content_type
+
+
+def content_key(url):
+    """
+    Get the content hash of an image from its name or url.
+
+    @param url - The name or url of the image
+    @return The hash, or None for images that were named by their filename
+    """
+    stem = url.rsplit("/", 1)[-1].split(".", 1)[0]
+    return stem if CONTENT_NAME.fullmatch(stem) else None
+
+
+def upload_to_bucket(bucket, filename, data, content_type, metadata=None):
+    """
+    Upload an immutable blob to Firebase Storage.
+
+    @param bucket - The bucket to upload to
+    @param filename - Name of the blob to upload to
+    @param data - The bytes of the blob
+    @param content_type - The content type of the blob
+    @param metadata - Optional custom metadata of the blob
+    @return The blob
+    """
+    blob = bucket.blob(filename)
+    blob.cache_control = CACHE_CONTROL
+    blob.metadata = metadata
+    blob.upload_from_string(data, content_type=content_type)
+    return blob
+
+
+def upload_variants(bucket, filename, variants):
+    """
+    Upload the resized variants of an image next to it, see utils.images.
+
+    @param bucket - The bucket of the image
+    @param filename - The name of the blob of the image
+    @param variants - A dict from (width, format) to the bytes of the variant
+    """
+    for (width, fmt), content in variants.items():
+        upload_to_bucket(
+            bucket, variant_name(filename, width, fmt), content, f"image/{fmt}"
+        )
+
+
+def store_image(bucket, folder, data, source=None):
+    """
+    Store an image with its variants under the name of its content, unless it
+    is stored already, and take a reference to it for the draft or post it is added to.
+
+    @param bucket - The bucket to store the image in
+    @param folder - The folder of the bucket to store the image in
+    @param data - The bytes of the image
+    @param source - The blob the browser uploaded the image to, copied instead of uploading the bytes again
+    @return A tuple of the url of the image and the metadata of its variants
+    @raise ValueError - If the data is not an image
+    """
+    content_type = image_type(data)
+    digest = hashlib.sha256(data).hexdigest()
+    filename = f"{folder}/{digest}.{EXTENSIONS[content_type]}"
+    # The reference is taken before the image is looked up, so a post that drops
+    # the last other reference meanwhile does not delete it
+    retain_images([filename])
+    try:
+        return _store(bucket, filename, data, content_type, source)
+    except BaseException:
+        _release(fetch_db().transaction(), _counter(digest), 1)
+        raise
+
+
+def _store(bucket, filename, data, content_type, source):
+    """
+    Upload an image with its variants, see store_image.
+
+    @param bucket - The bucket to store the image in
+    @param filename - The name of the blob of the image
+    @param data - The bytes of the image
+    @param content_type - The content type of the image
+    @param source - The blob the browser uploaded the image to, or None
+    @return A tuple of the url of the image and the metadata of its variants
+    """
+    stored = bucket.get_blob(filename)
+    if stored is not None and "variants" in (stored.metadata or {}):
+        return stored.public_url, json.loads(stored.metadata["variants"])
+    meta, variants = process_image(data)
+    # The variants are uploaded first, so a stored image always has them
+    upload_variants(bucket, filename, variants)
+    meta = {"url": bucket.blob(filename).public_url, **meta}
+    metadata = {"variants": json.dumps(meta)}
+    if source is None:
+        upload_to_bucket(bucket, filename, data, content_type, metadata)
+    else:
+        blob = bucket.copy_blob(source, bucket, filename)
+        blob.cache_control = CACHE_CONTROL
+        blob.content_type = content_type
+        blob.metadata = metadata
+        blob.patch()
+    return meta["url"], meta
+
+
+def _counter(key):
+    """
+    @param key - The content hash of an image
+    @return The reference of the document that counts the posts referencing the image
+    """
+    return fetch_db().collection("blobs").document(key)
+
+
+def retain_images(urls, batch=None):
+    """
+    Count references to images.
+
+    @param urls - The names or urls of the referenced images
+    @param batch - A write batch to add the counts to, which the caller commits.
+                   Without one the counts are written in their own batch
+    """
+    counts = Counter(key for key in map(content_key, urls) if key)
+    if not counts:
+        return
+    writes = batch if batch is not None else fetch_db().batch()
+    for key, count in counts.items():
+        writes.set(
+            _counter(key),
+            {
+                "refs": firestore.Increment(count),
+                "retained": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
+        )
+    if batch is None:
+        writes.commit()
+
+
+@firestore.transactional
+def _release(transaction, counter_ref, count):
+    """
+    Drop references to an image.
+
+    @param transaction - The Firestore transaction to run in
+    @param counter_ref - The counter document of the image
+    @param count - The number of dropped references
+    @return True if no post references the image anymore
+    """
+    snapshot = counter_ref.get(transaction=transaction)
+    refs = int((snapshot.to_dict() or {}).get("refs", 0)) if snapshot.exists else 0
+    if refs > count:
+        transaction.update(counter_ref, {"refs": refs - count})
+        return False
+    transaction.delete(counter_ref)
+    return True
+
+
+def release_images(urls):
+    """
+    Drop the references of a post to images, and delete the images that no post
+    references anymore with their variants. Images named by their filename
+    belong to a single post and are always deleted.
+
+    @param urls - The urls of the images removed from the post
+    @return The number of deleted images
+    """
+    bucket = storage.bucket()
+    folder = app.config["UPLOAD_FOLDER"]
+    counts = Counter()
+    deleted = 0
+    for url in urls:
+        key = content_key(url)
+        if key:
+            counts[key] += 1
+            continue
+        name = unquote(url.rsplit("/", 1)[-1])
+        stem = name.rsplit(".", 1)[0]
+        bucket.blob(f"{folder}/{name}").delete()
+        for blob in bucket.list_blobs(prefix=f"{folder}/{stem}-"):
+            if VARIANT_SUFFIX.fullmatch(blob.name[len(f"{folder}/{stem}") :]):
+                blob.delete()
+        deleted += 1
+    for key, count in counts.items():
+        if _release(fetch_db().transaction(), _counter(key), count):
+            # The image and its variants all start with the hash
+            for blob in bucket.list_blobs(prefix=f"{folder}/{key}"):
+                blob.delete()
+            deleted += 1
+    return deleted
+
+
+@firestore.transactional
+def _recount(transaction, counter_ref, refs, cutoff):
+    """
+    Set the references to an image to those of the posts, unless it was
+    uploaded after the cutoff and may still be held by a draft.
+
+    @param transaction - The Firestore transaction to run in
+    @param counter_ref - The counter document of the image
+    @param refs - The number of posts that reference the image
+    @param cutoff - The time before which the references of uploads are dropped
+    @return True if nothing references the image anymore
+    """
+    snapshot = counter_ref.get(transaction=transaction)
+    counter = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    retained = counter.get("retained")
+    if retained is not None and retained > cutoff:
+        return False
+    if refs:
+        if counter.get("refs") != refs:
+            transaction.set(counter_ref, {"refs": refs}, merge=True)
+        return False
+    if snapshot.exists:
+        transaction.delete(counter_ref)
+    return True
+
+
+def sweep_images(grace=IMAGE_GRACE):
+    """
+    Recount the references of the posts to the images, and delete the images
+    that no post references, once they are older than the grace period. Objects
+    uploaded with a signed URL that were never finalized are deleted too.
+
+    @param grace - How many seconds the references of an upload are kept without a post
+    @return The number of deleted images
+    """
+    db = fetch_db()
+    refs = Counter()
+    for doc in db.collection("posts").stream():
+        urls = doc.to_dict().get("images") or []
+        refs.update(key for key in map(content_key, urls) if key)
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    bucket = storage.bucket()
+    folder = app.config["UPLOAD_FOLDER"]
+    deleted = 0
+    blobs = defaultdict(list)
+    for blob in bucket.list_blobs(prefix=f"{folder}/"):
+        name = blob.name[len(folder) + 1 :]
+        match = CONTENT_NAME.match(name)
+        if match:
+            # The image and its variants all start with the hash
+            blobs[match.group()].append(blob)
+        elif PENDING_NAME.match(name) and blob.time_created < cutoff:
+            blob.delete()
+            deleted += 1
+    keys = {doc.id for doc in db.collection("blobs").stream()} | set(blobs)
+    for key in keys:
+        if not _recount(db.transaction(), _counter(key), refs[key], cutoff):
+            continue
+        # Images without a counter may still be being stored
+        if blobs[key] and all(blob.time_created < cutoff for blob in blobs[key]):
+            for blob in blobs[key]:
+                blob.delete()
+            deleted += 1
+    return deleted
+
+
+@click.command("sweep-images")
+@with_appcontext
+def sweep_images_command():
+    """Delete the uploaded images that no post references."""
+    deleted = sweep_images()
+    click.echo(f"Deleted {deleted} unreferenced images.")
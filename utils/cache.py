@@ -0,0 +1,290 @@
+"""
+This module contains the two-tier read cache for Firestore documents.
+
+L1 is a size-bounded LRU cache with a short TTL in every worker, L2 is the
+shared redis instance. Cache keys contain a generation number per scope, e.g.
+a single document or the searches of a country, so a write invalidates every
+cached read of its scope at once. Other workers see the new generation once
+their L1 copy of it expires.
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from flask import current_app as app
+from flask import has_app_context
+from redis.exceptions import RedisError
+
+from config import fetch_redis
+
+L1_SIZE = int(os.getenv("CACHE_L1_SIZE", "1024"))
+L1_TTL = float(os.getenv("CACHE_L1_TTL", "5"))
+L2_TTL = int(os.getenv("CACHE_L2_TTL", "300"))
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache whose entries expire after a TTL.
+    """
+
+    def __init__(self, maxsize=L1_SIZE, ttl=L1_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a value from the cache.
+
+        @param key - The key of the entry
+        @return The value or None if it is missing or expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Add a value to the cache, evicting the least recently used entry if it is full.
+
+        @param key - The key of the entry
+        @param value - The value to store
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        """
+        Delete all entries whose key starts with a prefix.
+
+        @param prefix - The key prefix
+        """
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        """
+        Delete all entries.
+        """
+        with self._lock:
+            self._data.clear()
+
+
+_l1 = LRUCache()
+# The generations of this worker when redis is down. There is one per written
+# document, so the least recently used ones are forgotten; invalidate removes the
+# reads of a scope from L1, so a forgotten generation can start over at 0.
+_generations = LRUCache(ttl=float("inf"))
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def cache_enabled():
+    """
+    Check if the read cache is enabled for the app.
+
+    @return True if reads should go through the cache
+    """
+    return has_app_context() and app.config.get("FIRESTORE_CACHE", False)
+
+
+def _generation(collection):
+    """
+    Get the current cache generation of a collection.
+
+    @param collection - The name of the collection
+    @return The generation number
+    """
+    key = f"gen:{collection}"
+    generation = _l1.get(key)
+    if generation is not None:
+        return generation
+    generation = _generations.get(collection) or 0
+    redis = fetch_redis()
+    if redis is not None:
+        try:
+            generation = int(redis.get(f"cache:{key}") or 0)
+        except RedisError:
+            pass
+    _l1.set(key, generation)
+    return generation
+
+
+def join_flight(key):
+    """
+    Join the load of a value, see single_flight. This is for loads that do not
+    fit in a single call, e.g. a value that is streamed while it loads.
+
+    @param key - The cache key
+    @return A tuple of the Future of the load and whether the caller leads it.
+            The leader must finish the load with end_flight
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = _inflight[key] = Future()
+        return future, True
+
+
+def end_flight(key, future, value):
+    """
+    Finish a load led by the caller and share its value with the callers waiting for it.
+
+    @param key - The cache key
+    @param future - The Future of the load, as returned by join_flight
+    @param value - The loaded value
+    """
+    with _inflight_lock:
+        del _inflight[key]
+    future.set_result(value)
+
+
+def single_flight(key, loader):
+    """
+    Load a value once for concurrent callers. Callers that ask for the same key
+    while a load is in flight in this worker wait for it and share its result.
+
+    @param key - The cache key
+    @param loader - A function that loads the value
+    @return The loaded value
+    """
+    future, leader = join_flight(key)
+    if not leader:
+        return future.result()
+    try:
+        value = loader()
+        future.set_result(value)
+        return value
+    except BaseException as err:
+        future.set_exception(err)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def cached(collection, name, loader):
+    """
+    Read a value through the cache. Values are stored pickled, so every caller
+    gets its own copy and can modify it.
+
+    @param collection - The scope the value is cached under, e.g. a document, see document_cache_name
+    @param name - A key for the value that is unique within the scope
+    @param loader - A function that reads the value from Firestore on a miss
+    @return The value
+    """
+    if not cache_enabled():
+        return loader()
+    key = f"{collection}:{_generation(collection)}:{name}"
+    data = _l1.get(key)
+    if data is not None:
+        return pickle.loads(data)
+    redis = fetch_redis()
+    if redis is not None:
+        try:
+            data = redis.get(f"cache:{key}")
+        except RedisError:
+            data = None
+        if data is not None:
+            _l1.set(key, data)
+            return pickle.loads(data)
+
+    def load():
+        value = loader()
+        data = pickle.dumps(value)
+        _l1.set(key, data)
+        if redis is not None:
+            try:
+                redis.set(f"cache:{key}", data, ex=L2_TTL)
+            except RedisError:
+                pass
+        return data
+
+    return pickle.loads(single_flight(key, load))
+
+
+def invalidate(*collections):
+    """
+    Invalidate all cached reads of the given scopes after a write.
+
+    @param collections - The names of the scopes that were written to, see document_cache_name
+    """
+    if not cache_enabled():
+        return
+    redis = fetch_redis()
+    for collection in collections:
+        generation = _generation(collection) + 1
+        if redis is not None:
+            try:
+                generation = redis.incr(f"cache:gen:{collection}")
+            except RedisError:
+                pass
+        _generations.set(collection, generation)
+        _l1.delete_prefix(f"{collection}:")
+        _l1.set(f"gen:{collection}", generation)
+
+
+def document_cache_name(collection, key):
+    """
+    Get the name the cached reads of a single document are stored under,
+    so a write to the document only invalidates its own reads.
+
+    @param collection - The collection of the document, or a name for reads that
+                        belong to one key, e.g. "listings" for the posts of a user
+    @param key - The key of the document, e.g. the id of a post or the uid of a user
+    @return The name to use as the collection of cached and invalidate
+    """
+    return f"{collection}/{key}"
+
+
+def invalidate_posts(*posts):
+    """
+    Invalidate the cached reads of the given posts and of the listings of
+    their users after a write to them.
+
+    @param posts - The written posts, dicts with their id and user_uid
+    """
+    invalidate(
+        *{document_cache_name("posts", int(post["id"])) for post in posts},
+        *{
+            document_cache_name("listings", post["user_uid"])
+            for post in posts
+            if post.get("user_uid")
+        },
+    )
+
+
+def search_cache_name(country):
+    """
+    Get the name the cached search results of a country are stored under,
+    so the writes to the posts of a country only invalidate its searches.
+
+    @param country - The country of the searches
+    @return The name to use as the collection of cached and invalidate
+    """
+    return f"search:{(country or '').strip()}"
+
+
+def invalidate_searches(*countries):
+    """
+    Invalidate the cached search results of the given countries after a write to their posts.
+
+    @param countries - The countries of the written posts, empty values are ignored
+    """
+    invalidate(*{search_cache_name(country) for country in countries if country})
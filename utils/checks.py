@@ -1,5 +1,6 @@
 from flask import session
 
+from utils.cache import document_cache_name
 from utils.firebase import firebase_query
 from utils.render import render_message
 
@@ -8,7 +9,11 @@ def check_self(pid: int) -> None:
     """
     Check if a user is reviewing their own property.
     """
-    with firebase_query("posts", [("id", "==", int(pid))]) as data:
+    with firebase_query(
+        "posts",
+        [("id", "==", int(pid))],
+        cache=document_cache_name("posts", int(pid)),
+    ) as data:
         doc = data[0]
         # If the user is the user s uid
         if doc["user_uid"] == session["user"]["uid"]:
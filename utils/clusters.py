@@ -0,0 +1,143 @@
+"""
+This module clusters the locations of the posts for the map.
+
+The map is split into the usual web mercator tiles, and every tile into a grid
+of CELLS_PER_TILE x CELLS_PER_TILE cells. The posts in a cell are one cluster.
+The clusters of every zoom level are aggregated once per snapshot of the posts,
+sorted by tile, so a tile is a contiguous range found with a binary search and
+holds at most CELLS_PER_TILE ** 2 clusters, however many posts there are.
+"""
+import math
+
+import numpy as np
+
+MAX_ZOOM = 16
+CELL_BITS = 3
+CELLS_PER_TILE = 2**CELL_BITS
+# The latitude where the web mercator projection is cut off.
+MAX_LATITUDE = 85.05112878
+
+
+def mercator_cells(lat, lng, zoom=MAX_ZOOM):
+    """
+    Project coordinates to the cell grid of a zoom level.
+
+    @param lat - An array of latitudes in degrees
+    @param lng - An array of longitudes in degrees
+    @param zoom - The zoom level
+    @return A tuple of the arrays of the cell columns and rows
+    """
+    size = 2 ** (zoom + CELL_BITS)
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lng, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2
+    column = np.clip(np.floor(x * size), 0, size - 1).astype(np.int64)
+    row = np.clip(np.floor(y * size), 0, size - 1).astype(np.int64)
+    return column, row
+
+
+def tile_range(zoom, x, y):
+    """
+    Get the range of the cluster keys of a tile.
+
+    @param zoom, x, y - The tile
+    @return A tuple of the first key of the tile and the first key after it
+    """
+    first = (x * 2**zoom + y) << (2 * CELL_BITS)
+    return first, first + CELLS_PER_TILE**2
+
+
+def tile_box(zoom, x, y):
+    """
+    Get the bounding box of a tile. The tiles at the top and bottom of the map
+    reach to the poles, since the posts beyond MAX_LATITUDE are projected to them.
+
+    @param zoom, x, y - The tile
+    @return A tuple of south, west, north, east in degrees
+    """
+    size = 2**zoom
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / size))))
+
+    north = 90.0 if y == 0 else latitude(y)
+    south = -90.0 if y == size - 1 else latitude(y + 1)
+    return south, x / size * 360 - 180, north, (x + 1) / size * 360 - 180
+
+
+class ClusterIndex:
+    """
+    The clusters of the posts at every zoom level.
+    """
+
+    def __init__(self, lat, lng, ids):
+        """
+        @param lat - The array of the latitudes of the posts, NaN for posts without a location
+        @param lng - The array of the longitudes of the posts
+        @param ids - The array of the ids of the posts
+        """
+        located = ~(np.isnan(lat) | np.isnan(lng))
+        lat = np.asarray(lat)[located]
+        lng = np.asarray(lng)[located]
+        ids = np.asarray(ids)[located]
+        column, row = mercator_cells(lat, lng)
+        mask = CELLS_PER_TILE - 1
+        self.levels = []
+        for zoom in range(MAX_ZOOM + 1):
+            shift = MAX_ZOOM - zoom
+            zoom_column, zoom_row = column >> shift, row >> shift
+            tile = (zoom_column >> CELL_BITS) * 2**zoom + (zoom_row >> CELL_BITS)
+            keys = (tile << (2 * CELL_BITS)) | (
+                ((zoom_column & mask) << CELL_BITS) | (zoom_row & mask)
+            )
+            keys, first, inverse = np.unique(
+                keys, return_index=True, return_inverse=True
+            )
+            counts = np.bincount(inverse, minlength=len(keys))
+            self.levels.append(
+                {
+                    "keys": keys,
+                    "count": counts,
+                    "lat": np.bincount(inverse, lat, len(keys)) / np.maximum(counts, 1),
+                    "lng": np.bincount(inverse, lng, len(keys)) / np.maximum(counts, 1),
+                    "id": ids[first],
+                }
+            )
+
+    @classmethod
+    def from_docs(cls, docs):
+        """
+        Build the clusters from post documents.
+
+        @param docs - An iterable of posts with their id, lat and lng
+        @return The ClusterIndex of the posts that have a location
+        """
+        located = [
+            (float(doc["lat"]), float(doc["lng"]), int(doc["id"]))
+            for doc in docs
+            if doc.get("lat") is not None and doc.get("lng") is not None
+        ]
+        points = np.array(located, dtype=np.float64).reshape(-1, 3)
+        return cls(points[:, 0], points[:, 1], points[:, 2].astype(np.int64))
+
+    def tile(self, zoom, x, y):
+        """
+        Get the clusters of a tile.
+
+        @param zoom, x, y - The tile, with 0 <= zoom <= MAX_ZOOM and 0 <= x, y < 2 ** zoom
+        @return A list of the clusters with their centroid and count, single
+                posts also have their id
+        """
+        level = self.levels[zoom]
+        start, end = np.searchsorted(level["keys"], tile_range(zoom, x, y))
+        clusters = []
+        for i in range(start, end):
+            cluster = {
+                "lat": round(float(level["lat"][i]), 5),
+                "lng": round(float(level["lng"][i]), 5),
+                "count": int(level["count"][i]),
+            }
+            if cluster["count"] == 1:
+                cluster["id"] = int(level["id"][i])
+            clusters.append(cluster)
+        return clusters
@@ -0,0 +1,190 @@
+"""
+This module keeps the drafts of the add wizard.
+
+A new post is collected step by step in a draft in redis, keyed by the user and
+the creation id of the post, and written to Firestore in a single commit on
+the last step. Without redis the drafts are kept in the session of the user.
+Edits of existing posts only write the fields that changed.
+"""
+import os
+import pickle
+
+from firebase_admin import firestore
+from flask import session
+
+from config import fetch_db, fetch_redis
+from utils.cache import invalidate_posts, invalidate_searches
+from utils.firebase import next_id
+from utils.ratings import rating_aggregate
+
+# Drafts that are not finished within this many seconds are dropped.
+DRAFT_TTL = int(os.getenv("DRAFT_TTL", str(7 * 24 * 3600)))
+# The fields of the images step that are added to instead of replaced.
+IMAGE_FIELDS = ["images", "image_variants"]
+
+
+def _add_images(data, current):
+    """
+    @param data - The fields of the images step
+    @param current - The fields of the draft or post
+    @return The fields with the new images before the current ones
+    """
+    return {
+        **data,
+        **{
+            field: data.get(field, []) + current.get(field, [])
+            for field in IMAGE_FIELDS
+        },
+    }
+
+
+def _draft_key(creation_id):
+    """
+    @param creation_id - The id of the post
+    @return The redis key of the draft of the post
+    """
+    return f"draft:{session['user']['uid']}:{creation_id}"
+
+
+def load_draft(creation_id):
+    """
+    Load the draft of a new post.
+
+    @param creation_id - The id of the post
+    @return The fields of the draft, empty if there is no draft
+    """
+    redis = fetch_redis()
+    if redis is None:
+        return dict(session.get("drafts", {}).get(str(creation_id), {}))
+    data = redis.get(_draft_key(creation_id))
+    return pickle.loads(data) if data else {}
+
+
+def save_draft(creation_id, draft):
+    """
+    Store the draft of a new post.
+
+    @param creation_id - The id of the post
+    @param draft - The fields of the draft
+    """
+    redis = fetch_redis()
+    if redis is None:
+        # Only the draft being written is kept, older ones are abandoned
+        session["drafts"] = {str(creation_id): draft}
+        return
+    redis.set(_draft_key(creation_id), pickle.dumps(draft), ex=DRAFT_TTL)
+
+
+def discard_draft(creation_id):
+    """
+    Delete the draft of a new post.
+
+    @param creation_id - The id of the post
+    """
+    redis = fetch_redis()
+    if redis is None:
+        session.pop("drafts", None)
+        return
+    redis.delete(_draft_key(creation_id))
+
+
+def start_draft(data):
+    """
+    Start the draft of a new post with the fields of the first step.
+
+    @param data - The fields of the first step
+    @return The id of the new post
+    """
+    creation_id = next_id("posts")
+    session["user"]["creation_id"] = creation_id
+    save_draft(creation_id, data)
+    return creation_id
+
+
+def update_draft(creation_id, data, images=False):
+    """
+    Add the fields of a step to the draft of a new post.
+
+    @param creation_id - The id of the post
+    @param data - The fields of the step
+    @param images - If True add the images to the images of the draft
+    """
+    draft = load_draft(creation_id)
+    if images:
+        data = _add_images(data, draft)
+    draft.update(data)
+    save_draft(creation_id, draft)
+
+
+def commit_draft(creation_id, data):
+    """
+    Write a new post from its draft and the fields of the last step in a single batched commit.
+
+    @param creation_id - The id of the post
+    @param data - The fields of the last step
+    @return The written post, or None if the draft has no address, e.g. because it expired
+    """
+    draft = {**load_draft(creation_id), **data}
+    if "country" not in draft:
+        return None
+    uid = session["user"]["uid"]
+    post = {
+        **draft,
+        # New posts start with an empty rating aggregate
+        **rating_aggregate([]),
+        "id": int(creation_id),
+        "user_uid": uid,
+        "created": firestore.SERVER_TIMESTAMP,
+    }
+    db = fetch_db()
+    batch = db.batch()
+    # The images keep the references that were taken when they were uploaded
+    batch.set(db.collection("posts").document(f"{creation_id}|{uid}"), post)
+    batch.commit()
+    invalidate_posts(post)
+    invalidate_searches(post["country"])
+    discard_draft(creation_id)
+    return post
+
+
+@firestore.transactional
+def _update_post(transaction, doc_ref, data, images):
+    """
+    Write the fields of an edit step that differ from the post, reading the
+    post in the same transaction, so concurrent edits do not lose each other's images.
+
+    @param transaction - The Firestore transaction to run in
+    @param doc_ref - Reference to the post document
+    @param data - The fields of the step
+    @param images - If True add the images to the images of the post
+    @return A tuple of the post before the edit and the changed fields
+    """
+    snapshot = doc_ref.get(transaction=transaction)
+    current = snapshot.to_dict() or {}
+    if images:
+        data = _add_images(data, current)
+    changes = {
+        field: value for field, value in data.items() if current.get(field) != value
+    }
+    if changes:
+        transaction.update(doc_ref, changes)
+    return current, changes
+
+
+def update_post(pid, data, images=False):
+    """
+    Write the fields of an edit step that differ from the post in a single transaction.
+
+    @param pid - The id of the post
+    @param data - The fields of the step
+    @param images - If True add the images to the images of the post
+    @return The changed fields, nothing is written if there are none
+    """
+    db = fetch_db()
+    doc_ref = db.collection("posts").document(f'{pid}|{session["user"]["uid"]}')
+    current, changes = _update_post(db.transaction(), doc_ref, data, images)
+    if not changes:
+        return changes
+    invalidate_posts({"id": pid, "user_uid": session["user"]["uid"]})
+    invalidate_searches(current.get("country"), changes.get("country"))
+    return changes
@@ -0,0 +1,122 @@
+"""
+This module contains the facet index of the amenity tags of the posts.
+
+Every distinct tag has a bitset with one bit per row of the search index. Amenity
+filters combine the bitsets with bitwise operations, and the facet counts of a
+result set are the population counts of its bitset and-ed with each tag's bitset.
+"""
+import json
+
+import numpy as np
+
+# The tag lists written by the add wizard, see utils.add.tags_data.
+TAG_GROUPS = ["basics", "views", "safety", "standout"]
+# The number of set bits of every byte value.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def facet_key(group, tag):
+    """
+    Build the key of a tag, e.g. "standout:Pool".
+
+    @param group - The tag group
+    @param tag - The tag
+    @return The facet key
+    """
+    return f"{group}:{tag}"
+
+
+def post_tags(doc):
+    """
+    Get the facet keys of the tags of a post.
+
+    @param doc - The post document
+    @return The set of facet keys
+    """
+    tags = doc.get("tags") or {}
+    keys = set()
+    for group in TAG_GROUPS:
+        values = tags.get(group) or []
+        if isinstance(values, str):
+            # Older posts store their tag lists as JSON strings
+            try:
+                values = json.loads(values)
+            except ValueError:
+                values = []
+        keys.update(facet_key(group, tag) for tag in values if isinstance(tag, str))
+    return keys
+
+
+def facet_filter(amenities, match_all=True):
+    """
+    Build the filter for the amenities of a search for documents that are
+    not in the facet index.
+
+    @param amenities - The list of facet keys to filter by
+    @param match_all - If True a post needs all amenities, otherwise any of them
+    @return A function that returns True if a document has the amenities, or None without amenities
+    """
+    if not amenities:
+        return None
+    wanted = set(amenities)
+    if match_all:
+        return lambda doc: wanted <= post_tags(doc)
+    return lambda doc: bool(wanted & post_tags(doc))
+
+
+class FacetIndex:
+    """
+    The bitsets of the tags over the rows of the search index.
+    """
+
+    def __init__(self, rows):
+        """
+        @param rows - The list of the facet key sets of every row
+        """
+        self.size = len(rows)
+        members = {}
+        for row, keys in enumerate(rows):
+            for key in keys:
+                members.setdefault(key, []).append(row)
+        self.bitsets = {}
+        for key, indices in members.items():
+            column = np.zeros(self.size, dtype=bool)
+            column[indices] = True
+            self.bitsets[key] = np.packbits(column)
+
+    def mask(self, amenities, match_all=True):
+        """
+        Find the rows with the given amenities.
+
+        @param amenities - The list of facet keys
+        @param match_all - If True a row needs all amenities, otherwise any of them
+        @return A boolean array over the rows
+        """
+        empty = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        bitsets = [self.bitsets.get(key, empty) for key in amenities]
+        if match_all:
+            bits = np.bitwise_and.reduce(bitsets) if bitsets else ~empty
+        else:
+            bits = np.bitwise_or.reduce(bitsets) if bitsets else empty
+        return np.unpackbits(bits, count=self.size).astype(bool)
+
+    def counts(self, mask):
+        """
+        Count the rows of a result set that have each tag.
+
+        @param mask - A boolean array of the rows in the result set
+        @return A dict of the tag groups to dicts of their tags and counts,
+                tags that no row of the result set has are left out
+        """
+        bits = np.packbits(mask)
+        counts = {}
+        for key, bitset in self.bitsets.items():
+            count = int(POPCOUNT[bitset & bits].sum(dtype=np.int64))
+            if count:
+                group, tag = key.split(":", 1)
+                counts.setdefault(group, {})[tag] = count
+        return {
+            group: dict(sorted(counts[group].items()))
+            for group in TAG_GROUPS
+            if group in counts
+        }
@@ -1,25 +1,127 @@
 """ This file contains all the functions that interact with the Firestore database. """
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Any, List, Tuple
+from typing import Any, List, Optional, Tuple, Union
 
-from firebase_admin import storage
+from firebase_admin import firestore, storage
 from flask import current_app as app
 from flask import session
 from google.cloud.exceptions import GoogleCloudError
-from werkzeug.utils import secure_filename
 
 from config import fetch_db
+from utils.cache import cached, document_cache_name, invalidate
+from utils.blobs import store_image
+from utils.ids import allocate_id
+from utils.ratings import average_rating, has_rating_aggregate
 from utils.render import render_message
 
+logger = logging.getLogger("first_logger")
+
+# Firestore allows at most 30 values in a single "in" query.
+IN_QUERY_LIMIT = 30
+MAX_QUERY_WORKERS = 8
+# Firestore allows at most 500 writes in a single batch.
+BATCH_LIMIT = 500
+# Images of a request are uploaded on at most this many threads.
+MAX_UPLOAD_WORKERS = int(os.getenv("MAX_UPLOAD_WORKERS", "4"))
+# The fields whose query values are converted to numbers, see query_value.
+NUMERIC_FIELDS = {"id", "pid", "property", "reviewed", "price", "maxGuests", "rating"}
+# At most this many reviews, the newest ones, are shown on a property or profile page.
+REVIEWS_LIMIT = int(os.getenv("REVIEWS_LIMIT", "20"))
+
+# Named field projections, e.g. the fields shown on a listing card.
+PROJECTIONS = {
+    "card": [
+        "id",
+        "images",
+        "image_variants",
+        "city",
+        "country",
+        "price",
+        "rating_sum",
+        "rating_count",
+    ],
+}
+
+
+def projection_fields(fields):
+    """
+    Resolve a field projection to a list of field paths.
+
+    @param fields - A list of field paths or the name of a projection in PROJECTIONS
+    @return The list of field paths or None to fetch whole documents
+    """
+    if isinstance(fields, str):
+        return PROJECTIONS[fields]
+    return fields
+
+
+def _stream_batches(query, size):
+    """
+    Stream the results of a query in batches. Each batch is a separate query that
+    starts after the last document of the previous one.
+
+    @param query - The Firestore query to stream
+    @param size - The number of documents per batch
+    @return A generator of document snapshots
+    """
+    last = None
+    while True:
+        batch = query.limit(size)
+        if last is not None:
+            batch = batch.start_after(last)
+        count = 0
+        for snapshot in batch.stream():
+            count += 1
+            last = snapshot
+            yield snapshot
+        # A short batch means the query is exhausted.
+        if count < size:
+            return
+
+
+def query_value(field, value):
+    """
+    Convert the value of a query filter to the type of the field. The values of
+    the numeric fields often come from the url or a form as strings.
+
+    @param field - The field of the filter
+    @param value - The value of the filter, or a list of values
+    @return The value, an int for a numeric field
+    """
+    if isinstance(value, list) or field not in NUMERIC_FIELDS:
+        return value
+    return int(value)
+
 
 @contextmanager
-def firebase_query(collection: str, query: List[Tuple[str, str, Any]]):
+def firebase_query(
+    collection: str,
+    query: List[Tuple[str, str, Any]],
+    order_by: Optional[List[str]] = None,
+    start_after: Optional[dict] = None,
+    limit: Optional[int] = None,
+    fields: Optional[Union[str, List[str]]] = None,
+    stream: bool = False,
+    prefetch: Optional[int] = None,
+    cache: Optional[str] = None,
+):
     """
     Query Firebase and return a generator. This is a generator that can be used to iterate over a collection and query the Firebase database.
 
     @param collection - The name of the collection to query. It must exist.
     @param query - The query to execute. It can be a list of tuples or a single tuple, as per the Firestore API.
+    @param order_by - Fields to order the results by, in ascending order.
+    @param start_after - Field values of the document to start after, used as a page cursor together with order_by.
+    @param limit - The maximum number of documents to return.
+    @param fields - Only fetch these fields of the documents. Either a list of field paths or the name of a projection, such as "card".
+    @param stream - If True yield a generator that reads the documents lazily instead of a list, so only the documents
+                    the caller still holds are kept in memory. It must be consumed inside the with block.
+    @param prefetch - In stream mode read the documents in batches of this size, one query per batch. Ignored if limit is set.
+    @param cache - Cache the results under this scope, see utils.cache.document_cache_name. Only the hot reads
+                   are cached, the results are read from Firestore if it is None. Ignored in stream mode.
 
     @return An iterable of documents that match the query or a 500 if there is a problem connecting to the database.
     """
@@ -30,171 +132,231 @@ def firebase_query(collection: str, query: List[Tuple[str, str, Any]]):
         docs = fetch_db().collection(collection)
         # Find all documents that match the given query.
         for q in query:
-            docs = docs.where(
-                q[0],
-                q[1],
-                int(q[2]) if not isinstance(q[2], List) else q[2],
+            docs = docs.where(q[0], q[1], query_value(q[0], q[2]))
+        for field in order_by or []:
+            docs = docs.order_by(field)
+        if start_after:
+            docs = docs.start_after(start_after)
+        if limit:
+            docs = docs.limit(limit)
+        if fields:
+            docs = docs.select(projection_fields(fields))
+        if stream:
+            snapshots = (
+                _stream_batches(docs, prefetch)
+                if prefetch and not limit
+                else docs.stream()
+            )
+            yield (doc.to_dict() for doc in snapshots)
+        elif cache:
+            yield cached(
+                cache,
+                repr((collection, query, order_by, start_after, limit, fields)),
+                lambda: [doc.to_dict() for doc in docs.stream()],
             )
-        docs = docs.stream()
-        yield [doc.to_dict() for doc in docs]
+        else:
+            yield [doc.to_dict() for doc in docs.stream()]
     except GoogleCloudError:
         return render_message(500, "Cannot connect to database.")
 
 
 @contextmanager
-def firebase_get(collection: str, name: str, partial: bool = False):
+def firebase_get(
+    collection: str,
+    name: str,
+    partial: bool = False,
+    fields: Optional[Union[str, List[str]]] = None,
+    cache: Optional[str] = None,
+):
     """
     Get a document from Firebase. This is a generator that yields the document in dict form.
 
     @param collection - The name of the collection to retrieve from.
     @param name - The name of the document to retrieve.
     @param partial - If True the document will be returned as a Firestore object rather than a dict.
+    @param fields - Only fetch these fields of the document, as for firebase_query.
+    @param cache - The scope the document is cached under, by default the document itself.
 
     @return A dict containing the document or a 500 if there is an error connecting to the database.
     """
     try:
         doc = fetch_db().collection(collection).document(name)
+        cache = cache or document_cache_name(collection, name)
         # Yields a dictionary of the document.
         if partial:
             yield doc
+        elif fields:
+            yield cached(
+                cache,
+                repr((collection, name, fields)),
+                lambda: doc.get(field_paths=projection_fields(fields)).to_dict(),
+            )
         else:
-            yield doc.get().to_dict()
+            yield cached(cache, repr((collection, name)), lambda: doc.get().to_dict())
     except GoogleCloudError:
         return render_message(500, "Cannot connect to database.")
 
 
-def upload_to_bucket(filename):
+def upload_file(image_file, bucket, folder):
     """
-    Uploads a file to Firebase Storage. This is a convenience function for upload_to_bucket and upload_to_bucket_file
+    Upload a single image with its responsive variants under the name of its
+    content, see utils.blobs, and report the outcome instead of raising, so the
+    other images of the same request can still be uploaded.
+
+    @param image_file - The uploaded file, a werkzeug FileStorage
+    @param bucket - The bucket to upload to
+    @param folder - The folder of the bucket to upload to
+
+    @return A dict with the filename and either the url of the upload and the
+            metadata of its variants, or an error message
+    """
+    result = {"filename": image_file.filename}
+    if not image_file.filename or not allowed_file(image_file.filename):
+        result["error"] = "file type not allowed"
+        return result
+    try:
+        result["url"], result["variants"] = store_image(
+            bucket, folder, image_file.stream.read()
+        )
+    except ValueError as err:
+        result["error"] = str(err)
+    except Exception as err:  # pylint: disable=broad-except
+        logger.exception("Cannot upload %s", image_file.filename)
+        result["error"] = str(err) or type(err).__name__
+    return result
 
-    @param filename - Name of file to upload
 
-    @return URL of the uploaded file's public_url which can be used to retrieve the file after it has been
+def upload_files(files):
     """
+    Upload images to Firebase Storage concurrently on a bounded thread pool.
+
+    @param files - A list of uploaded files
+    @return A list with the result of every file in the order of the files, see upload_file
+    """
+    files = [image_file for image_file in files if image_file]
+    if not files:
+        return []
     bucket = storage.bucket()
-    blob = bucket.blob(filename)
-    blob.upload_from_filename(filename)
-    return blob.public_url
+    # The app config is not available on the threads of the pool
+    folder = app.config["UPLOAD_FOLDER"]
+    with ThreadPoolExecutor(
+        max_workers=min(len(files), MAX_UPLOAD_WORKERS)
+    ) as executor:
+        return list(
+            executor.map(
+                lambda image_file: upload_file(image_file, bucket, folder), files
+            )
+        )
 
 
 def upload_images(request):
     """
-    Uploads images to Firebase Storage. This is a wrapper around upload_to_bucket to
+    Uploads images to Firebase Storage. This is a wrapper around upload_files to
     allow upload of mutiple images to Firebase Storage
 
     @param request - The request that contains the list of images to upload.
 
-    @return A list of URL's to the uploaded images. If there are no images an empty list is returned
+    @return A list with the result of every image, see upload_file. If there are no images an empty list is returned
     """
-    urls = []
-    uploaded_files = request.files.getlist("image", None)
+    return upload_files(request.files.getlist("image"))
 
-    # Returns an array of images that are not in the request.
-    if request.files.getlist("image") == []:
-        return []
-
-    # Returns a list of URLs to upload the uploaded files.
-    for image_file in uploaded_files:
-        # Returns a list of URLs to upload the image file to the upload folder.
-        if image_file and allowed_file(image_file.filename):
-            filename = secure_filename(image_file.filename)
-            image_file.save("/".join([app.config["UPLOAD_FOLDER"], filename]))
-            url = upload_to_bucket(
-                "/".join([app.config["UPLOAD_FOLDER"], filename])
-            )
-            os.remove("/".join([app.config["UPLOAD_FOLDER"], filename]))
-            urls.append(url)
-        else:
-            return []
-    return urls
 
+def _chunks(items, size):
+    """
+    Split a list into consecutive chunks of at most size elements.
 
-def update_images(request, id):
+    @param items - The list to split
+    @param size - The maximum length of a chunk
+    @return A list of lists, each one at most size elements long
     """
-    Updates images for a post. This is used to upload images to Firebase Storage
-    and remove them from the database document.
+    return [items[i : i + size] for i in range(0, len(items), size)]
 
-    @param request - Flask request object
-    @param id - The id of the post to update
 
-    @return A list of URLS that were uploaded
+def _fetch_ratings_chunk(ids):
     """
-    urls = []
-    uploaded_files = request.files.getlist("image", None)
+    Fetch the ratings of all reviews for a chunk of properties in a single query.
 
-    # Returns a list of URLs to upload the uploaded files.
-    for image_file in uploaded_files:
-        # Returns a list of URLs to upload the image file to the upload folder.
-        if image_file and allowed_file(image_file.filename):
-            filename = secure_filename(image_file.filename)
-            image_file.save("/".join([app.config["UPLOAD_FOLDER"], filename]))
-            url = upload_to_bucket(
-                "/".join([app.config["UPLOAD_FOLDER"], filename])
-            )
-            os.remove("/".join([app.config["UPLOAD_FOLDER"], filename]))
-            urls.append(url)
-        else:
-            return []
-
-    doc_ref = (
-        fetch_db()
-        .collection("posts")
-        .document(f'{id}|{session["user"]["uid"]}')
+    @param ids - A list of at most IN_QUERY_LIMIT property ids
+    @return A list of ( property id, rating ) tuples
+    """
+    reviews_ref = (
+        fetch_db().collection("reviews").where("reviewed", "in", ids).stream()
     )
-    doc_data = doc_ref.get().to_dict()
-    new_urls = doc_data["images"] + urls
+    ratings = []
+    for doc in reviews_ref:
+        review = doc.to_dict()
+        ratings.append((int(review["reviewed"]), int(review["rating"])))
+    return ratings
 
-    return new_urls
 
+def resolve_avg_ratings(ids):
+    """
+    Get the average ratings of many properties at once. The ids are split into chunks
+    that fit into a Firestore "in" query and the chunks are queried in parallel,
+    so a page of listings costs a few round trips instead of one per listing.
 
-def get_avg_rating(id):
+    @param ids - A list of property ids
+    @return A dict from property id to its average rating, or None if the
+    property has no reviews or an error occurred
     """
-    Get the average rating of a proprety based on it's reviews.
+    ids = list(dict.fromkeys(int(i) for i in ids))
+    if not ids:
+        return {}
+    totals = {i: [0, 0] for i in ids}
+    chunks = _chunks(ids, IN_QUERY_LIMIT)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=min(len(chunks), MAX_QUERY_WORKERS)
+        ) as executor:
+            for ratings in executor.map(_fetch_ratings_chunk, chunks):
+                for pid, rating in ratings:
+                    totals[pid][0] += rating
+                    totals[pid][1] += 1
+    except GoogleCloudError:
+        return {i: None for i in ids}
+    return {
+        pid: rating_sum / count if count > 0 else None
+        for pid, (rating_sum, count) in totals.items()
+    }
 
-    @param id - The id of the review
-    @param testing - Whether or not we are testing the API
 
+def get_avg_rating(id):
+    """
+    Get the average rating of a proprety based on it's reviews.
+    This is a thin wrapper around resolve_avg_ratings.
+    @param id - The id of the property
     @return The average rating or None if there are no reviews
     for the given id or if an error occurred
     """
-    # Returns a list of all the reviews that have been reviewed.
-    try:
-        reviews_ref = (
-            fetch_db()
-            .collection("reviews")
-            .where("reviewed", "==", id)
-            .stream()
-        )
-        review_ids = [int(doc.to_dict()["rating"]) for doc in reviews_ref]
-    except GoogleCloudError:
-        return None
-    avg_rating = (
-        sum(review_ids) / len(review_ids) if len(review_ids) > 0 else None
-    )
-    return avg_rating
+    return resolve_avg_ratings([id])[int(id)]
 
 
 def get_avg_ratings(docs):
     """
-    Get the average ratings for a list of documents. This is a convenience function for get_avg_rating.
-
+    Get the average ratings for a list of documents. Documents that carry a rating
+    aggregate are read directly, the rest are resolved together with resolve_avg_ratings.
     @param docs - A list of documents to get the average ratings for
-
     @return docs - The list of documents with the average ratings added to them
     """
-
+    ratings = resolve_avg_ratings(
+        [doc["id"] for doc in docs if not has_rating_aggregate(doc)]
+    )
     for doc in docs:
-        doc["avg_rating"] = get_avg_rating(int(doc["id"]))
+        if has_rating_aggregate(doc):
+            doc["avg_rating"] = average_rating(doc)
+        else:
+            doc["avg_rating"] = ratings[int(doc["id"])]
     return docs
 
 
-def get_ratings_property(id):
+def get_ratings_property(id, limit=REVIEWS_LIMIT):
     """
-    Get ratings for a reviewed property. This is a list of dictionaries
+    Get the newest reviews of a property. This is a list of dictionaries
     that contain information about the reviews.
 
     @param id - ID of the review. This can be any integer or a string
     that uniquely identifies a review.
+    @param limit - The maximum number of reviews to return
 
     @return A list of dictionaries that contain information about the propetry reviews.
     """
@@ -202,83 +364,120 @@ def get_ratings_property(id):
         fetch_db()
         .collection("reviews")
         .where("reviewed", "==", int(id))
+        .order_by("timestamp", direction=firestore.Query.DESCENDING)
+        .limit(limit)
         .stream()
     )
     ratings = [doc.to_dict() for doc in reviews_ref]
     return ratings
 
 
-def get_ratings_user(uid):
+def _fetch_reviews_chunk(ids, limit):
     """
-    Get ratings for a user among all his properties.
-    This is a list of dictionaries with one dictionary per review.
-
-    @param uid - user id to get ratings for
+    Fetch the newest reviews for a chunk of properties in a single query.
 
-    @return list of dictionaries with one dictionary per review or an
-    empty list if there are no ratings for the user.
+    @param ids - A list of at most IN_QUERY_LIMIT property ids
+    @param limit - The maximum number of reviews to return
+    @return A list of review dictionaries, newest first
     """
-    try:
-        posts_ref = (
-            fetch_db()
-            .collection("posts")
-            .where("user_uid", "==", uid)
-            .stream()
-        )
-        user_posts = [int(doc.to_dict()["id"]) for doc in posts_ref]
-        reviews_ref = (
-            fetch_db()
-            .collection("reviews")
-            .where("reviewed", "in", user_posts)
-            .stream()
-        )
-        reviews = [doc.to_dict() for doc in reviews_ref]
-        ratings = [review["rating"] for review in reviews]
-        avg_rating = sum(ratings) / len(ratings) if len(ratings) > 0 else 0
-    except GoogleCloudError:
-        return []
-    return reviews, avg_rating
+    reviews_ref = (
+        fetch_db()
+        .collection("reviews")
+        .where("reviewed", "in", ids)
+        .order_by("timestamp", direction=firestore.Query.DESCENDING)
+        .limit(limit)
+        .stream()
+    )
+    return [doc.to_dict() for doc in reviews_ref]
 
 
-def add_to_firestore(data, collection):
+def _rating_totals(docs):
     """
-    Add a document to firestore.
+    Sum up the ratings of several posts. Posts that carry a rating aggregate are
+    read directly, only the reviews of the rest are fetched.
 
-    @param data - The data to add to firestore. It should be a dictionary.
+    @param docs - A list of post documents
+    @return A ( sum of the ratings, number of reviews ) tuple
     """
-    # Get a reference to the document collection
-    ref = fetch_db().collection(collection)
-    count = len(ref.get()) + 1
-    data["id"] = count
-    session["user"]["creation_id"] = count
-    # Create a document
-    doc_ref = ref.document(str(count) + "|" + str(session["user"]["uid"]))
-    doc_ref.set(data)
+    rating_sum, count = 0, 0
+    for doc in docs:
+        if has_rating_aggregate(doc):
+            rating_sum += doc["rating_sum"]
+            count += doc["rating_count"]
+    legacy = [int(doc["id"]) for doc in docs if not has_rating_aggregate(doc)]
+    for chunk in _chunks(legacy, IN_QUERY_LIMIT):
+        for _, rating in _fetch_ratings_chunk(chunk):
+            rating_sum += rating
+            count += 1
+    return rating_sum, count
+
+
+def get_ratings_user(docs, limit=REVIEWS_LIMIT):
+    """
+    Get the ratings of a user among all his properties. The average and the number
+    of reviews come from the rating aggregates of the posts, only the newest
+    reviews are fetched.
 
+    @param docs - The posts of the user, with their rating aggregates
+    @param limit - The maximum number of reviews to return
 
-def update_firestore(data, did, collection, images=False):
+    @return A ( reviews, average rating, number of reviews ) tuple, the reviews are
+    a list of dictionaries with one dictionary per review, newest first.
     """
-    Update a document in Firestore.
+    ids = list(dict.fromkeys(int(doc["id"]) for doc in docs))
+    chunks = _chunks(ids, IN_QUERY_LIMIT)
+    try:
+        rating_sum, count = _rating_totals(docs)
+        reviews = []
+        if chunks:
+            with ThreadPoolExecutor(
+                max_workers=min(len(chunks), MAX_QUERY_WORKERS)
+            ) as executor:
+                for chunk_reviews in executor.map(
+                    lambda chunk: _fetch_reviews_chunk(chunk, limit), chunks
+                ):
+                    reviews.extend(chunk_reviews)
+    except GoogleCloudError:
+        return [], 0, 0
+    reviews.sort(key=lambda review: review["timestamp"], reverse=True)
+    avg_rating = rating_sum / count if count > 0 else 0
+    return reviews[:limit], avg_rating, count
 
-    @param data - The data to update.
-    @param id - The id of the document that needs to be updated.
-    @param collection - The collection to update the document in.
-    @param images - If True add the images to the document. If False add the images
+
+def batched_updates(updates):
     """
-    # Get a reference to the document collection
-    doc_ref = (
-        fetch_db()
-        .collection(collection)
-        .document(f'{did}|{session["user"]["uid"]}')
-    )
-    # Add images to the images array
-    if images is True:
-        doc_data = doc_ref.get().to_dict()
-        try:
-            data["images"] += doc_data["images"]
-        except GoogleCloudError:
-            pass
-    doc_ref.update(data)
+    Write updates to many documents in batched writes of at most BATCH_LIMIT updates each.
+
+    @param updates - An iterable of ( document reference, fields to update ) tuples,
+                     it is read lazily, so the documents can be streamed
+    @return The number of updated documents
+    """
+    db = fetch_db()
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for doc_ref, data in updates:
+        batch.update(doc_ref, data)
+        pending += 1
+        updated += 1
+        # Commit the batch once it is full.
+        if pending == BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending > 0:
+        batch.commit()
+    return updated
+
+
+def next_id(collection):
+    """
+    Get the id for a new document in a collection. The id is handed out by
+    the collection's counter document instead of counting the collection.
+    @param collection - The collection the document will be added to
+    @return The next free id
+    """
+    return allocate_id(collection)
 
 
 def add_favorite(data):
@@ -293,6 +492,7 @@ def add_favorite(data):
         ref = fetch_db().collection("fav")
         doc_ref = ref.document(session["user"]["uid"])
         doc_ref.set(data)
+        invalidate(document_cache_name("fav", session["user"]["uid"]))
         return "Success", 200
     except GoogleCloudError:
         return Exception, 404
@@ -311,6 +511,7 @@ def update_favorites(data):
     try:
         doc_ref = fetch_db().collection("fav").document(session["user"]["uid"])
         doc_ref.update(data)
+        invalidate(document_cache_name("fav", session["user"]["uid"]))
     except GoogleCloudError:
         return Exception, 404
 
@@ -326,7 +527,4 @@ def allowed_file(filename):
     extension must be lower case
     """
     allowed_extensions = ["png", "jpg", "jpeg", "gif", "webp"]
-    return (
-        "." in filename
-        and filename.rsplit(".", 1)[1].lower() in allowed_extensions
-    )
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed_extensions
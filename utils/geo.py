@@ -0,0 +1,474 @@
+"""
+This module geocodes the addresses of the posts and answers radius and
+bounding box queries over their coordinates.
+
+Addresses are geocoded offline with the gazetteer in data/cities.csv.gz, the
+cities with more than 15000 inhabitants from GeoNames (https://www.geonames.org,
+CC BY 4.0). Names are matched without case, accents and punctuation, and the
+local names of large cities, e.g. "Praha" or "München", are looked up in
+data/alternate_names.csv. Every post gets its coordinates and their geohash when its address
+is written. Queries look up the geohash prefixes of the cells covering the
+query area in a sorted array, and check the candidates with the haversine distance.
+"""
+import csv
+import gzip
+import logging
+import math
+import os
+from bisect import bisect_left
+from functools import lru_cache
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from config import fetch_db
+from utils.cache import invalidate_posts, invalidate_searches
+from utils.countries import countries
+from utils.firebase import batched_updates
+from utils.text_index import tokenize
+
+GAZETTEER_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "data",
+    "cities.csv.gz",
+)
+ALTERNATE_NAMES_PATH = os.path.join(
+    os.path.dirname(GAZETTEER_PATH), "alternate_names.csv"
+)
+# Letters that Unicode does not decompose into a base letter and an accent.
+ASCII_FOLDING = str.maketrans(
+    {"ł": "l", "ø": "o", "đ": "d", "ħ": "h", "ı": "i", "æ": "ae", "œ": "oe", "þ": "th"}
+)
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0088
+DEFAULT_RADIUS_KM = 25
+MAX_RADIUS_KM = 500
+# A query looks up at most this many geohash cells, a single character
+# geohash has 32 cells, so any area can be covered.
+MAX_CELLS = 32
+
+logger = logging.getLogger("first_logger")
+
+
+def encode_geohash(lat, lng, precision=GEOHASH_PRECISION):
+    """
+    Encode coordinates as a geohash.
+
+    @param lat - The latitude in degrees
+    @param lng - The longitude in degrees
+    @param precision - The number of characters of the geohash
+    @return The geohash
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, bounds = (lng, lng_range) if even else (lat, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            bounds[0] = middle
+        else:
+            bits *= 2
+            bounds[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Get the great circle distance between coordinates. Works with NumPy arrays.
+
+    @param lat1, lng1 - The first coordinates in degrees
+    @param lat2, lng2 - The second coordinates in degrees
+    @return The distance in kilometers
+    """
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _place_key(name):
+    """
+    Normalize the name of a place, e.g. "  Zürich " to "zurich" and "Łódź" to "lodz".
+
+    @param name - The name
+    @return The lookup key
+    """
+    return " ".join(tokenize(name or "")).translate(ASCII_FOLDING)
+
+
+# Other names of the countries, and countries missing from the list of the search.
+COUNTRY_ALIASES = {
+    "Czechia": "CZ",
+    "United States": "US",
+    "USA": "US",
+    "UK": "GB",
+    "Great Britain": "GB",
+    "England": "GB",
+    "Scotland": "GB",
+    "Wales": "GB",
+    "Holland": "NL",
+    "The Netherlands": "NL",
+    "Ivory Coast": "CI",
+    "Cape Verde": "CV",
+    "Burma": "MM",
+    "Macedonia": "MK",
+    "Korea": "KR",
+    "Russian Federation": "RU",
+    "Viet Nam": "VN",
+    "UAE": "AE",
+    "Turkey": "TR",
+    "Türkiye": "TR",
+}
+COUNTRY_CODES = {
+    _place_key(name): code for name, code in [*COUNTRY_ALIASES.items(), *countries]
+}
+
+
+def country_code(country):
+    """
+    Get the ISO 3166-1 alpha-2 code of a country.
+
+    @param country - The name or code of the country
+    @return The code, or None if the country is unknown
+    """
+    key = _place_key(country)
+    if key.upper() in COUNTRY_CODES.values():
+        return key.upper()
+    return COUNTRY_CODES.get(key)
+
+
+@lru_cache(maxsize=None)
+def _gazetteer():
+    """
+    Load the gazetteer with the alternate names of its cities, once per process.
+
+    @return A dict of (country code, place key) to (latitude, longitude),
+            the most populous city if several share a name. A name of a city
+            takes precedence over an alternate name of another one
+    """
+    places = {}
+    aliases = {}
+
+    def add(table, key, point):
+        if key not in table or point[2] > table[key][2]:
+            table[key] = point
+
+    with gzip.open(GAZETTEER_PATH, "rt", encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            point = (float(row["lat"]), float(row["lng"]), int(row["population"]))
+            name = _place_key(row["name"])
+            add(places, (row["country"], name), point)
+            # "New York City" is also found as "New York"
+            if name.endswith(" city"):
+                add(aliases, (row["country"], name[: -len(" city")]), point)
+    with open(ALTERNATE_NAMES_PATH, encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            point = places.get((row["country"], _place_key(row["name"])))
+            if point:
+                add(aliases, (row["country"], _place_key(row["alternate"])), point)
+    return {key: (lat, lng) for key, (lat, lng, _) in {**aliases, **places}.items()}
+
+
+def geocode(city, country, district=None):
+    """
+    Find the coordinates of an address in the gazetteer.
+
+    @param city - The city
+    @param country - The country name or code
+    @param district - The district, tried if the city is not in the gazetteer
+    @return A tuple of the latitude and longitude, or None if the place is unknown
+    """
+    code = country_code(country)
+    if code is None:
+        return None
+    places = _gazetteer()
+    for name in (city, district):
+        if name and name != "None":
+            point = places.get((code, _place_key(name)))
+            if point:
+                return point
+    return None
+
+
+def geocode_place(place, country=None):
+    """
+    Find the coordinates of a place typed into the search, e.g. "Lyon" or "Lyon, France".
+
+    @param place - The place
+    @param country - The country of the search, used if the place names none
+    @return A tuple of the latitude and longitude, or None if the place is unknown
+    """
+    city, _, rest = place.partition(",")
+    if rest.strip() and country_code(rest):
+        country = rest
+    return geocode(city, country) if country else None
+
+
+def location_data(city, country, district=None):
+    """
+    Build the location fields of a post from its address.
+
+    @param city - The city
+    @param country - The country
+    @param district - The district
+    @return A dict with the latitude, longitude and geohash, which are None if
+            the address is not in the gazetteer, so an edit clears old coordinates
+    """
+    point = geocode(city, country, district)
+    if point is None:
+        return {"lat": None, "lng": None, "geohash": None}
+    lat, lng = point
+    return {"lat": lat, "lng": lng, "geohash": encode_geohash(lat, lng)}
+
+
+def geocode_posts():
+    """
+    Geocode the posts that have no location, because they were written before
+    the locations were recorded or their address was not found. The posts are
+    updated in batched writes, the addresses that are still not found are logged.
+
+    @return A tuple of the number of updated posts and the ids of the posts
+            whose address is not in the gazetteer
+    """
+    unknown = []
+    written = []
+
+    def updates():
+        for doc in fetch_db().collection("posts").stream():
+            post = doc.to_dict()
+            if post.get("geohash") or "country" not in post:
+                continue
+            data = location_data(
+                post.get("city"), post["country"], post.get("district")
+            )
+            if data["geohash"] is None:
+                logger.warning(
+                    "Cannot geocode post %s: %s, %s, %s",
+                    post.get("id", doc.id),
+                    post.get("city"),
+                    post.get("district"),
+                    post["country"],
+                )
+                unknown.append(post.get("id", doc.id))
+                continue
+            written.append(post)
+            yield doc.reference, data
+
+    updated = batched_updates(updates())
+    invalidate_posts(*written)
+    invalidate_searches(*(post["country"] for post in written))
+    return updated, unknown
+
+
+@click.command("geocode-posts")
+@with_appcontext
+def geocode_command():
+    """Record the locations of the posts that have none."""
+    updated, unknown = geocode_posts()
+    click.echo(f"Geocoded {updated} posts.")
+    if unknown:
+        click.echo(f"Posts with an unknown address: {', '.join(map(str, unknown))}")
+
+
+def radius_box(lat, lng, radius_km):
+    """
+    Get the bounding box of a circle.
+
+    @param lat, lng - The center in degrees
+    @param radius_km - The radius in kilometers
+    @return A tuple of south, west, north, east, where west > east if the box
+            crosses the antimeridian
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    south = max(-90.0, lat - math.degrees(angle))
+    north = min(90.0, lat + math.degrees(angle))
+    ratio = math.sin(angle) / max(math.cos(math.radians(lat)), 1e-12)
+    if south == -90.0 or north == 90.0 or ratio >= 1:
+        # The circle contains a pole, so it spans every longitude
+        return south, -180.0, north, 180.0
+    delta = math.degrees(math.asin(ratio))
+    west = lng - delta if lng - delta >= -180 else lng - delta + 360
+    east = lng + delta if lng + delta <= 180 else lng + delta - 360
+    return south, west, north, east
+
+
+def _cell_size(precision):
+    """
+    @param precision - The number of characters of a geohash
+    @return The height and width of its cells in degrees
+    """
+    lat_bits = precision * 5 // 2
+    lng_bits = precision * 5 - lat_bits
+    return 180.0 / 2**lat_bits, 360.0 / 2**lng_bits
+
+
+def _cell_range(low, high, size, offset, count):
+    """
+    @return The indices of the cells of size covering low to high
+    """
+    first = int((low + offset) // size)
+    last = min(int((high + offset) // size), count - 1)
+    return range(first, last + 1)
+
+
+def covering_cells(south, west, north, east):
+    """
+    Find the geohash prefixes of the cells that cover a bounding box, with the
+    longest prefix for which at most MAX_CELLS cells are needed.
+
+    @param south, west, north, east - The box in degrees, west > east if it crosses the antimeridian
+    @return The list of geohash prefixes
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = _cell_size(precision)
+        columns = round(360 / width)
+        rows = _cell_range(south, north, height, 90, round(180 / height))
+        if west <= east:
+            spans = [_cell_range(west, east, width, 180, columns)]
+        else:
+            spans = [
+                _cell_range(west, 180, width, 180, columns),
+                _cell_range(-180, east, width, 180, columns),
+            ]
+        if len(rows) * sum(len(span) for span in spans) <= MAX_CELLS:
+            break
+    return [
+        encode_geohash(
+            (row + 0.5) * height - 90, (column + 0.5) * width - 180, precision
+        )
+        for row in rows
+        for span in spans
+        for column in span
+    ]
+
+
+def in_box(lat, lng, south, west, north, east):
+    """
+    Check if coordinates are inside a bounding box. Works with NumPy arrays.
+
+    @return True if the coordinates are inside the box
+    """
+    inside_lat = (lat >= south) & (lat <= north)
+    if west <= east:
+        return inside_lat & (lng >= west) & (lng <= east)
+    return inside_lat & ((lng >= west) | (lng <= east))
+
+
+def posts_in_box(south, west, north, east, fields):
+    """
+    Read the posts inside a bounding box from Firestore, with one range query
+    on the geohash per cell covering the box.
+
+    @param south, west, north, east - The box in degrees, west > east if it crosses the antimeridian
+    @param fields - The fields of the posts to read
+    @return A list of the posts inside the box
+    """
+    posts = fetch_db().collection("posts")
+    docs = []
+    for prefix in covering_cells(south, west, north, east):
+        # "~" sorts after every geohash character
+        query = posts.where("geohash", ">=", prefix).where("geohash", "<", f"{prefix}~")
+        for doc in query.select(fields).stream():
+            post = doc.to_dict()
+            if post.get("lat") is None or post.get("lng") is None:
+                continue
+            if in_box(post["lat"], post["lng"], south, west, north, east):
+                docs.append(post)
+    return docs
+
+
+def near_filter(near):
+    """
+    Build the filter of a radius search for documents that are not in the geo index.
+
+    @param near - A tuple of the latitude, longitude and radius in kilometers
+    @return A function that returns True if a document is inside the circle, or None without near
+    """
+    if not near:
+        return None
+    lat, lng, radius_km = near
+
+    def matches(doc):
+        if doc.get("lat") is None or doc.get("lng") is None:
+            return False
+        return haversine_km(lat, lng, doc["lat"], doc["lng"]) <= radius_km
+
+    return matches
+
+
+class GeoIndex:
+    """
+    The coordinates of the rows of the search index with their geohashes sorted.
+    """
+
+    def __init__(self, points):
+        """
+        @param points - The list of the (latitude, longitude) of every row, None for rows without a location
+        """
+        self.size = len(points)
+        self.lat = np.full(self.size, np.nan)
+        self.lng = np.full(self.size, np.nan)
+        hashed = []
+        for row, point in enumerate(points):
+            if point is None:
+                continue
+            self.lat[row], self.lng[row] = point
+            hashed.append((encode_geohash(*point), row))
+        hashed.sort()
+        self._hashes = [geohash for geohash, _ in hashed]
+        self._rows = np.array([row for _, row in hashed], dtype=np.int64)
+
+    def _candidates(self, south, west, north, east):
+        """
+        @return The rows in the geohash cells covering a bounding box
+        """
+        ranges = []
+        for prefix in covering_cells(south, west, north, east):
+            # "~" sorts after every geohash character
+            start = bisect_left(self._hashes, prefix)
+            end = bisect_left(self._hashes, prefix + "~", start)
+            if end > start:
+                ranges.append(self._rows[start:end])
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+    def box(self, south, west, north, east):
+        """
+        Find the rows inside a bounding box.
+
+        @param south, west, north, east - The box in degrees, west > east if it crosses the antimeridian
+        @return A boolean array over the rows
+        """
+        rows = self._candidates(south, west, north, east)
+        mask = np.zeros(self.size, dtype=bool)
+        inside = in_box(self.lat[rows], self.lng[rows], south, west, north, east)
+        mask[rows[inside]] = True
+        return mask
+
+    def radius(self, lat, lng, radius_km):
+        """
+        Find the rows within a distance of a point.
+
+        @param lat, lng - The center in degrees
+        @param radius_km - The distance in kilometers
+        @return A boolean array over the rows
+        """
+        rows = self._candidates(*radius_box(lat, lng, radius_km))
+        mask = np.zeros(self.size, dtype=bool)
+        distance = haversine_km(lat, lng, self.lat[rows], self.lng[rows])
+        mask[rows[distance <= radius_km]] = True
+        return mask
@@ -1,9 +1,27 @@
-""" This module is used to get travel tips from Bing AI. """
+"""
+This module is used to get travel tips from Bing AI.
+
+Every worker runs a background thread with its own event loop, which keeps a
+small pool of warm Sydney conversations. Requests submit their questions to it
+through the sync facade in get_travel_tips, so connection setup happens between
+requests instead of during them.
+"""
 import asyncio
+import concurrent.futures
+import logging
+import os
+import queue
 import re
+import threading
+import time
 
 from sydney import SydneyClient
 
+POOL_SIZE = int(os.getenv("SYDNEY_POOL_SIZE", "2"))
+TIPS_TIMEOUT = float(os.getenv("TIPS_TIMEOUT", "60"))
+
+logger = logging.getLogger("first_logger")
+
 
 def parse_response(text):
     """
@@ -16,40 +34,243 @@ def parse_response(text):
     pattern = re.compile(
         r"^\d+\.\s+(?:(?!\[\^\d+\^\]).)+", re.MULTILINE | re.DOTALL
     )
-
     matches = pattern.findall(text)
-
     return matches[0].split("\n")
 
 
-async def main(text) -> None:
+def parse_tip(line):
+    """
+    Parse a single line of a response. This is the incremental counterpart of
+    L { parse_response } used while the response is streamed.
+
+    @param line - A complete line of the response text.
+
+    @return The list item without citations, or None if the line is not a numbered list item.
+    """
+    line = re.sub(r"\[\^\d+\^\]", "", line).strip()
+    return line if re.match(r"^\d+\.\s+", line) else None
+
+
+def tips_prompt(text):
+    """
+    Build the question for Bing AI about the places to visit near a location.
+
+    @param text - The location to search for.
+
+    @return The prompt.
+    """
+    return f"""What are the top 10 places to visit in 50 km range of: {text},
+                                    in numbered list format and without any description.
+                                    If you want to include tags, such as 'Historical Landmark',
+                                    separate them with the '|' symbol."""
+
+
+async def main(sydney, text) -> None:
     """
     Asks Bing AI (SydneyClient) for information about the top 10
     places to visit in 50 km range of a location.
 
+    @param sydney - A SydneyClient with a started conversation.
     @param text - The location to search for.
 
     @return The parsed response.
     """
-    async with SydneyClient() as sydney:
-        response = await sydney.ask(
-            f"""What are the top 10 places to visit in 50 km range of: {text},
-                                    in numbered list format and without any description.
-                                    If you want to include tags, such as 'Historical Landmark',
-                                    separate them with the '|' symbol.""",
-            citations=False,
+    response = await sydney.ask(tips_prompt(text), citations=False)
+    return parse_response(response)
+
+
+async def stream_tips(sydney, text):
+    """
+    Asks Bing AI (SydneyClient) for the top 10 places to visit in 50 km range of a
+    location, like L { main }, and yields every list item as soon as its line is complete.
+
+    @param sydney - A SydneyClient with a started conversation.
+    @param text - The location to search for.
+
+    @return An async generator of list items.
+    """
+    buffer = ""
+    async for token in sydney.ask_stream(tips_prompt(text), citations=False):
+        buffer += token
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            tip = parse_tip(line)
+            if tip:
+                yield tip
+    tip = parse_tip(buffer)
+    if tip:
+        yield tip
+
+
+class SydneyPool:
+    """
+    An event loop in a background thread that owns a pool of warm Sydney conversations.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._idle = None
+        self._created = 0
+
+    def _ensure_started(self):
+        """
+        Start the event loop thread, also after the worker was forked.
+
+        @return The running event loop
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._idle = asyncio.Queue()
+                self._created = 0
+                threading.Thread(
+                    target=self._loop.run_forever, name="sydney-pool", daemon=True
+                ).start()
+                self._pid = os.getpid()
+            return self._loop
+
+    async def _acquire(self):
+        """
+        Take a warm conversation from the pool, starting a new one while the pool is not full.
+
+        @return A SydneyClient with a started conversation
+        """
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            sydney = SydneyClient()
+            try:
+                await sydney.start_conversation()
+            except BaseException:
+                self._created -= 1
+                raise
+            return sydney
+        return await self._idle.get()
+
+    async def _recycle(self, sydney):
+        """
+        Start a fresh conversation on a used client and put it back into the pool.
+        This runs after the answer was returned, outside of the request.
+
+        @param sydney - The used SydneyClient
+        """
+        try:
+            await sydney.reset_conversation()
+            self._idle.put_nowait(sydney)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Cannot start a new Sydney conversation")
+            self._created -= 1
+            await sydney.close_conversation()
+
+    async def _run(self, func, *args):
+        """
+        Run a coroutine function with a conversation from the pool.
+
+        @param func - A coroutine function that takes the SydneyClient as its first argument
+        @param args - The other arguments of func
+        @return The result of func
+        """
+        sydney = await self._acquire()
+        try:
+            return await func(sydney, *args)
+        finally:
+            self._loop.create_task(self._recycle(sydney))
+
+    def submit(self, func, *args, timeout=TIPS_TIMEOUT):
+        """
+        Run a coroutine function with a conversation from the pool and wait for its result.
+
+        @param func - A coroutine function that takes the SydneyClient as its first argument
+        @param args - The other arguments of func
+        @param timeout - How many seconds to wait for the result
+        @return The result of func
+        """
+        loop = self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(self._run(func, *args), loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stream(self, func, *args, timeout=TIPS_TIMEOUT):
+        """
+        Run an async generator function with a conversation from the pool and
+        yield its items as they are produced.
+
+        @param func - An async generator function that takes the SydneyClient as its first argument
+        @param args - The other arguments of func
+        @param timeout - How many seconds to wait for all items
+        @return A generator of the items of func
+        """
+        loop = self._ensure_started()
+        items = queue.Queue()
+        done = object()
+
+        async def produce(sydney, *args):
+            async for item in func(sydney, *args):
+                items.put(item)
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(produce, *args), loop
         )
-        print(response)
-        matching = parse_response(response)
-        return matching
+        future.add_done_callback(lambda _: items.put(done))
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                try:
+                    item = items.get(
+                        timeout=max(0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    raise concurrent.futures.TimeoutError() from None
+                if item is done:
+                    # Raise the error of func, if there was one
+                    future.result()
+                    return
+                yield item
+        finally:
+            # Stop asking if the caller went away early
+            future.cancel()
+
+
+pool = SydneyPool()
+
 
+def get_travel_tips(text, timeout=TIPS_TIMEOUT):
+    """
+    Get the travel tips for a location from Bing AI. This is a sync facade for L { main }
+    that runs it on the background event loop of the worker.
+
+    @param text - The location to search for.
+    @param timeout - How many seconds to wait for Bing AI.
 
-def get_travel_tips(text):
+    @return The list of tips, empty if Bing AI did not answer in time or failed.
     """
-    This is just an async wrapper for L { main }.
+    try:
+        return pool.submit(main, text, timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        logger.warning("Bing AI did not answer in %s seconds", timeout)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot get travel tips from Bing AI")
+    return []
+
 
-    @param text - text to parse and run
+def stream_travel_tips(text, timeout=TIPS_TIMEOUT):
+    """
+    Stream the travel tips for a location from Bing AI. This is a sync facade for
+    L { stream_tips } that runs it on the background event loop of the worker.
+
+    @param text - The location to search for.
+    @param timeout - How many seconds to wait for the whole answer.
 
-    @return the same thing as L { main }
+    @return A generator of tips. It stops early if Bing AI fails or does not answer in time.
     """
-    return asyncio.run(main(text))
+    try:
+        yield from pool.stream(stream_tips, text, timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        logger.warning("Bing AI did not answer in %s seconds", timeout)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot get travel tips from Bing AI")
@@ -0,0 +1,102 @@
+""" This module hands out ids for new documents from counter documents in Firestore. """
+import os
+import threading
+
+from firebase_admin import firestore
+
+from config import fetch_db
+
+COUNTERS = "counters"
+# Every worker reserves this many ids at once to save round trips to the counter.
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "10"))
+
+
+def _max_id(transaction, collection):
+    """
+    Find the highest id in use in a collection. Used to seed a missing counter.
+
+    @param transaction - The Firestore transaction to read in
+    @param collection - The collection to look in
+    @return The highest id or 0 if the collection is empty
+    """
+    docs = transaction.get(
+        fetch_db()
+        .collection(collection)
+        .order_by("id", direction=firestore.Query.DESCENDING)
+        .limit(1)
+    )
+    for doc in docs:
+        return int(doc.to_dict()["id"])
+    return 0
+
+
+@firestore.transactional
+def _reserve_block(transaction, collection, size):
+    """
+    Reserve a block of consecutive ids in the counter document of a collection.
+
+    @param transaction - The Firestore transaction to run in
+    @param collection - The collection to reserve ids for
+    @param size - The number of ids to reserve
+    @return The first id of the reserved block
+    """
+    counter_ref = fetch_db().collection(COUNTERS).document(collection)
+    snapshot = counter_ref.get(transaction=transaction)
+    if snapshot.exists:
+        last_id = int(snapshot.get("last_id"))
+    else:
+        last_id = _max_id(transaction, collection)
+    transaction.set(counter_ref, {"last_id": last_id + size})
+    return last_id + 1
+
+
+class IdAllocator:
+    """
+    Hands out ids for one collection from blocks reserved in its counter document.
+    Ids are unique across workers, but not necessarily consecutive, since
+    a worker that exits drops the rest of its block.
+    """
+
+    def __init__(self, collection, block_size=ID_BLOCK_SIZE):
+        self.collection = collection
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+
+    def allocate(self):
+        """
+        Get the next free id, reserving a new block when the current one runs out.
+
+        @return A new unique id
+        """
+        with self._lock:
+            # A forked worker must not reuse the block of its parent.
+            if self._pid != os.getpid() or self._next >= self._end:
+                start = _reserve_block(
+                    fetch_db().transaction(), self.collection, self.block_size
+                )
+                self._pid = os.getpid()
+                self._next = start
+                self._end = start + self.block_size
+            self._next += 1
+            return self._next - 1
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def allocate_id(collection):
+    """
+    Get a new unique id for a document in a collection.
+
+    @param collection - The collection the document will be added to
+    @return A new unique id
+    """
+    with _allocators_lock:
+        if collection not in _allocators:
+            _allocators[collection] = IdAllocator(collection)
+        allocator = _allocators[collection]
+    return allocator.allocate()
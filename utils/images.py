@@ -0,0 +1,235 @@
+"""
+This module makes the responsive variants of the images of the posts.
+
+Every uploaded image is resized to the widths in VARIANT_WIDTHS, up to its own
+width, and encoded in every format of VARIANT_FORMATS. The variants are stored
+next to the original and named after it, e.g. "room.jpg" gets "room-640w.avif",
+so a post only keeps their widths and formats, together with a tiny blurred
+placeholder that is shown while the image loads. The images are resized in a
+pool of processes, so the request threads are neither blocked by the GIL nor
+by each other. The hero images in static/img get the same variants with the
+resize-static-images command.
+"""
+import base64
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+import click
+from flask import url_for
+from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError
+
+VARIANT_WIDTHS = [320, 640, 1024, 1600]
+# The formats in the order the browser should prefer them, with their encoder options.
+VARIANT_FORMATS = {
+    "avif": {"quality": 50, "speed": 8},
+    "webp": {"quality": 75, "method": 4},
+}
+PLACEHOLDER_WIDTH = 16
+# The number of processes that resize images, 0 resizes on the calling thread.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+STATIC_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static"
+)
+STATIC_MANIFEST = os.path.join(STATIC_FOLDER, "img", "variants.json")
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def variant_name(name, width, fmt):
+    """
+    Get the name of a variant of an image, e.g. "static/uploads/room-640w.avif".
+
+    @param name - The name or url of the original image
+    @param width - The width of the variant
+    @param fmt - The format of the variant, a key of VARIANT_FORMATS
+    @return The name or url of the variant
+    """
+    head, _, tail = name.rpartition("/")
+    stem = tail.rsplit(".", 1)[0] if "." in tail else tail
+    return f"{head}/{stem}-{width}w.{fmt}" if head else f"{stem}-{width}w.{fmt}"
+
+
+def make_variants(data):
+    """
+    Resize an image to its variants. This runs in the processes of the pool.
+
+    @param data - The bytes of the image
+    @return A tuple of the metadata of the variants, with the width and height of
+            the image, the widths and formats of the variants and the placeholder
+            as a data URI, and a dict from (width, format) to the bytes of the variant
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            image = ImageOps.exif_transpose(original)
+            transparent = (
+                image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+            )
+            image = image.convert("RGBA" if transparent else "RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as err:
+        raise ValueError("not a valid image") from err
+    width, height = image.size
+    widths = sorted({min(variant, width) for variant in VARIANT_WIDTHS})
+    files = {}
+    for variant in widths:
+        resized = (
+            image
+            if variant == width
+            else image.resize(
+                (variant, max(1, round(height * variant / width))),
+                Image.Resampling.LANCZOS,
+            )
+        )
+        for fmt, options in VARIANT_FORMATS.items():
+            output = io.BytesIO()
+            resized.save(output, fmt.upper(), **options)
+            files[(variant, fmt)] = output.getvalue()
+    thumbnail = image.resize(
+        (PLACEHOLDER_WIDTH, max(1, round(height * PLACEHOLDER_WIDTH / width))),
+        Image.Resampling.BILINEAR,
+    ).filter(ImageFilter.GaussianBlur(1))
+    output = io.BytesIO()
+    thumbnail.save(output, "WEBP", quality=30)
+    placeholder = base64.b64encode(output.getvalue()).decode("ascii")
+    meta = {
+        "width": width,
+        "height": height,
+        "widths": widths,
+        "formats": list(VARIANT_FORMATS),
+        "placeholder": f"data:image/webp;base64,{placeholder}",
+    }
+    return meta, files
+
+
+def _executor():
+    """
+    Get the process pool of the worker, created again after the worker was forked.
+
+    @return The ProcessPoolExecutor
+    """
+    global _pool, _pool_pid  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Spawned processes do not inherit the threads of the Firestore listeners
+            _pool = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def process_image(data):
+    """
+    Resize an image to its variants in the process pool, see make_variants.
+
+    @param data - The bytes of the image
+    @return A tuple of the metadata and the files of the variants
+    @raise ValueError - If the data is not an image
+    """
+    global _pool  # pylint: disable=global-statement
+    if IMAGE_WORKERS <= 0:
+        return make_variants(data)
+    try:
+        return _executor().submit(make_variants, data).result()
+    except BrokenProcessPool:
+        # A crashed worker breaks the pool, the next image gets a new one
+        with _pool_lock:
+            _pool = None
+        raise
+
+
+def srcset(image, fmt):
+    """
+    Build the srcset of an image in a format. This is a template filter.
+
+    @param image - The metadata of the variants of the image, with its url
+    @param fmt - The format
+    @return The srcset, e.g. "room-320w.webp 320w, room-640w.webp 640w"
+    """
+    return ", ".join(
+        f'{variant_name(image["url"], width, fmt)} {width}w'
+        for width in image["widths"]
+    )
+
+
+def image_variants(post, url):
+    """
+    Find the variants of an image of a post. This is a template global.
+
+    @param post - The post, with its image_variants
+    @param url - The url of the image
+    @return The metadata of the variants with the url, only the url for
+            images uploaded before the variants were made
+    """
+    for image in post.get("image_variants") or []:
+        if image.get("url") == url:
+            return image
+    return {"url": url}
+
+
+@lru_cache(maxsize=None)
+def _static_manifest():
+    """
+    Load the metadata of the variants of the static images, once per process.
+
+    @return A dict from the path of an image in the static folder to the
+            metadata of its variants, empty if resize-static-images never ran
+    """
+    try:
+        with open(STATIC_MANIFEST, encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def static_image(filename):
+    """
+    Get the variants of an image in the static folder. This is a template global.
+
+    @param filename - The path of the image in the static folder, e.g. "img/room.jpg"
+    @return A dict with the url of the image, and the metadata of its variants
+            if resize-static-images made them
+    """
+    return {
+        **_static_manifest().get(filename, {}),
+        "url": url_for("static", filename=filename),
+    }
+
+
+def resize_static_images():
+    """
+    Write the variants of the JPEG and PNG images in static/img next to them,
+    and their metadata to the manifest.
+
+    @return The number of resized images
+    """
+    manifest = {}
+    folder = os.path.join(STATIC_FOLDER, "img")
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        with open(os.path.join(folder, name), "rb") as file:
+            meta, files = make_variants(file.read())
+        for (width, fmt), content in files.items():
+            with open(os.path.join(folder, variant_name(name, width, fmt)), "wb") as file:
+                file.write(content)
+        manifest[f"img/{name}"] = meta
+    with open(STATIC_MANIFEST, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    _static_manifest.cache_clear()
+    return len(manifest)
+
+
+@click.command("resize-static-images")
+def resize_static_images_command():
+    """Make the responsive variants of the images in static/img."""
+    resized = resize_static_images()
+    click.echo(f"Resized {resized} images.")
@@ -0,0 +1,59 @@
+""" This module generates the Firestore composite index definitions of the app's queries. """
+import json
+
+import click
+
+# The composite indexes of the queries that filter or order on more than one field,
+# as (collection, fields) in the order of the query. A field is ascending unless
+# it is prefixed with "-".
+COMPOSITE_INDEXES = [
+    # The search feed: country == , maxGuests >= , price range, ordered by maxGuests, price, id
+    ("posts", ["country", "maxGuests", "price", "id"]),
+    # The listings of a user: user_uid == , ordered by id
+    ("posts", ["user_uid", "id"]),
+    # The feed of all listings, ordered by created, id
+    ("posts", ["created", "id"]),
+    # The newest reviews of a property or a user: reviewed == or in, ordered by timestamp
+    ("reviews", ["reviewed", "-timestamp"]),
+]
+
+
+def index_field(field):
+    """
+    Build the definition of one field of a composite index.
+
+    @param field - The field path, prefixed with "-" if it is ordered descending
+    @return A dict in the format of firestore.indexes.json
+    """
+    if field.startswith("-"):
+        return {"fieldPath": field[1:], "order": "DESCENDING"}
+    return {"fieldPath": field, "order": "ASCENDING"}
+
+
+def firestore_indexes():
+    """
+    Build the index definitions in the format of firestore.indexes.json.
+
+    @return A dict that can be deployed with the Firebase CLI
+    """
+    return {
+        "indexes": [
+            {
+                "collectionGroup": collection,
+                "queryScope": "COLLECTION",
+                "fields": [index_field(field) for field in fields],
+            }
+            for collection, fields in COMPOSITE_INDEXES
+        ],
+        "fieldOverrides": [],
+    }
+
+
+@click.command("firestore-indexes")
+@click.argument("path", default="firestore.indexes.json")
+def indexes_command(path):
+    """Write the composite index definitions of the app to PATH."""
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(firestore_indexes(), file, indent=2)
+        file.write("\n")
+    click.echo(f"Wrote {len(COMPOSITE_INDEXES)} composite indexes to {path}.")
@@ -0,0 +1,150 @@
+""" This module contains helpers for cursor based pagination of the listing pages. """
+import json
+import os
+from datetime import datetime
+
+from flask import current_app as app
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from utils.firebase import firebase_query, projection_fields
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "24"))
+# How many batches a filtered page may scan before it is returned short.
+MAX_SCAN_BATCHES = 5
+
+
+class _CursorJSON:
+    """
+    JSON that also encodes datetimes, e.g. the creation time of a post in a cursor.
+    """
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, datetime):
+            return {"$datetime": value.isoformat()}
+        raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+
+    @staticmethod
+    def _object_hook(value):
+        if set(value) == {"$datetime"}:
+            return datetime.fromisoformat(value["$datetime"])
+        return value
+
+    @classmethod
+    def dumps(cls, obj, **kwargs):
+        return json.dumps(obj, default=cls._default, **kwargs)
+
+    @classmethod
+    def loads(cls, data, **kwargs):
+        return json.loads(data, object_hook=cls._object_hook, **kwargs)
+
+
+def _serializer():
+    """
+    Get the serializer for page tokens. Tokens are signed with the app secret
+    key, so clients can pass them back but not forge them.
+
+    @return An URLSafeSerializer instance
+    """
+    return URLSafeSerializer(
+        app.secret_key, salt="listings-page", serializer=_CursorJSON
+    )
+
+
+def encode_cursor(state):
+    """
+    Encode the state of a listing feed into an opaque next-page token.
+
+    @param state - A JSON serializable dict describing the feed and where the next page starts,
+                   its values may also be datetimes
+    @return The page token or None if there is no state
+    """
+    if state is None:
+        return None
+    return _serializer().dumps(state)
+
+
+def decode_cursor(token):
+    """
+    Decode a next-page token created with encode_cursor.
+
+    @param token - The page token
+    @return The state dict or None if the token is invalid
+    """
+    try:
+        return _serializer().loads(token)
+    except BadSignature:
+        return None
+
+
+def fetch_page(
+    collection,
+    query,
+    order_by,
+    after=None,
+    page_size=PAGE_SIZE,
+    predicate=None,
+    fields=None,
+):
+    """
+    Fetch a single page of a query ordered by the given fields. If a predicate is
+    given, documents that do not pass it are skipped and further batches are read
+    until the page is full, at most MAX_SCAN_BATCHES batches per page.
+
+    @param collection - The collection to query
+    @param query - The list of query tuples, as for firebase_query
+    @param order_by - The fields to order by, their values form the cursor
+    @param after - The cursor of the previous page or None for the first page
+    @param page_size - The maximum number of documents on a page
+    @param predicate - An optional filter function that is applied to each document
+    @param fields - An optional field projection, as for firebase_query. The
+                    order_by fields are always fetched, since they form the cursor
+
+    @return A tuple of the documents on the page and the cursor of the next
+            page, which is None if there are no more documents
+    """
+    if fields:
+        fields = list(dict.fromkeys([*projection_fields(fields), *order_by]))
+    docs = []
+    for _ in range(MAX_SCAN_BATCHES):
+        with firebase_query(
+            collection,
+            query,
+            order_by=order_by,
+            start_after=after,
+            limit=page_size,
+            fields=fields,
+            stream=True,
+        ) as batch:
+            scanned = 0
+            # Documents are read and filtered one at a time
+            for doc in batch:
+                scanned += 1
+                after = {field: doc[field] for field in order_by}
+                if predicate is None or predicate(doc):
+                    docs.append(doc)
+                    # The page is full, continue after this document next time.
+                    if len(docs) == page_size:
+                        return docs, after
+        # A short batch means the query is exhausted.
+        if scanned < page_size:
+            return docs, None
+    return docs, after
+
+
+def slice_page(ids, after=None, page_size=PAGE_SIZE):
+    """
+    Get a page of a known list of ids, such as the favorites of a user.
+
+    @param ids - The list of ids
+    @param after - The last id of the previous page or None for the first page
+    @param page_size - The maximum number of ids on a page
+
+    @return A tuple of the ids on the page and the cursor of the next page,
+            which is None if there are no more ids
+    """
+    ids = sorted(set(int(i) for i in ids))
+    if after is not None:
+        ids = [i for i in ids if i > int(after)]
+    page = ids[:page_size]
+    return page, page[-1] if len(ids) > page_size else None
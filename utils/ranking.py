@@ -0,0 +1,116 @@
+"""
+This module ranks search results.
+
+A page is selected from the candidates with a bounded heap, so only the page
+is ever sorted. Pages continue after the rank key of the last result of the
+previous page, which makes the keys a cursor like the one of fetch_page.
+"""
+import heapq
+import math
+import os
+import time
+from datetime import datetime
+
+from utils.ratings import average_rating, has_rating_aggregate
+
+DEFAULT_SORT = "price"
+# Ratings of posts with few reviews are pulled towards this prior.
+PRIOR_RATING = 3.0
+PRIOR_COUNT = 2
+# The popularity boost of a new post halves every POPULARITY_HALF_LIFE days.
+POPULARITY_HALF_LIFE = float(os.getenv("POPULARITY_HALF_LIFE", "30"))
+RECENCY_WEIGHT = float(os.getenv("RECENCY_WEIGHT", "1"))
+
+
+def _created(doc):
+    """
+    Get the creation time of a post.
+
+    @param doc - The post
+    @return The creation time as a unix timestamp, 0 for posts created before it was recorded
+    """
+    created = doc.get("created")
+    return created.timestamp() if isinstance(created, datetime) else 0.0
+
+
+def _rating(doc):
+    """
+    Get the average rating and the number of ratings of a post.
+
+    @param doc - The post
+    @return A tuple of the average rating and the rating count
+    """
+    if not has_rating_aggregate(doc) or not doc["rating_count"]:
+        return 0.0, 0
+    return float(average_rating(doc)), int(doc["rating_count"])
+
+
+def popularity(doc, now):
+    """
+    Score a post by how many good ratings it has and how new it is.
+
+    @param doc - The post
+    @param now - The unix timestamp to measure the age of the post from
+    @return The popularity score, higher is more popular
+    """
+    rating, count = _rating(doc)
+    mean = (rating * count + PRIOR_RATING * PRIOR_COUNT) / (count + PRIOR_COUNT)
+    score = math.log1p(count) * mean / 5
+    created = _created(doc)
+    if created:
+        age = max(0.0, now - created) / (24 * 3600)
+        score += RECENCY_WEIGHT * 0.5 ** (age / POPULARITY_HALF_LIFE)
+    return score
+
+
+# The rank key of each sort order. Smaller keys come first and every key ends
+# with the id, so the order is total and a key can serve as a cursor.
+RANK_KEYS = {
+    "relevance": lambda doc, now: (-doc.get("relevance", 0.0), int(doc["id"])),
+    "price": lambda doc, now: (float(doc["price"]), int(doc["id"])),
+    "rating": lambda doc, now: (*(-value for value in _rating(doc)), int(doc["id"])),
+    "popular": lambda doc, now: (-popularity(doc, now), int(doc["id"])),
+    # Ids are not in creation order, they only break ties of equal creation times
+    "newest": lambda doc, now: (-_created(doc), -int(doc["id"])),
+}
+
+
+def sort_order(sort, keywords=None):
+    """
+    Validate a sort order.
+
+    @param sort - The requested sort order
+    @param keywords - The keywords of the search, results can only be relevant to keywords
+    @return The sort order or DEFAULT_SORT if it is unknown
+    """
+    if sort not in RANK_KEYS or (sort == "relevance" and not keywords):
+        return DEFAULT_SORT
+    return sort
+
+
+def rank_page(candidates, sort, after, page_size):
+    """
+    Select a page of the best ranked candidates.
+
+    @param candidates - An iterable of the documents that match a search, it is read once
+    @param sort - The sort order validated with sort_order
+    @param after - The cursor of the previous page or None for the first page
+    @param page_size - The maximum number of documents on a page
+
+    @return A tuple of the documents on the page and the cursor of the next
+            page, which is None if there are no more documents
+    """
+    # Scores that change with time are computed for the time of the first page,
+    # so they do not move between pages
+    now = after["now"] if after else time.time()
+    rank_key = RANK_KEYS.get(sort, RANK_KEYS[DEFAULT_SORT])
+    keyed = ((rank_key(doc, now), doc) for doc in candidates)
+    if after:
+        last = tuple(after["key"])
+        keyed = (item for item in keyed if item[0] > last)
+    top = heapq.nsmallest(page_size + 1, keyed, key=lambda item: item[0])
+    # Copy the documents, since the caller adds the average rating to them
+    docs = [dict(doc) for _, doc in top[:page_size]]
+    if len(top) <= page_size:
+        return docs, None
+    return docs, {"key": list(top[page_size - 1][0]), "now": now}
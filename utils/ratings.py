@@ -0,0 +1,194 @@
+""" This module keeps the denormalized rating aggregates of posts up to date. """
+from collections import defaultdict
+
+import click
+from firebase_admin import firestore
+from flask import session
+from flask.cli import with_appcontext
+
+from config import fetch_db
+from utils.cache import invalidate_posts, invalidate_searches
+
+STARS = ["1", "2", "3", "4", "5"]
+
+
+def rating_aggregate(ratings):
+    """
+    Compute the rating aggregate of a post from the ratings of its reviews.
+
+    @param ratings - A list of ratings between 1 and 5
+    @return A dict with the rating_sum, rating_count and rating_hist fields of a post
+    """
+    hist = {star: 0 for star in STARS}
+    for rating in ratings:
+        hist[str(int(rating))] += 1
+    return {
+        "rating_sum": sum(int(rating) for rating in ratings),
+        "rating_count": len(ratings),
+        "rating_hist": hist,
+    }
+
+
+def rating_changes(old_rating, new_rating):
+    """
+    Build the update of a post's rating aggregate when one of its reviews changes.
+
+    @param old_rating - The rating before the change or None if the review is new
+    @param new_rating - The rating after the change or None if the review is deleted
+    @return A dict of field paths to Firestore increments, empty if nothing changed
+    """
+    changes = defaultdict(int)
+    if old_rating is not None:
+        changes["rating_sum"] -= int(old_rating)
+        changes["rating_count"] -= 1
+        changes[f"rating_hist.{int(old_rating)}"] -= 1
+    if new_rating is not None:
+        changes["rating_sum"] += int(new_rating)
+        changes["rating_count"] += 1
+        changes[f"rating_hist.{int(new_rating)}"] += 1
+    return {
+        field: firestore.Increment(value)
+        for field, value in changes.items()
+        if value != 0
+    }
+
+
+def average_rating(doc):
+    """
+    Get the average rating of a post from its rating aggregate.
+
+    @param doc - The post document
+    @return The average rating or None if the post has no reviews
+    """
+    count = doc.get("rating_count", 0)
+    return doc["rating_sum"] / count if count > 0 else None
+
+
+def has_rating_aggregate(doc):
+    """
+    Check if a post carries a rating aggregate, i.e. it was written or
+    backfilled after the aggregates were introduced.
+
+    @param doc - The post document
+    @return True if the post has a rating aggregate
+    """
+    return "rating_count" in doc and "rating_sum" in doc
+
+
+@firestore.transactional
+def _commit_review(transaction, review_ref, data, written):
+    """
+    Write a review and update the rating aggregate of the reviewed post atomically.
+
+    @param transaction - The Firestore transaction to run in
+    @param review_ref - Reference to the review document
+    @param data - The review data to set or update, None deletes the review
+    @param written - A list the reviewed post is added to
+    @return The review before the change or None if it did not exist
+    """
+    snapshot = review_ref.get(transaction=transaction)
+    old = snapshot.to_dict() if snapshot.exists else None
+    review = old if old else data
+    # Nothing to edit or delete if the review does not exist
+    if review is None or "reviewed" not in review:
+        return None
+    # All reads have to happen before the first write of a transaction.
+    posts = transaction.get(
+        fetch_db()
+        .collection("posts")
+        .where("id", "==", int(review["reviewed"]))
+        .limit(1)
+    )
+    post_refs = []
+    unseeded = False
+    for post in posts:
+        post_refs.append(post.reference)
+        doc = post.to_dict() or {}
+        written.append(doc)
+        unseeded = unseeded or not has_rating_aggregate(doc)
+    # A post that was never backfilled gets its aggregate from all of its reviews,
+    # increments alone would leave it counting only the reviews since
+    others = []
+    if unseeded:
+        reviews = transaction.get(
+            fetch_db().collection("reviews").where("reviewed", "==", review["reviewed"])
+        )
+        others = [
+            doc.to_dict()["rating"] for doc in reviews if doc.id != review_ref.id
+        ]
+    if data is None:
+        transaction.delete(review_ref)
+    elif old is None:
+        transaction.set(review_ref, data)
+    else:
+        transaction.update(review_ref, data)
+    old_rating = old["rating"] if old else None
+    new_rating = data.get("rating", old_rating) if data else None
+    if unseeded:
+        ratings = others + ([new_rating] if new_rating is not None else [])
+        for post_ref in post_refs:
+            transaction.update(post_ref, rating_aggregate(ratings))
+        return old
+    changes = rating_changes(old_rating, new_rating)
+    if changes:
+        for post_ref in post_refs:
+            transaction.update(post_ref, changes)
+    return old
+
+
+def commit_review(rid, data):
+    """
+    Add, edit or delete a review of the logged in user and keep the
+    rating aggregate of the reviewed post in sync in the same transaction.
+
+    @param rid - The id of the review
+    @param data - The review data to set or update, None deletes the review
+    @return The review before the change or None if it did not exist
+    """
+    db = fetch_db()
+    review_ref = db.collection("reviews").document(
+        f'{rid}|{session["user"]["uid"]}'
+    )
+    written = []
+    old = _commit_review(db.transaction(), review_ref, data, written)
+    invalidate_posts(*written)
+    # The rating changes the rank of the post in its country's searches
+    invalidate_searches(*(post.get("country") for post in written))
+    return old
+
+
+def backfill_ratings():
+    """
+    Recompute the rating aggregates of all posts from their reviews.
+    The posts are updated in batched writes.
+
+    @return The number of updated posts
+    """
+    # Imported here, since utils.firebase reads the aggregates with this module
+    from utils.firebase import batched_updates  # pylint: disable=import-outside-toplevel
+
+    db = fetch_db()
+    ratings = defaultdict(list)
+    for doc in db.collection("reviews").stream():
+        review = doc.to_dict()
+        ratings[int(review["reviewed"])].append(int(review["rating"]))
+    written = []
+
+    def updates():
+        for doc in db.collection("posts").stream():
+            post = doc.to_dict()
+            written.append(post)
+            yield doc.reference, rating_aggregate(ratings[int(post["id"])])
+
+    updated = batched_updates(updates())
+    invalidate_posts(*written)
+    invalidate_searches(*(post.get("country") for post in written))
+    return updated
+
+
+@click.command("backfill-ratings")
+@with_appcontext
+def backfill_ratings_command():
+    """Recompute the rating aggregates of all posts from their reviews."""
+    updated = backfill_ratings()
+    click.echo(f"Updated the rating aggregates of {updated} posts.")
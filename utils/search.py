@@ -1,5 +1,11 @@
+import hashlib
+import json
+
+from utils.geo import DEFAULT_RADIUS_KM, MAX_RADIUS_KM, geocode_place
+from utils.ranking import sort_order
 from utils.render import render_message
-from utils.time import format_dates
+from utils.text_index import tokenize
+from utils.time import day_ordinal, format_dates, format_firebase_date
 
 
 def get_search_params(request):
@@ -10,16 +16,111 @@ def get_search_params(request):
 
     @return The search parameters, or an error message if the parameters are invalid
     """
-    vfrom, to = format_dates(request.form["from"], request.form["to"])
-    from_price = request.form["from-price"]
-    to_price = request.form["to-price"]
+    return parse_search_params(request.form)
+
+
+def parse_search_params(form):
+    """
+    Parse the search parameters from the search form data.
+
+    @param form - A mapping with the fields of the search form
+
+    @return The search parameters, or an error message if the parameters are invalid
+    """
+    vfrom, to = format_dates(form["from"], form["to"])
+    from_price = form["from-price"]
+    to_price = form["to-price"]
     # if vfrom > to return error message
     if vfrom > to:
         return render_message(400, "Invalid date range")
     # This function is used to check if the range is greater than the current price range
     if from_price > to_price:
         return render_message(400, "Invalid price range")
-    country = request.form["country"]
-    guests = int(request.form["guests"])
-
+    country = form["country"]
+    guests = int(form["guests"])
     return vfrom, to, from_price, to_price, country, guests
+
+
+def parse_near(form):
+    """
+    Parse the radius search from the search form data.
+
+    @param form - A mapping with the fields of the search form
+
+    @return A tuple of the latitude, longitude and radius in kilometers, None if
+            no place was entered, or an error message if the place is unknown
+    """
+    place = form.get("near", "").strip()
+    if not place:
+        return None
+    try:
+        radius = float(form.get("radius") or DEFAULT_RADIUS_KM)
+    except ValueError:
+        return render_message(400, "Invalid radius")
+    if not 0 < radius <= MAX_RADIUS_KM:
+        return render_message(400, f"The radius must be at most {MAX_RADIUS_KM} km")
+    point = geocode_place(place, form["country"])
+    if point is None:
+        return render_message(400, f"Unknown place: {place}")
+    return (*point, radius)
+
+
+def search_cache_key(params, after, bookings):
+    """
+    Build the canonical key of a page of search results, so searches that only
+    differ in how their fields were typed share their cached results.
+
+    @param params - The search form fields
+    @param after - The cursor of the previous page or None for the first page
+    @param bookings - True if the bookings are checked for the dates of the stay
+
+    @return The key
+    """
+    vfrom, to, from_price, to_price, country, guests = parse_search_params(params)
+    near = parse_near(params)
+    amenities = sorted(set(params.get("amenities") or []))
+    keywords = params.get("q") or ""
+    canonical = {
+        "country": country.strip(),
+        "guests": guests,
+        # Searches without dates use today, so their results change once a day
+        "days": [day_ordinal(vfrom), day_ordinal(to)],
+        "price": [int(from_price), int(to_price)],
+        "bookings": bookings,
+        "keywords": sorted(set(tokenize(keywords))),
+        "amenities": amenities,
+        "match_all": params.get("match") != "any" if amenities else None,
+        "sort": sort_order(params.get("sort"), keywords),
+        "near": [round(value, 4) for value in near] if near else None,
+        "after": after,
+    }
+    text = json.dumps(canonical, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def search_filter(vfrom, to, from_price, to_price, available=None):
+    """
+    Build the filter for the price and date range of a search, since we are
+    limited in what we can do with Firestore queries. It is applied to the
+    documents one at a time while they are streamed.
+
+    @param vfrom - The first day of the stay
+    @param to - The last day of the stay
+    @param from_price - The minimum price per night
+    @param to_price - The maximum price per night
+    @param available - An optional function that checks the bookings of a property id
+
+    @return A function that returns True if a document matches the search
+    """
+
+    def matches(doc):
+        return (
+            (doc["price"] >= int(from_price) and doc["price"] <= int(to_price))
+            and (
+                format_firebase_date(doc["from"]) <= vfrom
+                and format_firebase_date(doc["to"]) >= to
+            )
+            and (available is None or available(doc["id"]))
+        )
+
+    return matches
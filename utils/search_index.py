@@ -0,0 +1,387 @@
+"""
+This module contains the in-memory search index of the posts.
+
+Every worker keeps the searchable fields of all posts in NumPy arrays, which a
+Firestore snapshot listener keeps current. Searches are answered with
+vectorized masks over the arrays, without reading from Firestore. Until the
+listener delivered its first snapshot, searches fall back to Firestore queries,
+except keyword searches, which only the in-memory text index can answer.
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+from flask import current_app as app
+from flask import has_app_context
+
+from config import fetch_db
+from utils.clusters import ClusterIndex
+from utils.facets import FacetIndex, post_tags
+from utils.firebase import PROJECTIONS
+from utils.geo import GeoIndex
+from utils.text_index import TEXT_FIELDS, TextIndex
+from utils.time import day_ordinal
+
+# The fields kept for every post, enough to render its card without a read.
+INDEX_FIELDS = list(
+    dict.fromkeys(
+        PROJECTIONS["card"] + ["from", "to", "maxGuests", "created", "lat", "lng"]
+    )
+)
+REQUIRED_FIELDS = ["id", "country", "maxGuests", "price", "from", "to"]
+# How long a keyword search waits for the first snapshot of a worker.
+KEYWORD_WAIT = float(os.getenv("KEYWORD_WAIT", "5"))
+
+logger = logging.getLogger("first_logger")
+
+
+def index_enabled():
+    """
+    Check if the search index is enabled for the app.
+
+    @return True if searches should use the in-memory index
+    """
+    return has_app_context() and app.config.get("SEARCH_INDEX", False)
+
+
+def _point(doc):
+    """
+    Get the coordinates of a post.
+
+    @param doc - The post
+    @return A tuple of the latitude and longitude, or None if the post is not geocoded
+    """
+    try:
+        return float(doc["lat"]), float(doc["lng"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class SearchIndex:
+    """
+    A columnar index of the searchable fields of all posts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._pid = None
+        self._watch = None
+        self._docs = {}
+        self._tags = {}
+        self._text = TextIndex()
+        self._columns = None
+
+    @property
+    def ready(self):
+        """
+        @return True once the listener delivered the first snapshot
+        """
+        return self._ready.is_set()
+
+    def wait(self, timeout):
+        """
+        Wait for the first snapshot.
+
+        @param timeout - How many seconds to wait at most
+        @return True if the index is ready
+        """
+        return self._ready.wait(timeout)
+
+    def start(self):
+        """
+        Start listening to the posts collection, also after the worker was
+        forked or the listener stopped after an error.
+        """
+        with self._lock:
+            if (
+                self._pid == os.getpid()
+                and self._watch is not None
+                and self._watch.is_active
+            ):
+                return
+            self._pid = os.getpid()
+            self._docs = {}
+            self._tags = {}
+            self._text = TextIndex()
+            self._columns = None
+            self._ready.clear()
+            self._watch = (
+                fetch_db()
+                .collection("posts")
+                .select(INDEX_FIELDS + TEXT_FIELDS)
+                .on_snapshot(self._on_snapshot)
+            )
+
+    def _on_snapshot(self, snapshot, changes, read_time):
+        """
+        Apply the changes of a snapshot to the index. This runs on the thread
+        of the listener.
+
+        @param snapshot - All documents of the collection
+        @param changes - The changes since the last snapshot
+        @param read_time - The time of the snapshot
+        """
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                data = doc.to_dict() if change.type.name != "REMOVED" else None
+                # Posts written before the creation time was recorded are ranked
+                # by the creation time of their document
+                if data and "created" not in data:
+                    data["created"] = doc.create_time
+                if data and all(field in data for field in REQUIRED_FIELDS):
+                    self._docs[doc.id] = {
+                        field: data[field] for field in INDEX_FIELDS if field in data
+                    }
+                    self._tags[doc.id] = post_tags(data)
+                    self._text.update(doc.id, data)
+                else:
+                    if data:
+                        missing = [f for f in REQUIRED_FIELDS if f not in data]
+                        logger.warning(
+                            "Post %s is left out of the search index, it has no %s",
+                            doc.id,
+                            ", ".join(missing),
+                        )
+                    self._docs.pop(doc.id, None)
+                    self._tags.pop(doc.id, None)
+                    self._text.remove(doc.id)
+            # The arrays are rebuilt by the next search
+            self._columns = None
+        self._ready.set()
+
+    def _build(self):
+        """
+        Build the arrays from the indexed documents.
+
+        @return A dict with the arrays, the documents, their ids, the country codes,
+                the facet index and the geo index
+        """
+        docs = []
+        for key, doc in self._docs.items():
+            try:
+                row = (
+                    int(doc["id"]),
+                    int(doc["maxGuests"]),
+                    float(doc["price"]),
+                    day_ordinal(doc["from"]),
+                    day_ordinal(doc["to"]),
+                )
+            except (TypeError, ValueError, AttributeError):
+                logger.warning("Cannot index post %s", doc.get("id"))
+                continue
+            docs.append((row, key, doc))
+        countries = {}
+        codes = [
+            countries.setdefault(doc["country"], len(countries)) for _, _, doc in docs
+        ]
+        rows = np.array([row for row, _, _ in docs], dtype=np.float64).reshape(-1, 5)
+        return {
+            "id": rows[:, 0].astype(np.int64),
+            "guests": rows[:, 1].astype(np.int64),
+            "price": rows[:, 2],
+            "from": rows[:, 3].astype(np.int64),
+            "to": rows[:, 4].astype(np.int64),
+            "country": np.array(codes, dtype=np.int32),
+            "countries": countries,
+            "rows": {key: i for i, (_, key, _) in enumerate(docs)},
+            "ids": {row[0]: i for i, (row, _, _) in enumerate(docs)},
+            "keys": [key for _, key, _ in docs],
+            "docs": [doc for _, _, doc in docs],
+            "facets": FacetIndex([self._tags.get(key, set()) for _, key, _ in docs]),
+            "geo": GeoIndex([_point(doc) for _, _, doc in docs]),
+        }
+
+    def _snapshot(self):
+        """
+        Get the current arrays, rebuilding them if the index changed.
+
+        @return The dict of arrays, see _build
+        """
+        with self._lock:
+            if self._columns is None:
+                self._columns = self._build()
+            return self._columns
+
+    def clusters(self):
+        """
+        Get the map clusters of the posts, built once per snapshot.
+
+        @return The ClusterIndex of the current snapshot
+        """
+        columns = self._snapshot()
+        if "clusters" not in columns:
+            geo = columns["geo"]
+            columns["clusters"] = ClusterIndex(geo.lat, geo.lng, columns["id"])
+        return columns["clusters"]
+
+    def lookup(self, ids):
+        """
+        Get posts by their ids.
+
+        @param ids - The list of post ids
+        @return The list of copies of the posts in the order of the ids, without the ids that are not indexed
+        """
+        columns = self._snapshot()
+        rows = columns["ids"]
+        return [dict(columns["docs"][rows[pid]]) for pid in ids if pid in rows]
+
+    def matches(
+        self,
+        country,
+        guests,
+        vfrom,
+        to,
+        from_price,
+        to_price,
+        available=None,
+        keywords=None,
+        amenities=None,
+        match_all=True,
+        near=None,
+    ):
+        """
+        Find the posts that match a search and count the amenities of the results.
+
+        @param country - The country of the posts
+        @param guests - The minimum number of guests
+        @param vfrom - The first day of the stay
+        @param to - The last day of the stay
+        @param from_price - The minimum price per night
+        @param to_price - The maximum price per night
+        @param available - An optional function that checks the bookings of a property id
+        @param keywords - Optional keywords that every matching post must contain
+        @param amenities - An optional list of facet keys, see utils.facets
+        @param match_all - If True a post needs all amenities, otherwise any of them
+        @param near - An optional tuple of the latitude, longitude and radius in
+                      kilometers that the posts must be within
+
+        @return A tuple of an iterator of the matching documents, which must not be
+                modified, and the facet counts of the results. With keywords, the
+                documents are copies with their BM25 score as relevance
+        """
+        columns = self._snapshot()
+        scores = None
+        if keywords:
+            with self._lock:
+                scores = self._text.search(keywords)
+            if not scores:
+                return iter(()), {}
+        code = columns["countries"].get(country)
+        if code is None:
+            return iter(()), {}
+        mask = (
+            (columns["country"] == code)
+            & (columns["guests"] >= guests)
+            & (columns["price"] >= int(from_price))
+            & (columns["price"] <= int(to_price))
+            & (columns["from"] <= day_ordinal(vfrom))
+            & (columns["to"] >= day_ordinal(to))
+        )
+        if scores is not None:
+            selected = np.zeros(len(mask), dtype=bool)
+            selected[
+                [columns["rows"][key] for key in scores if key in columns["rows"]]
+            ] = True
+            mask &= selected
+        if amenities:
+            mask &= columns["facets"].mask(amenities, match_all)
+        if near:
+            mask &= columns["geo"].radius(*near)
+        if available is not None:
+            # Bookings are checked one row at a time, after the cheap filters
+            for row in np.flatnonzero(mask):
+                mask[row] = available(columns["id"][row])
+        counts = columns["facets"].counts(mask)
+        rows = np.flatnonzero(mask)
+        if scores is not None:
+            docs = (
+                {**columns["docs"][row], "relevance": scores[columns["keys"][row]]}
+                for row in rows
+            )
+        else:
+            docs = (columns["docs"][row] for row in rows)
+        return docs, counts
+
+
+index = SearchIndex()
+
+
+def search_posts(
+    country,
+    guests,
+    vfrom,
+    to,
+    from_price,
+    to_price,
+    available=None,
+    keywords=None,
+    amenities=None,
+    match_all=True,
+    near=None,
+):
+    """
+    Find the posts that match a search in the in-memory index.
+    The listener is started by the first search of each worker.
+
+    @return A tuple of the documents and facet counts as for SearchIndex.matches,
+            or None if the index is disabled or not loaded yet.
+            Keyword searches wait up to KEYWORD_WAIT seconds for the index
+            and find nothing if it is not loaded by then
+    """
+    if not index_enabled():
+        return None
+    try:
+        index.start()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot start the search index listener")
+        return None
+    if not index.ready and not (keywords and index.wait(KEYWORD_WAIT)):
+        if keywords:
+            logger.warning("The search index is not loaded, no keyword results")
+            return iter(()), {}
+        return None
+    return index.matches(
+        country,
+        guests,
+        vfrom,
+        to,
+        from_price,
+        to_price,
+        available=available,
+        keywords=keywords,
+        amenities=amenities,
+        match_all=match_all,
+        near=near,
+    )
+
+
+def map_clusters():
+    """
+    Get the map clusters from the in-memory index.
+
+    @return The ClusterIndex of the posts, or None if the index is disabled or not loaded yet
+    """
+    if not index_enabled():
+        return None
+    try:
+        index.start()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot start the search index listener")
+        return None
+    return index.clusters() if index.ready else None
+
+
+def lookup_posts(ids):
+    """
+    Get posts by their ids from the in-memory index.
+
+    @param ids - The list of post ids
+    @return The list of copies of the posts in the order of the ids, without
+            the ids that are not indexed, or None if the index is disabled or not loaded yet
+    """
+    if not index_enabled() or not index.ready:
+        return None
+    return index.lookup(ids)
@@ -0,0 +1,192 @@
+"""
+This module contains the inverted index for keyword searches over the posts.
+
+The index maps every token of the text fields of a post to the posts it occurs
+in. It is updated one post at a time by the listener of the search index,
+so a write to a post reaches it without a rebuild. Query tokens match every
+indexed token they are a prefix of, and matches are scored with BM25.
+"""
+import heapq
+import json
+import logging
+import math
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+
+# The fields of a post that keyword searches look at.
+TEXT_FIELDS = ["description", "city", "district", "type", "space", "tags"]
+# BM25 parameters, the usual defaults.
+BM25_K1 = 1.2
+BM25_B = 0.75
+# A short query token matches at most this many indexed tokens, the ones
+# that occur in the most posts.
+MAX_EXPANSIONS = 200
+
+logger = logging.getLogger("first_logger")
+
+
+def tokenize(text):
+    """
+    Split a text into lowercase tokens without accents.
+
+    @param text - The text
+    @return The list of tokens
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r"\w+", text.casefold())
+
+
+def _field_text(value):
+    """
+    Flatten the value of a text field, e.g. the dict of tag lists, into text.
+
+    @param value - The value of the field
+    @return The text of the field
+    """
+    if isinstance(value, dict):
+        return " ".join(_field_text(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return " ".join(_field_text(item) for item in value)
+    if isinstance(value, str) and value.startswith("["):
+        # Older posts store their tag lists as JSON strings
+        try:
+            return _field_text(json.loads(value))
+        except ValueError:
+            pass
+    return "" if value in (None, "None") else str(value)
+
+
+def post_tokens(data):
+    """
+    Get the tokens of the text fields of a post.
+
+    @param data - The post document
+    @return The list of tokens
+    """
+    return tokenize(" ".join(_field_text(data.get(field)) for field in TEXT_FIELDS))
+
+
+class TextIndex:
+    """
+    An inverted index with BM25 scoring. The caller serializes updates and queries.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._lengths = {}
+        self._terms = {}
+        self._total = 0
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def remove(self, key):
+        """
+        Remove a post from the index.
+
+        @param key - The id of the post document
+        """
+        terms = self._terms.pop(key, None)
+        if terms is None:
+            return
+        self._total -= self._lengths.pop(key)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+                self._vocabulary = None
+
+    def update(self, key, data):
+        """
+        Add a post to the index or replace its tokens.
+
+        @param key - The id of the post document
+        @param data - The post document
+        """
+        self.remove(key)
+        tokens = post_tokens(data)
+        if not tokens:
+            return
+        terms = Counter(tokens)
+        self._terms[key] = terms
+        self._lengths[key] = len(tokens)
+        self._total += len(tokens)
+        for term, count in terms.items():
+            if term not in self._postings:
+                self._postings[term] = {}
+                self._vocabulary = None
+            self._postings[term][key] = count
+
+    def _expand(self, token):
+        """
+        Find the indexed tokens that start with a query token. If there are more
+        than MAX_EXPANSIONS, the token itself and the tokens that occur in the
+        most posts are kept.
+
+        @param token - The query token
+        @return The list of matching indexed tokens
+        """
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        start = bisect_left(self._vocabulary, token)
+        # Every token that starts with the query token sorts before this one
+        end = bisect_left(self._vocabulary, token + "\U0010ffff", start)
+        terms = self._vocabulary[start:end]
+        if len(terms) > MAX_EXPANSIONS:
+            logger.info(
+                "Keyword %r matches %d terms, searching the %d most frequent",
+                token,
+                len(terms),
+                MAX_EXPANSIONS,
+            )
+            terms = heapq.nlargest(
+                MAX_EXPANSIONS,
+                terms,
+                key=lambda term: (term == token, len(self._postings[term])),
+            )
+        return terms
+
+    def search(self, query):
+        """
+        Score the posts that match every token of a query.
+
+        @param query - The keywords
+        @return A dict of the ids of the matching post documents to their BM25 scores
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or not self._lengths:
+            return {}
+        count = len(self._lengths)
+        average = self._total / count
+        scores = None
+        for token in tokens:
+            # A post scores with the best of the tokens the query token expands to
+            token_scores = {}
+            for term in self._expand(token):
+                postings = self._postings[term]
+                idf = math.log(
+                    1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for key, tf in postings.items():
+                    norm = BM25_K1 * (
+                        1 - BM25_B + BM25_B * self._lengths[key] / average
+                    )
+                    score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    if score > token_scores.get(key, 0):
+                        token_scores[key] = score
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {
+                    key: score + token_scores[key]
+                    for key, score in scores.items()
+                    if key in token_scores
+                }
+            if not scores:
+                return {}
+        return scores
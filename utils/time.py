@@ -1,5 +1,5 @@
 """ This module contains functions for formatting dates and times. """
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 
 def format_dates(fromd, tod):
@@ -11,13 +11,11 @@ def format_dates(fromd, tod):
 
     @return A tuple of datetime. date objects for the start and end dates of the conversion. If one of the dates is None the other will be
     """
-    today = datetime.today()
-    formatted_today = today.strftime("%m-%d-%Y")
+    today = datetime.today().date()
     future_date = today + timedelta(days=365 * 10)
-    formatted_date = future_date.strftime("%m-%d-%Y")
 
-    vfrom = datetime.strptime(fromd, "%Y-%m-%d").date() if fromd else formatted_today
-    to = datetime.strptime(tod, "%Y-%m-%d").date() if tod else formatted_date
+    vfrom = datetime.strptime(fromd, "%Y-%m-%d").date() if fromd else today
+    to = datetime.strptime(tod, "%Y-%m-%d").date() if tod else future_date
 
     return vfrom, to
 
@@ -45,3 +43,20 @@ def convert_date(date):
     return datetime.combine(
         datetime.strptime(date, "%Y-%m-%d").date(), datetime.min.time()
     )
+
+
+def day_ordinal(day):
+    """
+    Convert a date into a day number, so date ranges can be compared as integers.
+
+    @param day - A date, a datetime with or without nanoseconds, or a date string in the format YYYY-MM-DD
+
+    @return The proleptic Gregorian ordinal of the day
+    """
+    if isinstance(day, str):
+        day = datetime.strptime(day, "%Y-%m-%d").date()
+    if isinstance(day, datetime):
+        day = format_firebase_date(day)
+    if not isinstance(day, date):
+        raise TypeError(f"Cannot convert {day!r} to a day")
+    return day.toordinal()
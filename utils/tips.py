@@ -0,0 +1,411 @@
+"""
+This module caches the travel tips from Bing AI per location.
+
+Tips are stored in redis with an on-disk fallback. Fresh tips are served as
+they are, stale tips are served while a background thread refreshes them,
+so only the first request for a location waits for Bing AI.
+
+Only one question per location is asked at a time: concurrent requests in a
+worker share one answer and workers take turns through a redis lock. Each
+worker asks at most TIPS_MAX_CONCURRENCY questions at once and queues at most
+TIPS_MAX_QUEUE more, so a burst cannot tie up all of its threads.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+
+from config import fetch_redis
+from utils.cache import end_flight, join_flight
+from utils.gpt import TIPS_TIMEOUT, get_travel_tips, stream_travel_tips
+
+# How long tips are served without a refresh.
+TIPS_TTL = int(os.getenv("TIPS_TTL", str(7 * 24 * 3600)))
+# How long stale tips are kept around to serve while they are refreshed.
+TIPS_STALE_TTL = int(os.getenv("TIPS_STALE_TTL", str(30 * 24 * 3600)))
+# How long browsers and proxies may reuse a /tips response.
+TIPS_MAX_AGE = int(os.getenv("TIPS_MAX_AGE", str(24 * 3600)))
+TIPS_MAX_CONCURRENCY = int(os.getenv("TIPS_MAX_CONCURRENCY", "4"))
+TIPS_MAX_QUEUE = int(os.getenv("TIPS_MAX_QUEUE", "16"))
+# How long a request waits for the answer of a concurrent request for the same
+# location: for a slot, for the redis lock and for Bing AI.
+TIPS_WAIT = float(os.getenv("TIPS_WAIT", str(3 * TIPS_TIMEOUT)))
+
+logger = logging.getLogger("first_logger")
+_slots = threading.BoundedSemaphore(TIPS_MAX_CONCURRENCY)
+_queued = 0
+_queued_lock = threading.Lock()
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def tips_key(city, country):
+    """
+    Normalize a location into a cache key, so e.g. " paris" and "Paris" share their tips.
+
+    @param city - The city of the location
+    @param country - The country of the location
+    @return The cache key
+    """
+
+    def normalize(text):
+        return re.sub(r"\s+", " ", (text or "").strip()).casefold()
+
+    return f"{normalize(city)}|{normalize(country)}"
+
+
+def _tips_path(key):
+    """
+    Get the path of the on-disk cache file for a key.
+
+    @param key - The cache key
+    @return The file path
+    """
+    name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(app.instance_path, "tips", f"{name}.json")
+
+
+def _read_entry(key):
+    """
+    Read a cached entry from redis or, if that fails, from disk.
+
+    @param key - The cache key
+    @return A dict with the tips and the time they were fetched, or None
+    """
+    redis = fetch_redis()
+    if redis is not None:
+        try:
+            data = redis.get(f"tips:{key}")
+            if data is not None:
+                return json.loads(data)
+        except RedisError:
+            pass
+    try:
+        with open(_tips_path(key), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_entry(key, tips):
+    """
+    Store tips in redis and on disk.
+
+    @param key - The cache key
+    @param tips - The list of tips
+    """
+    data = json.dumps({"tips": tips, "fetched": time.time()})
+    redis = fetch_redis()
+    if redis is not None:
+        try:
+            redis.set(f"tips:{key}", data, ex=TIPS_STALE_TTL)
+        except RedisError:
+            pass
+    path = _tips_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so readers never see half a file
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        logger.exception("Cannot write tips cache file %s", path)
+
+
+def _ask(key, city, country):
+    """
+    Ask Bing AI for the tips of a location and cache them.
+
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    @return The list of tips, empty if Bing AI did not answer
+    """
+    tips = get_travel_tips(f"{city}, {country}")
+    # Do not cache failures, so the next request tries again
+    if tips:
+        _write_entry(key, tips)
+    return tips
+
+
+@contextmanager
+def _location_lock(key):
+    """
+    Hold the redis lock of a location, so workers take turns asking for its tips.
+
+    @param key - The cache key
+    @return A context manager that gives True if the lock was acquired, False if
+            another worker held it for too long, and None if redis is not available
+    """
+    redis = fetch_redis()
+    if redis is None:
+        yield None
+        return
+    lock = redis.lock(
+        f"tips-lock:{key}",
+        timeout=TIPS_TIMEOUT + 10,
+        blocking_timeout=TIPS_TIMEOUT,
+    )
+    try:
+        acquired = lock.acquire()
+    except RedisError:
+        yield None
+        return
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except RedisError:
+                pass
+
+
+def _waited_tips(key, acquired):
+    """
+    Get the tips another worker cached while we waited for the lock of a location.
+
+    @param key - The cache key
+    @param acquired - Whether the lock was acquired, see _location_lock
+    @return The list of tips to serve, or None if we have to ask Bing AI
+    """
+    if acquired is None:
+        return None
+    entry = _read_entry(key)
+    if entry is not None and time.time() - entry["fetched"] <= TIPS_TTL:
+        return entry["tips"]
+    # Serve what we have if the other worker did not finish in time
+    if not acquired:
+        return entry["tips"] if entry else []
+    return None
+
+
+def _ask_locked(key, city, country):
+    """
+    Ask Bing AI for the tips of a location while holding the redis lock of the
+    location, unless another worker cached fresh tips while we waited for it.
+
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    @return The list of tips, empty if Bing AI did not answer
+    """
+    with _location_lock(key) as acquired:
+        tips = _waited_tips(key, acquired)
+        if tips is not None:
+            return tips
+        return _ask(key, city, country)
+
+
+@contextmanager
+def _slot(key):
+    """
+    Wait for a free slot if TIPS_MAX_CONCURRENCY questions are already running
+    in this worker.
+
+    @param key - The cache key
+    @return A context manager that gives whether a slot was acquired, False if
+            the queue is full or no slot got free in time
+    """
+    global _queued  # pylint: disable=global-statement
+    with _queued_lock:
+        full = _queued >= TIPS_MAX_QUEUE
+        if not full:
+            _queued += 1
+    if full:
+        logger.warning("Too many travel tips requests, dropping %s", key)
+        yield False
+        return
+    try:
+        acquired = _slots.acquire(timeout=TIPS_TIMEOUT)
+    finally:
+        with _queued_lock:
+            _queued -= 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _slots.release()
+
+
+def _ask_limited(key, city, country):
+    """
+    Ask Bing AI for the tips of a location in a free slot, see _slot.
+
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    @return The list of tips, empty if the queue is full or no slot got free in time
+    """
+    with _slot(key) as acquired:
+        if not acquired:
+            return []
+        return _ask_locked(key, city, country)
+
+
+def _stream_limited(key, city, country, tips):
+    """
+    Stream the tips of a location from Bing AI in a free slot and under the
+    redis lock of the location, like _ask_limited, and cache the complete answer.
+
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    @param tips - A list every yielded tip is appended to
+    @return A generator of tips, none if the queue is full or no slot got free in time
+    """
+    with _slot(key) as acquired:
+        if not acquired:
+            return
+        with _location_lock(key) as locked:
+            waited = _waited_tips(key, locked)
+            if waited is not None:
+                tips.extend(waited)
+                yield from waited
+                return
+            for tip in stream_travel_tips(f"{city}, {country}"):
+                tips.append(tip)
+                yield tip
+            # Do not cache failures, so the next request tries again
+            if tips:
+                _write_entry(key, tips)
+
+
+def _shared_tips(key, future):
+    """
+    Wait for the answer of the concurrent request that asks Bing AI for the tips of a location.
+
+    @param key - The cache key
+    @param future - The Future of the question, as returned by join_flight
+    @return The list of tips, or None if the question did not finish in time or
+            did not get a complete answer, e.g. because its client disconnected
+    """
+    try:
+        return future.result(timeout=TIPS_WAIT)
+    except FutureTimeoutError:
+        logger.warning("Gave up waiting for the travel tips of %s", key)
+        return None
+
+
+def _fetch(key, city, country):
+    """
+    Get the tips of a location from Bing AI. Concurrent calls for the same
+    location in this worker share a single question, a call that does not get
+    its answer asks on its own.
+
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    @return The list of tips, empty if Bing AI did not answer
+    """
+    future, leader = join_flight(f"tips:{key}")
+    if not leader:
+        tips = _shared_tips(key, future)
+        return tips if tips is not None else _ask_limited(key, city, country)
+    tips = None
+    try:
+        tips = _ask_limited(key, city, country)
+        return tips
+    finally:
+        end_flight(f"tips:{key}", future, tips)
+
+
+def _refresh(flask_app, key, city, country):
+    """
+    Refresh the tips of a location in the background.
+
+    @param flask_app - The app to run in
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    """
+    try:
+        with flask_app.app_context():
+            _fetch(key, city, country)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot refresh travel tips for %s", key)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def _refresh_in_background(key, city, country):
+    """
+    Start a background refresh of the tips of a location, unless one is running.
+
+    @param key - The cache key
+    @param city - The city of the location
+    @param country - The country of the location
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    threading.Thread(
+        target=_refresh,
+        args=(app._get_current_object(), key, city, country),
+        daemon=True,
+    ).start()
+
+
+def get_cached_tips(city, country):
+    """
+    Get the travel tips of a location. Only a location without any cached
+    tips waits for Bing AI, stale tips are returned right away and refreshed
+    in the background.
+
+    @param city - The city of the location
+    @param country - The country of the location
+    @return The list of tips, empty if Bing AI did not answer
+    """
+    key = tips_key(city, country)
+    entry = _read_entry(key)
+    # Files on disk do not expire by themselves like redis keys
+    if entry is None or time.time() - entry["fetched"] > TIPS_STALE_TTL:
+        return _fetch(key, city, country)
+    if time.time() - entry["fetched"] > TIPS_TTL:
+        _refresh_in_background(key, city, country)
+    return entry["tips"]
+
+
+def stream_cached_tips(city, country):
+    """
+    Stream the travel tips of a location. Cached tips are yielded at once,
+    otherwise every tip is yielded as soon as Bing AI produces it and the
+    complete answer is cached at the end. Like get_cached_tips, one request per
+    location asks Bing AI within the limits of the worker, the others get its answer.
+
+    @param city - The city of the location
+    @param country - The country of the location
+    @return A generator of tips
+    """
+    key = tips_key(city, country)
+    entry = _read_entry(key)
+    if entry is not None and time.time() - entry["fetched"] <= TIPS_STALE_TTL:
+        if time.time() - entry["fetched"] > TIPS_TTL:
+            _refresh_in_background(key, city, country)
+        yield from entry["tips"]
+        return
+    # Share the question with the concurrent requests for the location, see _fetch
+    future, leader = join_flight(f"tips:{key}")
+    if not leader:
+        tips = _shared_tips(key, future)
+        yield from tips if tips is not None else _fetch(key, city, country)
+        return
+    tips = []
+    complete = False
+    try:
+        yield from _stream_limited(key, city, country, tips)
+        complete = True
+    finally:
+        # A stream that stopped halfway, e.g. because its client disconnected,
+        # is not shared, the waiting requests ask on their own
+        end_flight(f"tips:{key}", future, list(tips) if complete else None)
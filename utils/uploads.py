@@ -0,0 +1,188 @@
+"""
+This module lets browsers upload the images of the posts directly to Storage.
+
+The browser asks for a short-lived V4 signed URL for every image and uploads the
+image with a PUT to Storage, so the upload itself does not go through a worker.
+It then finalizes the uploads: the objects are checked to be ones signed for the
+user, within the size limit and images, and are stored under the names of their
+content with their variants, see utils.blobs. Finalizing downloads every object
+into the worker to hash and resize it, and uploads the variants from there, so
+the bytes of an image still pass through a worker once, on the finalize request.
+The names of the signed objects are kept in the session until they are finalized.
+"""
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import click
+from firebase_admin import storage
+from flask import current_app as app
+from flask import session
+from flask.cli import with_appcontext
+from werkzeug.utils import secure_filename
+
+from utils.blobs import store_image
+from utils.firebase import MAX_UPLOAD_WORKERS, allowed_file
+
+logger = logging.getLogger("first_logger")
+
+# How many seconds a signed upload URL is valid.
+UPLOAD_URL_TTL = int(os.getenv("UPLOAD_URL_TTL", "900"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# The most files signed by one request, and kept waiting to be finalized.
+MAX_UPLOAD_FILES = 20
+MAX_PENDING_UPLOADS = 100
+IMAGE_TYPES = ["image/jpeg", "image/png", "image/gif", "image/webp"]
+# The header that makes Storage reject uploads larger than the limit.
+LENGTH_HEADER = "x-goog-content-length-range"
+
+
+def _check_file(file):
+    """
+    @param file - The name, type and size of a file the browser wants to upload
+    @return An error message, or None if the file may be uploaded
+    """
+    if not isinstance(file, dict) or not isinstance(file.get("name"), str):
+        return "invalid file"
+    if not allowed_file(file["name"]) or file.get("type") not in IMAGE_TYPES:
+        return "file type not allowed"
+    if not isinstance(file.get("size"), int) or file["size"] > MAX_UPLOAD_BYTES:
+        return "file too large"
+    return None
+
+
+def sign_uploads(files):
+    """
+    Issue signed upload URLs for the images of a post. The objects get a random
+    prefix, so uploads with the same filename do not overwrite each other.
+
+    @param files - A list of dicts with the name, type and size of every file
+    @return A list with the result of every file in the order of the files, a dict
+            with the filename and either the object name, the signed url and the
+            headers the upload must send, or an error message
+    """
+    bucket = storage.bucket()
+    folder = app.config["UPLOAD_FOLDER"]
+    pending = session.get("uploads", [])
+    results = []
+    for i, file in enumerate(files):
+        result = {"filename": file.get("name") if isinstance(file, dict) else None}
+        error = "too many files" if i >= MAX_UPLOAD_FILES else _check_file(file)
+        if error:
+            result["error"] = error
+            results.append(result)
+            continue
+        extension = file["name"].rsplit(".", 1)[1].lower()
+        name = secure_filename(file["name"]) or f"image.{extension}"
+        object_name = f"{folder}/{uuid.uuid4().hex}-{name}"
+        length = f"0,{MAX_UPLOAD_BYTES}"
+        result["object"] = object_name
+        result["url"] = bucket.blob(object_name).generate_signed_url(
+            version="v4",
+            expiration=timedelta(seconds=UPLOAD_URL_TTL),
+            method="PUT",
+            content_type=file["type"],
+            headers={LENGTH_HEADER: length},
+        )
+        result["headers"] = {"Content-Type": file["type"], LENGTH_HEADER: length}
+        pending.append(object_name)
+        results.append(result)
+    session["uploads"] = pending[-MAX_PENDING_UPLOADS:]
+    return results
+
+
+def finalize_upload(bucket, folder, object_name):
+    """
+    Check an uploaded object and store it under the name of its content with
+    its variants, see utils.blobs. The uploaded object is deleted afterwards.
+
+    @param bucket - The bucket of the object
+    @param folder - The folder of the bucket to store the image in
+    @param object_name - The name of the object
+    @return A dict with the filename and either the url of the image and the
+            metadata of its variants, or an error message
+    """
+    # The filename without the random prefix of the object
+    result = {"filename": object_name.rsplit("/", 1)[-1].split("-", 1)[-1]}
+    try:
+        blob = bucket.get_blob(object_name)
+        if blob is None:
+            result["error"] = "not uploaded"
+            return result
+        if blob.content_type not in IMAGE_TYPES or blob.size > MAX_UPLOAD_BYTES:
+            blob.delete()
+            result["error"] = "file type not allowed"
+            return result
+        try:
+            result["url"], result["variants"] = store_image(
+                bucket, folder, blob.download_as_bytes(), source=blob
+            )
+        except ValueError as err:
+            result["error"] = str(err)
+        blob.delete()
+    except Exception as err:  # pylint: disable=broad-except
+        logger.exception("Cannot finalize the upload %s", object_name)
+        result["error"] = str(err) or type(err).__name__
+    return result
+
+
+def finalize_uploads(object_names):
+    """
+    Finalize the uploads of a user concurrently on a bounded thread pool.
+
+    @param object_names - The names of the uploaded objects, as returned by sign_uploads
+    @return A list with the result of every object in the order of the names, see finalize_upload
+    """
+    pending = session.get("uploads", [])
+    signed = [name for name in object_names if name in pending]
+    # Every object is finalized once
+    session["uploads"] = [name for name in pending if name not in object_names]
+    results = {}
+    if signed:
+        bucket = storage.bucket()
+        # The app config is not available on the threads of the pool
+        folder = app.config["UPLOAD_FOLDER"]
+        with ThreadPoolExecutor(
+            max_workers=min(len(signed), MAX_UPLOAD_WORKERS)
+        ) as executor:
+            results = dict(
+                zip(
+                    signed,
+                    executor.map(
+                        lambda name: finalize_upload(bucket, folder, name), signed
+                    ),
+                )
+            )
+    return [
+        results.get(name, {"filename": name, "error": "unknown upload"})
+        for name in object_names
+    ]
+
+
+def configure_cors(origin):
+    """
+    Allow the site to upload to the bucket with signed URLs.
+
+    @param origin - The origin of the site, e.g. "https://example.com"
+    """
+    bucket = storage.bucket()
+    bucket.cors = [
+        {
+            "origin": [origin],
+            "method": ["PUT"],
+            "responseHeader": ["Content-Type", LENGTH_HEADER],
+            "maxAgeSeconds": 3600,
+        }
+    ]
+    bucket.patch()
+
+
+@click.command("storage-cors")
+@with_appcontext
+def storage_cors_command():
+    """Allow browser uploads to the bucket from FLASK_URL."""
+    origin = os.getenv("FLASK_URL", "").rstrip("/")
+    configure_cors(origin)
+    click.echo(f"Allowed uploads from {origin}.")
@@ -1,5 +1,5 @@
 """ This module contains all the routes related to adding a new post. """
-from flask import Blueprint, redirect, render_template, request, session
+from flask import Blueprint, jsonify, redirect, render_template, request, session
 
 from utils.add import (
     address_data,
@@ -9,14 +9,12 @@ from utils.add import (
     type_date_data,
 )
 from utils.auth import login_required
-from utils.firebase import (
-    add_to_firestore,
-    firebase_get,
-    update_firestore,
-    upload_images,
-)
+from utils.cache import document_cache_name
+from utils.drafts import commit_draft, start_draft, update_draft, update_post
+from utils.firebase import firebase_get, upload_images
 from utils.render import render_message
 from utils.time import convert_date
+from utils.uploads import finalize_uploads, sign_uploads
 
 add = Blueprint("add", __name__)
 
@@ -31,7 +29,11 @@ def get_add_page(pid, template):
     @return the template to render
     """
     if pid:
-        with firebase_get("posts", f"{pid}|{session['user']['uid']}") as doc:
+        with firebase_get(
+            "posts",
+            f"{pid}|{session['user']['uid']}",
+            cache=document_cache_name("posts", int(pid)),
+        ) as doc:
             # If doc is not found return 404
             if not doc:
                 return render_message(404, "Post not found")
@@ -39,6 +41,21 @@ def get_add_page(pid, template):
     return render_template(template)
 
 
+def save_step(pid, data, images=False):
+    """
+    Save the fields of a step of the add process, to the post when editing it
+    or to the draft of a new post.
+
+    @param pid - The id of the edited post or None for a new post
+    @param data - The fields of the step
+    @param images - If True add the images to the existing ones
+    """
+    if pid:
+        update_post(pid, data, images=images)
+    else:
+        update_draft(session["user"]["creation_id"], data, images=images)
+
+
 @add.route("/edit/<int:pid>", methods=["GET"])
 def edit(pid: int):
     """
@@ -70,11 +87,15 @@ def add_loc(pid: int):
     # This is the main entry point for the firestore.
     if request.method == "POST":
         data = address_data(request)
+        # An incomplete address is answered with an error message
+        if not isinstance(data, dict):
+            return data
         # Add or edit a user s post.
         if pid:
-            update_firestore(data, pid, "posts")
+            update_post(pid, data)
             return redirect("/edit/" + str(pid))
-        add_to_firestore(data, "posts")
+        # A new post is kept in a draft until the last step
+        start_draft(data)
         return redirect("/add-2")
     else:
         # This is the main page for the user s post
@@ -97,9 +118,7 @@ def add_type(pid: int):
     # POST request. form type from date to date
     if request.method == "POST":
         data = type_date_data(request)
-        update_firestore(
-            data, session["user"]["creation_id"] if not pid else pid, "posts"
-        )
+        save_step(pid, data)
         # Redirect to edit page if pid is not set
         return redirect("/add-3") if not pid else redirect("/edit/" + str(pid))
     else:
@@ -126,9 +145,7 @@ def add_space(pid: int):
         data = {
             "space": space,
         }
-        update_firestore(
-            data, session["user"]["creation_id"] if not pid else pid, "posts"
-        )
+        save_step(pid, data)
         # Redirect to edit page if pid is not set
         return redirect("/add-4") if not pid else redirect("/edit/" + str(pid))
     else:
@@ -151,9 +168,7 @@ def add_tags(pid: int):
     # Add a new post to the firestore
     if request.method == "POST":
         data = tags_data(request)
-        update_firestore(
-            data, session["user"]["creation_id"] if not pid else pid, "posts"
-        )
+        save_step(pid, data)
         # Redirect to edit page if pid is not set
         return redirect("/add-5") if not pid else redirect("/edit/" + str(pid))
     else:
@@ -178,15 +193,32 @@ def add_desc(pid: int):
         data = {
             "description": value,
         }
-        update_firestore(
-            data, session["user"]["creation_id"] if not pid else pid, "posts"
-        )
+        save_step(pid, data)
         # Redirect to edit page if pid is not set
         return redirect("/add-6") if not pid else redirect("/edit/" + str(pid))
     else:
         return get_add_page(pid, "add-1-5.html")
 
 
+def save_images(pid, results):
+    """
+    Add the uploaded images to the post or draft.
+
+    @param pid - The id of the edited post or None for a new post
+    @param results - The results of the uploads, see utils.firebase.upload_file
+    @return The results of the images that could not be uploaded
+    """
+    data = {
+        "images": [result["url"] for result in results if "url" in result],
+        "image_variants": [
+            result["variants"] for result in results if "variants" in result
+        ],
+    }
+    save_step(pid, data, images=True)
+    # The uploaded images are kept, the others are reported
+    return [result for result in results if "error" in result]
+
+
 @add.route("/add-6", defaults={"pid": None}, methods=["GET", "POST"])
 @add.route("/add-6/<int:pid>", methods=["GET", "POST"])
 @login_required
@@ -200,22 +232,67 @@ def add_image(pid: int):
             If you are editing the post, redirect to the property page.
     """
     if request.method == "POST":
-        img_urls = upload_images(request)
-        data = {
-            "images": img_urls,
-        }
-        update_firestore(
-            data,
-            session["user"]["creation_id"] if not pid else pid,
-            "posts",
-            images=True,
-        )
+        failed = save_images(pid, upload_images(request))
+        if failed:
+            names = ", ".join(
+                f'{result["filename"]} ({result["error"]})' for result in failed
+            )
+            return render_message(
+                400, f"These images could not be uploaded: {names}"
+            )
         # Redirect to edit page if pid is not set
         return redirect("/add-7") if not pid else redirect("/edit/" + str(pid))
     else:
         return get_add_page(pid, "add-1-6.html")
 
 
+@add.route("/add-6/sign", methods=["POST"])
+@login_required
+def sign_images():
+    """
+    Issue signed URLs to upload images directly to Storage.
+    The body is a JSON object with the name, type and size of the files.
+
+    @return The results of the files, see utils.uploads.sign_uploads, or a 400 without files
+    """
+    files = (request.get_json(silent=True) or {}).get("files")
+    if not isinstance(files, list) or not files:
+        return jsonify({"message": "Missing files"}), 400
+    return jsonify({"uploads": sign_uploads(files)}), 200
+
+
+@add.route("/add-6/finalize", defaults={"pid": None}, methods=["POST"])
+@add.route("/add-6/<int:pid>/finalize", methods=["POST"])
+@login_required
+def finalize_images(pid: int):
+    """
+    Add the images uploaded to Storage to a post.
+    The body is a JSON object with the names of the uploaded objects.
+
+    @param pid - pid of the post to add images to
+
+    @return The page to continue with and the images that could not be added,
+            or a 400 without objects
+    """
+    objects = (request.get_json(silent=True) or {}).get("objects")
+    if (
+        not isinstance(objects, list)
+        or not objects
+        or not all(isinstance(name, str) for name in objects)
+    ):
+        return jsonify({"message": "Missing objects"}), 400
+    failed = save_images(pid, finalize_uploads(objects))
+    return (
+        jsonify(
+            {
+                "redirect": "/add-7" if not pid else "/edit/" + str(pid),
+                "failed": failed,
+            }
+        ),
+        200,
+    )
+
+
 @add.route("/add-7", defaults={"pid": None}, methods=["GET", "POST"])
 @add.route("/add-7/<int:pid>", methods=["GET", "POST"])
 @login_required
@@ -232,9 +309,10 @@ def add_basics(pid: int):
     # Add a new post to the firestore
     if request.method == "POST":
         data = basic_data(request)
-        update_firestore(
-            data, session["user"]["creation_id"] if not pid else pid, "posts"
-        )
+        # A missing or non-numeric number of guests is answered with an error message
+        if not isinstance(data, dict):
+            return data
+        save_step(pid, data)
         # Redirect to edit page if pid is not set
         return redirect("/add-8") if not pid else redirect("/edit/" + str(pid))
     else:
@@ -246,7 +324,8 @@ def add_basics(pid: int):
 @login_required
 def add_prices(pid: int):
     """
-    Add the price to a post. You can also add the monthly or yearly discount
+    Add the price to a post. You can also add the monthly or yearly discount.
+    This is the last step, which writes a new post to the database.
 
     @param pid - pid of the post to add prices to
 
@@ -255,9 +334,14 @@ def add_prices(pid: int):
     """
     if request.method == "POST":
         data = price_data(request)
-        update_firestore(
-            data, session["user"]["creation_id"] if not pid else pid, "posts"
-        )
+        # A missing or non-numeric price is answered with an error message
+        if not isinstance(data, dict):
+            return data
+        if pid:
+            update_post(pid, data)
+        # The draft of a new post is written to Firestore in a single commit
+        elif commit_draft(session["user"]["creation_id"], data) is None:
+            return redirect("/add-1")
         pid = session["user"]["creation_id"]
         session["user"][
             "creation_id"
@@ -1,13 +1,47 @@
 """ This module contains the views for the various listing pages of the website. """
-from flask import Blueprint, redirect, render_template, request, session
+from flask import Blueprint, jsonify, render_template, request, session
 
 from utils.auth import login_required
+from utils.availability import availability_filter
+from utils.cache import cache_enabled, cached, search_cache_name
+from utils.clusters import MAX_ZOOM, ClusterIndex, tile_box
+from utils.facets import facet_filter
+from utils.geo import near_filter, posts_in_box
 from utils.countries import countries
-from utils.firebase import firebase_get, firebase_query, get_avg_ratings
+from utils.firebase import (
+    IN_QUERY_LIMIT,
+    firebase_get,
+    firebase_query,
+    get_avg_ratings,
+)
+from utils.pagination import (
+    PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+    fetch_page,
+    slice_page,
+)
 from utils.render import render_message
-from utils.search import get_search_params
+from utils.search import (
+    parse_near,
+    parse_search_params,
+    search_cache_key,
+    search_filter,
+)
+from utils.ranking import rank_page, sort_order
+from utils.search_index import INDEX_FIELDS
+from utils.search_index import (
+    index,
+    index_enabled,
+    lookup_posts,
+    map_clusters,
+    search_posts,
+)
 
 main = Blueprint("main", __name__)
+# Search candidates are read from Firestore in batches of this size.
+SEARCH_BATCH_SIZE = 200
+SEARCH_FIELDS = INDEX_FIELDS + ["tags"]
 
 
 @main.context_processor
@@ -23,6 +57,194 @@ def inject_variables():
     return {"countries": [c[0] for c in countries]}
 
 
+def load_posts(ids):
+    """
+    Load the cards of posts by their ids, from the in-memory search index if
+    it is loaded and otherwise from Firestore.
+
+    @param ids - The list of post ids
+    @return The list of the posts in the order of the ids, deleted posts are left out
+    """
+    docs = lookup_posts(ids)
+    if docs is not None:
+        return docs
+    found = {}
+    for start in range(0, len(ids), IN_QUERY_LIMIT):
+        with firebase_query(
+            "posts", [("id", "in", ids[start : start + IN_QUERY_LIMIT])], fields="card"
+        ) as chunk:
+            found.update({int(doc["id"]): doc for doc in chunk})
+    return [found[pid] for pid in ids if pid in found]
+
+
+def load_search_page(params, after):
+    """
+    Load one page of search results. The ids of the posts on a page are cached
+    under the canonical form of the search, until a post of its country changes.
+    Nothing is cached while the search index is loading.
+
+    @param params - The search form fields
+    @param after - The cursor of the previous page or None for the first page
+
+    @return A tuple of the documents on the page, the cursor of the next page
+            and the amenity counts of all results, which are None while the index is loading
+    """
+    vfrom, to, _, _, country, _ = parse_search_params(params)
+    # Bookings only matter if the guest picked the dates of the stay
+    available = None
+    if params["from"] and params["to"]:
+        available = availability_filter(vfrom, to)
+    # Results found while the index is loading are incomplete, e.g. keyword
+    # searches find nothing, so they must not be shared with the other workers
+    if not cache_enabled() or (index_enabled() and not index.ready):
+        return find_search_page(params, after, available)
+
+    def load():
+        docs, next_after, facets = find_search_page(params, after, available)
+        return [int(doc["id"]) for doc in docs], next_after, facets
+
+    ids, next_after, facets = cached(
+        search_cache_name(country),
+        search_cache_key(params, after, bookings=available is not None),
+        load,
+    )
+    return load_posts(ids), next_after, facets
+
+
+def find_search_page(params, after, available):
+    """
+    Find one page of search results. Searches are answered from the in-memory
+    search index and only read from Firestore while the index is loading.
+
+    @param params - The search form fields
+    @param after - The cursor of the previous page or None for the first page
+    @param available - An optional function that checks the bookings of a property id
+
+    @return A tuple as for load_search_page
+    """
+    vfrom, to, from_price, to_price, country, guests = parse_search_params(params)
+    keywords = params.get("q")
+    amenities = params.get("amenities")
+    match_all = params.get("match") != "any"
+    near = parse_near(params)
+    found = search_posts(
+        country,
+        guests,
+        vfrom,
+        to,
+        from_price,
+        to_price,
+        available=available,
+        keywords=keywords,
+        amenities=amenities,
+        match_all=match_all,
+        near=near,
+    )
+    if found is not None:
+        candidates, facets = found
+        docs, after = rank_page(candidates, params.get("sort"), after, PAGE_SIZE)
+        return docs, after, facets
+    if keywords:
+        # Keywords are only searched in the text index, never by scanning posts
+        return [], None, None
+    # The price range is filtered by Firestore, the dates are filtered here
+    # since Firestore cannot compare them with the stay
+    with firebase_query(
+        "posts",
+        [
+            ("country", "==", country),
+            ("maxGuests", ">=", guests),
+            ("price", ">=", from_price),
+            ("price", "<=", to_price),
+        ],
+        order_by=["maxGuests", "price", "id"],
+        fields=SEARCH_FIELDS,
+        stream=True,
+        prefetch=SEARCH_BATCH_SIZE,
+    ) as candidates:
+        predicate = search_filter(vfrom, to, from_price, to_price, available=available)
+        has_amenities = facet_filter(amenities, match_all)
+        is_near = near_filter(near)
+        candidates = (
+            doc
+            for doc in candidates
+            if predicate(doc)
+            and (has_amenities is None or has_amenities(doc))
+            and (is_near is None or is_near(doc))
+        )
+        docs, after = rank_page(candidates, params.get("sort"), after, PAGE_SIZE)
+    return docs, after, None
+
+
+def load_page(state):
+    """
+    Load one page of a listing feed. The state describes the feed, e.g. the
+    listings of a user or a search, and the cursor where the page starts.
+
+    @param state - The feed state, as created by the listing views or decoded from a page token
+
+    @return A tuple of the documents on the page, the state of the next page,
+            which is None if this is the last page, and the amenity counts of a search
+    """
+    feed = state["feed"]
+    after = state.get("after")
+    facets = None
+    if feed == "index":
+        # Ids are handed out in blocks per worker, so they are not in creation order
+        docs, after = fetch_page(
+            "posts", [], ["created", "id"], after, fields="card"
+        )
+    elif feed == "user":
+        docs, after = fetch_page(
+            "posts",
+            [("user_uid", "==", state["uid"])],
+            ["id"],
+            after,
+            fields="card",
+        )
+    elif feed == "favorites":
+        with firebase_get("fav", session["user"]["uid"]) as fav_doc:
+            favs = fav_doc["favs"] if fav_doc else []
+        # Every page must fit into a single "in" query
+        ids, after = slice_page(
+            favs, after, page_size=min(PAGE_SIZE, IN_QUERY_LIMIT)
+        )
+        docs = []
+        if ids:
+            with firebase_query(
+                "posts", [("id", "in", ids)], fields="card"
+            ) as docs:
+                docs = sorted(docs, key=lambda doc: int(doc["id"]))
+    else:
+        docs, after, facets = load_search_page(state["params"], after)
+    # Calculate the average rating of each document
+    docs = get_avg_ratings(docs)
+    next_state = {**state, "after": after} if after is not None else None
+    return docs, next_state, facets
+
+
+def render_listings(state, fav_doc):
+    """
+    Render the first page of a listing feed. Further pages are loaded by
+    the page with infinite scrolling from the listings_page endpoint.
+
+    @param state - The feed state, see load_page
+    @param fav_doc - The favorites of the current user
+
+    @return A template to render the listings page.
+    """
+    docs, next_state, facets = load_page(state)
+    return render_template(
+        "listings.html",
+        docs=docs,
+        fav_doc=fav_doc,
+        type=state["type"],
+        next_cursor=encode_cursor(next_state),
+        facets=facets,
+        params=state.get("params"),
+    )
+
+
 @main.route("/")
 def index():
     """
@@ -32,18 +254,12 @@ def index():
 
     @return A template to render the listings page for index.
     """
-    with firebase_query("posts", []) as docs:
-        docs = get_avg_ratings(docs)
-
-        if "user" not in session:
-            return render_template(
-                "listings.html", docs=docs, fav_doc=[], type="index"
-            )
+    state = {"feed": "index", "type": "index"}
+    if "user" not in session:
+        return render_listings(state, [])
 
-        with firebase_get("fav", session["user"]["uid"]) as fav_doc:
-            return render_template(
-                "listings.html", docs=docs, fav_doc=fav_doc, type="index"
-            )
+    with firebase_get("fav", session["user"]["uid"]) as fav_doc:
+        return render_listings(state, fav_doc)
 
 
 @main.route("/favorites")
@@ -60,14 +276,7 @@ def my_favs():
         # If fav_doc is not available return 404
         if not fav_doc:
             return render_message(404, "You have no favorites")
-        with firebase_query(
-            "posts", [("id", "in", [int(i) for i in fav_doc["favs"]])]
-        ) as docs:
-            # Calculate the average rating of each property
-            docs = get_avg_ratings(docs)
-            return render_template(
-                "listings.html", docs=docs, fav_doc=fav_doc, type="index"
-            )
+        return render_listings({"feed": "favorites", "type": "index"}, fav_doc)
 
 
 @main.route("/my-listings")
@@ -79,13 +288,8 @@ def my_listings():
 
     @return A template to render the listings page with a listings of the current user.
     """
-    with firebase_query(
-        "posts", [("user_uid", "==", session["user"]["uid"])]
-    ) as docs:
-        docs = get_avg_ratings(docs)
-        return render_template(
-            "listings.html", docs=docs, fav_doc=None, type="rentals"
-        )
+    state = {"feed": "user", "uid": session["user"]["uid"], "type": "rentals"}
+    return render_listings(state, None)
 
 
 @main.route("/listings/<uid>")
@@ -98,13 +302,69 @@ def user_listings(uid):
 
     @return A template for the listings of a user.
     """
-    with firebase_get(
-        "fav", session["user"]["uid"]
-    ) as fav_doc, firebase_query("posts", [("user_uid", "==", uid)]) as docs:
-        docs = get_avg_ratings(docs)
-        return render_template(
-            "listings.html", docs=docs, fav_doc=fav_doc, type="index"
-        )
+    with firebase_get("fav", session["user"]["uid"]) as fav_doc:
+        state = {"feed": "user", "uid": uid, "type": "index"}
+        return render_listings(state, fav_doc)
+
+
+@main.route("/api/listings")
+def listings_page():
+    """
+    Get the next page of a listing feed for infinite scrolling.
+
+    @return JSON with the rendered cards of the page and the token of the
+            next page, which is null on the last page, or 400 if the token is invalid
+    """
+    state = decode_cursor(request.args.get("cursor", ""))
+    if state is None:
+        return jsonify({"message": "Invalid page token"}), 400
+    fav_doc = []
+    if "user" in session:
+        with firebase_get("fav", session["user"]["uid"]) as fav_doc:
+            pass
+    elif state["feed"] in ("user", "favorites"):
+        return jsonify({"message": "You must be logged in to view this page."}), 401
+    docs, next_state, _ = load_page(state)
+    html = render_template(
+        "cards.html", docs=docs, fav_doc=fav_doc, type=state["type"]
+    )
+    return jsonify({"html": html, "next": encode_cursor(next_state)}), 200
+
+
+def load_map_tile(zoom, x, y):
+    """
+    Load the clusters of a map tile. The clusters are built from the in-memory
+    search index, or from the locations of the posts on the tile while it is loading.
+
+    @param zoom, x, y - The tile
+    @return The list of clusters, see ClusterIndex.tile
+    """
+    clusters = map_clusters()
+    if clusters is None:
+        docs = posts_in_box(*tile_box(zoom, x, y), fields=["id", "lat", "lng"])
+        clusters = ClusterIndex.from_docs(docs)
+    return clusters.tile(zoom, x, y)
+
+
+@main.route("/api/map")
+def map_tile():
+    """
+    Get the clusters of the listings on a map tile, in the usual z/x/y web mercator tiles.
+
+    @return JSON with the clusters of the tile, or 400 if the tile is invalid
+    """
+    try:
+        zoom, x, y = (int(request.args[arg]) for arg in ("z", "x", "y"))
+    except (KeyError, ValueError):
+        return jsonify({"message": "Missing or invalid tile"}), 400
+    if not 0 <= zoom <= MAX_ZOOM or not (0 <= x < 2**zoom and 0 <= y < 2**zoom):
+        return jsonify({"message": "Missing or invalid tile"}), 400
+    clusters = cached(
+        "posts", f"map:{zoom}/{x}/{y}", lambda: load_map_tile(zoom, x, y)
+    )
+    response = jsonify({"z": zoom, "x": x, "y": y, "clusters": clusters})
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response, 200
 
 
 @main.route("/stays")
@@ -119,7 +379,9 @@ def my_stays():
     with firebase_query(
         "rentals", [("user_uid", "==", session["user"]["uid"])]
     ) as properties, firebase_query(
-        "posts", [("id", "in", [int(doc["property"]) for doc in properties])]
+        "posts",
+        [("id", "in", [int(doc["property"]) for doc in properties])],
+        fields="card",
     ) as docs, firebase_query(
         "reviews", [("reviewer", "==", session["user"]["uid"])]
     ) as reviews:
@@ -142,34 +404,28 @@ def my_stays():
 @main.route("/search", methods=["POST"])
 def search():
     """
-    Search for posts that match the given criteria. You can search by date range and price range, country or the maximum number of guests.
+    Search for posts that match the given criteria. You can search by date range and price range, country, the maximum number of guests,
+    keywords in the description, location, type and amenities or the distance to a place.
 
 
-    @return A list of posts that match the search criteria. The list is sorted by price and with the most popular posts first
+    @return A list of posts that match the search criteria, ranked by the selected sort order:
+            relevance, price, rating, popularity or newest first
     """
-    from utils.time import format_firebase_date
-
-    vfrom, to, from_price, to_price, country, guests = get_search_params(
-        request
-    )
-    # Build the Firestore query
-    with firebase_query(
-        "posts", [("country", "==", country), ("maxGuests", ">=", guests)]
-    ) as docs:
-        # Filter the documents by price and date range, since we are limited in what
-        # we can do with Firestore queries
-        docs = [
-            doc
-            for doc in docs
-            if (
-                doc["price"] >= int(from_price)
-                and doc["price"] <= int(to_price)
-            )
-            and (
-                format_firebase_date(doc["from"]) <= vfrom
-                and format_firebase_date(doc["to"]) >= to
-            )
-        ]
-        # Calculate the average rating of each document
-        docs = get_avg_ratings(docs)
-        return render_template("listings.html", docs=docs, type="index")
+    params = {
+        field: request.form[field]
+        for field in ["from", "to", "from-price", "to-price", "country", "guests"]
+    }
+    params["q"] = request.form.get("q", "").strip()
+    params["amenities"] = request.form.getlist("amenity")
+    params["match"] = "any" if request.form.get("match") == "any" else "all"
+    params["sort"] = sort_order(request.form.get("sort"), params["q"])
+    params["near"] = request.form.get("near", "").strip()
+    params["radius"] = request.form.get("radius", "").strip()
+    # Invalid parameters are answered with an error message
+    error = parse_search_params(params)
+    if len(error) != 6:
+        return error
+    near = parse_near(params)
+    if near is not None and len(near) != 3:
+        return near
+    return render_listings({"feed": "search", "params": params, "type": "index"}, [])
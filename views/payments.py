@@ -1,4 +1,5 @@
 """ This module contains the routes for Stripe payments. """
+import logging
 import os
 
 import stripe
@@ -6,10 +7,12 @@ from flask import Blueprint, redirect, request, session
 from google.cloud.exceptions import GoogleCloudError
 
 from utils.auth import login_required
+from utils.availability import book_rental, is_available, record_booking
 from utils.checks import check_self
 from utils.render import render_message
 
 payments = Blueprint("payments", __name__)
+logger = logging.getLogger("first_logger")
 
 
 @payments.context_processor
@@ -25,6 +28,30 @@ def inject_variables():
     return {"hidenav": True}
 
 
+def refund_payment(payment_session_id):
+    """
+    Refund a checkout and cancel its subscription, e.g. because its dates were
+    booked by someone else while the user was paying.
+
+    @param payment_session_id - The id of the Stripe checkout session
+    """
+    try:
+        checkout = stripe.checkout.Session.retrieve(
+            payment_session_id, expand=["invoice"]
+        )
+        if checkout.get("subscription"):
+            stripe.Subscription.delete(checkout["subscription"])
+        invoice = checkout.get("invoice") or {}
+        payment_intent = checkout.get("payment_intent") or invoice.get(
+            "payment_intent"
+        )
+        if payment_intent:
+            stripe.Refund.create(payment_intent=payment_intent)
+    except stripe.error.StripeError:
+        # The payment stays recorded at Stripe, so it can be refunded by hand
+        logger.exception("Cannot refund the checkout %s", payment_session_id)
+
+
 @payments.route("/payment/<pid>", methods=["POST"])
 @login_required
 def create_checkout_session(pid):
@@ -38,6 +65,14 @@ def create_checkout_session(pid):
             is a : class : ` stripe. checkout. Session `
     """
     check_self(pid)
+    try:
+        free = request.form["from"] < request.form["to"] and is_available(
+            pid, request.form["from"], request.form["to"]
+        )
+    except ValueError:
+        return render_message(400, "Invalid date range")
+    if not free:
+        return render_message(409, "The property is not available on these dates")
     payment_session = stripe.checkout.Session.create(
         mode="subscription",
         payment_method_types=["card"],
@@ -70,13 +105,11 @@ def success_payment():
     @return A view with success status and error message if there was an
             error or a redirect to the payment page
     """
-    from utils.firebase import add_to_firestore
-
     payment_session_id = request.args.get("session_id")
     # This function is used to add a booking to firestore database.
     if payment_session_id == session["user"]["verificationToken"]:
         try:
-            add_to_firestore(
+            rid = book_rental(
                 {
                     "user_uid": session["user"]["uid"],
                     "pay_id": payment_session_id,
@@ -84,10 +117,23 @@ def success_payment():
                     "guests": int(session["user"]["guests"]),
                     "from": session["user"]["from"],
                     "to": session["user"]["to"],
-                },
-                "rentals",
+                }
             )
         except GoogleCloudError:
             return render_message(500, "Internal server error")
+        # Someone else booked the dates while this user was paying
+        if rid is None:
+            refund_payment(payment_session_id)
+            return render_message(
+                409,
+                "The property was booked for these dates meanwhile, "
+                "your payment will be refunded",
+            )
+        record_booking(
+            rid,
+            session["user"]["pid"],
+            session["user"]["from"],
+            session["user"]["to"],
+        )
         return render_message(200, "Payment successful")
     return render_message(401, "Unauthorized")
@@ -1,17 +1,23 @@
 """ This module contains the view functions for the property page. """
+import json
+
 from flask import (
     Blueprint,
+    Response,
     render_template,
     redirect,
     request,
     session,
     jsonify,
+    stream_with_context,
 )
-from firebase_admin import storage
-from utils.firebase import get_ratings_property
-from utils.gpt import get_travel_tips
+from utils.firebase import get_avg_rating, get_ratings_property
+from utils.ratings import average_rating, has_rating_aggregate
+from utils.tips import TIPS_MAX_AGE, get_cached_tips, stream_cached_tips
 from utils.auth import login_required
 from utils.firebase import firebase_query, firebase_get
+from utils.cache import document_cache_name, invalidate_posts, invalidate_searches
+from utils.blobs import release_images
 
 posts = Blueprint("posts", __name__)
 
@@ -26,7 +32,11 @@ def view(pid: int):
 
     @return The HTML of the property page. This page contains the property's information, reviews, and travel tips.
     """
-    with firebase_query("posts", [("pid", "==", int(pid))]) as data:
+    with firebase_query(
+        "posts",
+        [("pid", "==", int(pid))],
+        cache=document_cache_name("posts", int(pid)),
+    ) as data:
         doc = data[0]
         tags = []
         # Add tags to the tags list
@@ -34,12 +44,11 @@ def view(pid: int):
             for item in doc["tags"][tag]:
                 tags.append(item)
         reviews = get_ratings_property(pid)
-        review_ratings = [review["rating"] for review in reviews]
-        avg_rating = (
-            sum(review_ratings) / len(review_ratings)
-            if len(review_ratings) > 0
-            else 0
-        )
+        # Only the newest reviews are shown, so the average comes from the aggregate
+        if has_rating_aggregate(doc):
+            avg_rating = average_rating(doc) or 0
+        else:
+            avg_rating = get_avg_rating(pid) or 0
         return render_template(
             "property.html",
             doc=doc,
@@ -59,11 +68,41 @@ def get_tips():
     """
     city = request.args.get("city")
     country = request.args.get("country")
-    travel_tips = get_travel_tips(f"{city} + {', '} + {country}")
+    travel_tips = get_cached_tips(city, country)
     # This method is used to check for tips. If there are no tips, then the service is not available
     if not travel_tips:
-        return jsonify({"message": "Service not available"}), 200
-    return jsonify({"travel_tips": travel_tips}), 200
+        response = jsonify({"message": "Service not available"})
+        response.headers["Cache-Control"] = "no-store"
+        return response, 200
+    response = jsonify({"travel_tips": travel_tips})
+    # Tips rarely change, so browsers and proxies may reuse them
+    response.headers[
+        "Cache-Control"
+    ] = f"public, max-age={TIPS_MAX_AGE}, stale-while-revalidate={TIPS_MAX_AGE}"
+    return response, 200
+
+
+@posts.route("/tips/stream", methods=["GET"])
+def stream_tips():
+    """
+    Stream the list of tips for what to visit in a city as server-sent events.
+    Every tip is sent as soon as Bing Search AI produces it, followed by a done event.
+
+    @return An event stream response with one JSON encoded tip per message
+    """
+    city = request.args.get("city")
+    country = request.args.get("country")
+
+    def events():
+        for tip in stream_cached_tips(city, country):
+            yield f"data: {json.dumps(tip)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @posts.route("/delete-img/<int:pid>/<string:file>", methods=["GET"])
@@ -83,10 +122,18 @@ def delete_img(pid: int, file: str):
     ) as doc_ref:
         doc_data = doc_ref.get().to_dict()
         new_array = [x for x in doc_data["images"] if file not in x]
-        doc_ref.update({"images": new_array})
-        bucket = storage.bucket()
-        file_to_delete = bucket.blob(f"static/uploads/{file}")
-        file_to_delete.delete()
+        variants = doc_data.get("image_variants") or []
+        doc_ref.update(
+            {
+                "images": new_array,
+                "image_variants": [
+                    image for image in variants if file not in image["url"]
+                ],
+            }
+        )
+        invalidate_posts({"id": pid, "user_uid": session["user"]["uid"]})
+        # The image is only deleted if no other post shares it
+        release_images([x for x in doc_data["images"] if file in x])
         return redirect(f"/add-6/{pid}")
 
 
@@ -105,8 +152,8 @@ def delete_post(pid: int):
     with firebase_get(
         "posts", f"{pid}|{session['user']['uid']}", partial=True
     ) as doc_ref:
-        print(doc_ref.get().exists)
-        if not doc_ref.get().exists:
+        doc = doc_ref.get()
+        if not doc.exists:
             return (
                 render_template(
                     "message.html",
@@ -116,4 +163,7 @@ def delete_post(pid: int):
                 404,
             )
         doc_ref.delete()
+        invalidate_posts({"id": pid, "user_uid": session["user"]["uid"]})
+        invalidate_searches(doc.to_dict().get("country"))
+        release_images(doc.to_dict().get("images") or [])
         return redirect("/")
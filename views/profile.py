@@ -3,6 +3,7 @@ from firebase_admin import auth
 from flask import Blueprint, redirect, render_template, request, session
 
 from utils.add import user_data
+from utils.cache import document_cache_name
 from utils.firebase import firebase_query, get_avg_ratings, get_ratings_user
 
 profile = Blueprint("profile", __name__)
@@ -33,13 +34,19 @@ def view_user(uid: str):
     """
     user = auth.get_user(uid)
     data = user_data(user)
-    with firebase_query("posts", [("user_uid", "==", uid)]) as docs:
+    with firebase_query(
+        "posts",
+        [("user_uid", "==", uid)],
+        fields="card",
+        cache=document_cache_name("listings", uid),
+    ) as docs:
         docs = get_avg_ratings(docs)
-        reviews, avg_rating = get_ratings_user(uid)
+        reviews, avg_rating, review_count = get_ratings_user(docs)
         return render_template(
             "profile.html",
             user=data,
             reviews=reviews,
+            review_count=review_count,
             docs=docs,
             avg_rating=avg_rating,
         )
@@ -3,12 +3,8 @@ from flask import Blueprint, redirect, render_template, request, session
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 
 from utils.checks import check_duplicate, check_self
-from utils.firebase import (
-    add_to_firestore,
-    firebase_get,
-    firebase_query,
-    update_firestore,
-)
+from utils.firebase import firebase_query, next_id
+from utils.ratings import commit_review
 from utils.render import render_message
 
 reviews = Blueprint("reviews", __name__)
@@ -28,8 +24,9 @@ def add_review(pid: int):
     """
     # This is a POST request.
     if request.method == "POST":
-        check_self(pid)
-        check_duplicate(pid)
+        error = check_self(pid) or check_duplicate(pid)
+        if error:
+            return error
         # with firebase_query("posts", [("id", "==", int(pid))]) as data:
         #     doc = data[0]
         #     # If the user is the user s uid
@@ -48,7 +45,9 @@ def add_review(pid: int):
         #         return render_message(
         #             400, "You can't post a review on the same property twice"
         #         )
+        rid = next_id("reviews")
         data = {
+            "id": rid,
             "rating": int(request.form["rating"]),
             "text": request.form["message"],
             "reviewer": session["user"]["uid"],
@@ -56,7 +55,8 @@ def add_review(pid: int):
             "reviewed": int(pid),
             "timestamp": SERVER_TIMESTAMP,
         }
-        add_to_firestore(data, "reviews")
+        # Write the review and update the post's rating aggregate together
+        commit_review(rid, data)
         return redirect("/stays")
     return render_template("review.html")
 
@@ -77,7 +77,7 @@ def edit_review(rid: int):
             "text": request.form["message"],
             "timestamp": SERVER_TIMESTAMP,
         }
-        update_firestore(data, rid, "reviews")
+        commit_review(rid, data)
         return redirect("/stays")
     else:
         with firebase_query("reviews", [("id", "==", int(rid))]) as data:
@@ -100,12 +100,7 @@ def delete_review(rid: int):
 
     @return template with error message or redirect to stays if the review is deleted.
     """
-    with firebase_get(
-        "reviews", f'{rid}|{session["user"]["uid"]}', partial=True
-    ) as doc_ref:
-        if doc_ref.get().to_dict() is None:
-            return render_message(
-                400, "Cannot delete a review that doesn't exist"
-            )
-        doc_ref.delete()
-        return redirect("/stays")
+    # Delete the review and update the post's rating aggregate together
+    if commit_review(rid, None) is None:
+        return render_message(400, "Cannot delete a review that doesn't exist")
+    return redirect("/stays")